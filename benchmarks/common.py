@@ -0,0 +1,109 @@
+"""Helpers shared by the benchmark scripts: summaries and JSON baselines."""
+
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, "benchmarks", "baselines")
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile, `pct` in 0..100."""
+    ordered = sorted(values)
+    if not ordered:
+        return float("nan")
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(values):
+    return {
+        "min": min(values),
+        "median": statistics.median(values),
+        "max": max(values),
+    }
+
+
+def environment():
+    """Where the numbers were taken; baselines only compare on the same setup."""
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def load_baseline(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {
+        "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": environment(),
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Baseline written to {path}")
+
+
+def compare(results, baseline, tolerance, min_delta=None, higher_is_better=()):
+    """
+    Compare `results[target][metric]` against the baseline and return one
+    message per regression. A metric regresses when it is worse by more than
+    `tolerance` (a fraction) *and* by more than `min_delta[metric]`, so tiny
+    absolute swings on small numbers don't fail the run.
+    """
+    min_delta = min_delta or {}
+    if baseline["environment"] != environment():
+        print(
+            "Warning: baseline was recorded on a different setup "
+            f"({baseline['environment']['python']} on {baseline['environment']['platform']}), "
+            "the comparison is only indicative"
+        )
+
+    regressions = []
+    for target, metrics in results.items():
+        previous = baseline["results"].get(target)
+        if previous is None:
+            continue
+        for metric, value in metrics.items():
+            old = previous.get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            delta = old - value if metric in higher_is_better else value - old
+            if delta > abs(old) * tolerance and delta > min_delta.get(metric, 0):
+                regressions.append(
+                    f"{target} {metric}: {old:.1f} -> {value:.1f} "
+                    f"({delta / old * 100 if old else math.inf:+.0f}% worse)"
+                )
+    return regressions
+
+
+def print_table(headers, rows):
+    widths = [
+        max(len(str(cell)) for cell in column) for column in zip(headers, *rows)
+    ]
+    for row in [headers, *rows]:
+        print("  ".join(str(cell).rjust(width) for cell, width in zip(row, widths)))
+
+
+def exit_with(regressions):
+    if regressions:
+        print("\nRegressions against the baseline:")
+        for message in regressions:
+            print(f"  - {message}")
+        sys.exit(1)
@@ -0,0 +1,219 @@
+"""
+Cold start benchmark for the API.
+
+Every run starts a fresh interpreter, imports the app (`src.main` or one of
+the bundles written by build.py), then sends it a single `GET /api/health`
+straight through ASGI. That covers what a serverless cold start pays before
+it can answer: imports, building the schemas/models, creating the engine
+and FastAPI's lazy middleware setup on the first request. The lifespan is not
+run, so no database is needed.
+
+    python build.py                                     # bundles to measure
+    python -m benchmarks.startup                        # compare with the baseline
+    python -m benchmarks.startup --update-baseline      # record a new baseline
+
+Metrics (median over the runs):
+
+    import_ms          importing the module, measured inside the child
+    first_request_ms   from the end of the import to the first response
+    process_ms         spawn to first response, including interpreter startup
+    peak_rss_mb        max resident set size of the child
+
+Exits with status 1 when a metric is worse than the baseline by more than
+`--tolerance`. Baselines are machine specific; record one on the machine (or
+CI runner) that does the comparing.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.common import (
+    BASELINE_DIR,
+    ROOT,
+    compare,
+    exit_with,
+    load_baseline,
+    print_table,
+    save_baseline,
+    summarize,
+)
+from build import BUNDLE_LOADER, BUNDLES, import_check_env
+
+METRICS = ["import_ms", "first_request_ms", "process_ms", "peak_rss_mb"]
+
+# below these a difference is noise, whatever the percentage
+MIN_DELTA = {"import_ms": 5, "first_request_ms": 2, "process_ms": 10, "peak_rss_mb": 2}
+
+CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+LOADER
+imported = time.perf_counter()
+
+status = None
+if module is not None:
+    import asyncio
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/api/health",
+        "raw_path": b"/api/health",
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"host", b"localhost")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("localhost", 80),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(module.app(scope, receive, send))
+    status = messages[0]["status"]
+answered = time.perf_counter()
+
+# ru_maxrss is in KiB on Linux and in bytes on macOS
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+rss_mb = rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+print("RESULT " + json.dumps({
+    "status": status,
+    "import_ms": (imported - start) * 1000,
+    "first_request_ms": (answered - imported) * 1000,
+    "peak_rss_mb": rss_mb,
+}), flush=True)
+"""
+
+
+def find_targets(bundle_dir):
+    """Name -> statement that binds `module`. "python" is the empty baseline."""
+    targets = {
+        "python": "module = None",
+        "src.main": "import src.main as module",
+    }
+    for name in BUNDLES:
+        path = os.path.join(bundle_dir, f"{name}.build.py")
+        if os.path.exists(path):
+            targets[f"{name}.build.py"] = BUNDLE_LOADER.format(path=path)
+        else:
+            print(f"Skipping {name}.build.py: {path} not found, run `python build.py` first")
+    return targets
+
+
+def run_once(loader):
+    started = time.perf_counter()
+    child = subprocess.Popen(
+        [sys.executable, "-c", CHILD.replace("LOADER", loader)],
+        cwd=ROOT,
+        env=import_check_env(),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    # the result line is printed right after the first response, so this
+    # doesn't include interpreter shutdown
+    for line in child.stdout:
+        if line.startswith("RESULT "):
+            process_ms = (time.perf_counter() - started) * 1000
+            break
+    else:
+        process_ms = None
+    _, stderr = child.communicate()
+    if process_ms is None or child.returncode != 0:
+        raise RuntimeError(f"Benchmark child failed:\n{stderr[-2000:]}")
+
+    result = json.loads(line[len("RESULT "):])
+    if result["status"] not in (None, 200):
+        raise RuntimeError(f"First request answered {result['status']}")
+    result["process_ms"] = process_ms
+    return result
+
+
+def measure(targets, runs, warmup):
+    results = {}
+    for name, loader in targets.items():
+        for _ in range(warmup):  # page the files into the OS cache
+            run_once(loader)
+        samples = [run_once(loader) for _ in range(runs)]
+        results[name] = {
+            metric: summarize([sample[metric] for sample in samples])
+            for metric in METRICS
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure API cold start cost.")
+    parser.add_argument("--runs", type=int, default=10, help="Measured runs per target")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured runs per target")
+    parser.add_argument(
+        "--target",
+        action="append",
+        help="Only measure this target (repeatable): python, src.main, <bundle>.build.py",
+    )
+    parser.add_argument(
+        "--bundle-dir",
+        default=os.path.join(ROOT, "frontend", "api", "build"),
+        help="Where build.py wrote the bundles",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=os.path.join(BASELINE_DIR, "startup.json"),
+        help="Baseline JSON file",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="Write the results as the new baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.15,
+        help="Allowed slowdown before a metric counts as a regression (fraction)",
+    )
+    args = parser.parse_args()
+
+    targets = find_targets(args.bundle_dir)
+    if args.target:
+        unknown = set(args.target) - set(targets)
+        if unknown:
+            parser.error(f"unknown target(s): {', '.join(sorted(unknown))}")
+        targets = {name: targets[name] for name in args.target}
+
+    stats = measure(targets, args.runs, args.warmup)
+    print_table(
+        ["target", *METRICS],
+        [
+            [name, *(f"{s[m]['median']:.1f} (min {s[m]['min']:.1f})" for m in METRICS)]
+            for name, s in stats.items()
+        ],
+    )
+    results = {
+        name: {metric: s[metric]["median"] for metric in METRICS}
+        for name, s in stats.items()
+    }
+
+    if args.update_baseline:
+        save_baseline(args.baseline, results)
+        return
+    baseline = load_baseline(args.baseline)
+    if baseline is None:
+        print(f"\nNo baseline at {args.baseline}, run with --update-baseline to record one")
+        return
+    exit_with(compare(results, baseline, args.tolerance, MIN_DELTA))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Compile every link into a snapshot file for LINK_SNAPSHOT_PATH.
+
+    python export_snapshot.py --out links.snap
+
+Reads the links from the configured store (STORAGE_BACKEND, DATABASE_URL)
+and writes a minimal perfect hash over the ids plus a string heap of the
+long URLs (see src/snapshot.py). Running servers pick up a new file within
+LINK_SNAPSHOT_REFRESH seconds; links created after the export are looked up
+in the database as before.
+"""
+
+import asyncio
+import time
+
+
+async def export(out):
+    from src.snapshot import write_snapshot
+    from src.storage import link_store
+
+    try:
+        started = time.perf_counter()
+        links = [link async for link in link_store.iter_links()]
+        read_s = time.perf_counter() - started
+        count = write_snapshot(out, links)
+        print(f"Read {count} links in {read_s:.1f}s, wrote {out} in {time.perf_counter() - started - read_s:.1f}s")
+    finally:
+        await link_store.close()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write the link snapshot file.")
+    parser.add_argument("--out", default="links.snap", help="Snapshot file to write")
+    args = parser.parse_args()
+    asyncio.run(export(args.out))
+
+
+if __name__ == "__main__":
+    main()
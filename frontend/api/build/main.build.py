@@ -5,168 +5,3777 @@
 # Any changes made to this file will be lost when build.py runs again.
 # To make changes, edit the source files in the src/ directory instead.
 # 
-# Generated from: db.py, schemas.py, models.py, main.py
+# Generated from: metrics.py, schemas.py, querylog.py, db.py, snapshot.py, tracing.py, profiler.py, cache.py, breaker.py, utils.py, models.py, counters.py, clicks.py, spool.py, storage.py, filters.py, expiry.py, suggest.py, main.py
+# Routes: all
 # ============================================================================
 
+# Deferred into the functions that use them:
+#   from bs4 import BeautifulSoup
+#   from google.genai import Client as GenAIClient
+#   from google.genai import errors as genai_errors
+#   import httpx
+
 # ===== All Imports =====
+import asyncio
+import fcntl
 import hashlib
+import hmac
+import json
+import logging
+import math
+import mmap
 import os
 import random
+import re
+import secrets
+import sqlite3
+import struct
+import sys
+import threading
 import time
-from datetime import datetime
-from typing import AsyncGenerator, Optional
+import traceback
+import tracemalloc
+import zlib
+from abc import ABC, abstractmethod
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import AsyncGenerator, AsyncIterator, Awaitable, Callable, Iterable, Iterator, Optional, TypeVar
+from urllib.parse import unquote, urlsplit
+
+import dotenv
+import fastapi
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import AnyHttpUrl, BaseModel, Field
+from sqlalchemy import DateTime, ForeignKey, Index, Integer, NullPool, String, bindparam, case, delete, event, func, insert, literal_column, or_, select, text, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Mapped, declarative_base, mapped_column, relationship
+
+
+# ===== Bundle Environment Defaults =====
+import os
+
+os.environ.setdefault('DB_POOL_SIZE', '1')
+os.environ.setdefault('DB_POOL_MAX_OVERFLOW', '2')
+os.environ.setdefault('DB_POOL_PRE_PING', '1')
+os.environ.setdefault('DB_POOL_RECYCLE', '300')
+
+
+# ===== From metrics.py =====
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+OUTBOUND_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0)
+
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21)
+
+
+_request_db_stats: ContextVar[list | None] = ContextVar("request_db_stats", default=None)
+
+
+_route_paths: dict = {}
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Counters, histograms and callback gauges kept in process memory and
+    rendered in the Prometheus text format. Every metric is declared once
+    with its help text; series are created on first use per label set.
+    """
+
+    def __init__(self):
+        self._families: dict[str, dict] = {}
+
+    def counter(self, name: str, help: str):
+        self._families[name] = {"type": "counter", "help": help, "series": {}}
+
+    def histogram(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self._families[name] = {
+            "type": "histogram",
+            "help": help,
+            "buckets": buckets,
+            "series": {},
+        }
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]):
+        """A value read when /metrics is scraped, e.g. a queue length."""
+        self._families[name] = {"type": "gauge", "help": help, "read": read}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._families[name]["series"]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        family = self._families[name]
+        key = tuple(sorted(labels.items()))
+        histogram = family["series"].get(key)
+        if histogram is None:
+            histogram = family["series"][key] = Histogram(family["buckets"])
+        histogram.observe(value)
+
+    @contextmanager
+    def time_block(self, name: str, **labels):
+        """Observe the duration of the block, labelled outcome="ok" or "error"."""
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            self.observe(name, time.perf_counter() - start, outcome=outcome, **labels)
+
+    def render(self) -> str:
+        lines = []
+        for name, family in self._families.items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            if family["type"] == "gauge":
+                try:
+                    lines.append(f"{name} {_format_value(family['read']())}")
+                except Exception as e:
+                    print(f"Failed to read gauge {name}: {e}")
+                continue
+            for labels, value in family["series"].items():
+                if family["type"] == "counter":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip((*family["buckets"], float("inf")), value.counts):
+                    cumulative += count
+                    le = (("le", _format_value(float(bound))),)
+                    lines.append(f"{name}_bucket{_format_labels(labels + le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+metrics.histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the last response byte.",
+)
+
+
+metrics.counter("http_requests_total", "Requests handled, by route, method and status.")
+
+
+metrics.histogram(
+    "http_request_db_queries",
+    "Database statements executed per request.",
+    QUERY_COUNT_BUCKETS,
+)
+
+
+metrics.histogram(
+    "http_request_db_seconds",
+    "Time per request spent waiting for database statements.",
+)
+
+
+metrics.histogram(
+    "db_query_duration_seconds",
+    "Duration of single database statements, by statement type.",
+)
+
+
+metrics.histogram(
+    "outbound_request_duration_seconds",
+    "Duration of calls to other services (page fetches, LLM calls).",
+    OUTBOUND_BUCKETS,
+)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_started
+    kind = statement.split(None, 1)[0].upper() if statement else ""
+    metrics.observe("db_query_duration_seconds", elapsed, statement=kind)
+    stats = _request_db_stats.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+
+
+def install_engine_hooks(engine: AsyncEngine):
+    """Time every statement the engine runs (and count it for the request)."""
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def route_template(scope) -> str:
+    """
+    The path template of the route that handled the request, e.g.
+    "/url/{url}/redirect". Starlette puts the matched endpoint in the scope;
+    requests that matched no route are all "unmatched", so scanners can't
+    create unbounded label values.
+    """
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    if endpoint not in _route_paths:
+        for route in scope["app"].router.routes:
+            if hasattr(route, "endpoint"):
+                _route_paths[route.endpoint] = route.path
+    return _route_paths.get(endpoint, "unmatched")
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware (no BaseHTTPMiddleware task/queue overhead) that
+    records latency, status and database usage per route template.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        db_stats = [0, 0.0]
+        token = _request_db_stats.set(db_stats)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_db_stats.reset(token)
+            route = route_template(scope)
+            metrics.observe(
+                "http_request_duration_seconds", time.perf_counter() - start, route=route
+            )
+            metrics.inc(
+                "http_requests_total", route=route, method=scope["method"], status=status
+            )
+            metrics.observe("http_request_db_queries", db_stats[0], route=route)
+            metrics.observe("http_request_db_seconds", db_stats[1], route=route)
+
+
+
+# ===== From schemas.py =====
+class LinkCreate(BaseModel):
+    long_url: AnyHttpUrl
+    name: str | None = None
+    # the link stops redirecting at expires_at (UTC unless an offset is
+    # given) or after max_clicks redirects, whichever comes first
+    expires_at: datetime | None = None
+    max_clicks: int | None = Field(default=None, ge=1)
+
+
+class LinkMetadataResponse(BaseModel):
+    clicks: int
+    last_ip: str | None
+    custom_name: str | None = None
+    expires_at: datetime | None = None
+    max_clicks: int | None = None
+
+
+class LinkResponse(BaseModel):
+    shortened_url: str
+    long_url: AnyHttpUrl
+    link_metadata: LinkMetadataResponse = Field(alias="metadata")
+
+
+class ErrorResponse(BaseModel):
+    error: str
+    message: str
+    redirect_to: str | None = None
+
+
+class LinkRedirectResponse(BaseModel):
+    message: str = "Redirecting to the original URL"
+    redirect_to: str = Field(alias="long_url")
+
+
+class LinkAliasAvailabilityResponse(BaseModel):
+    alias: str
+    is_available: bool
+
+
+class LinkAliasBatchCheck(BaseModel):
+    aliases: list[str] = Field(max_length=100)
+
+
+class LinkAliasBatchAvailabilityResponse(BaseModel):
+    results: list[LinkAliasAvailabilityResponse]
+
+
+class LinkAliasSuggestionResponse(BaseModel):
+    suggested_aliases: list[str]
+    time_taken: float
+    source: str | None = None
+
+
+class LinkURLExistenceResponse(BaseModel):
+    long_url: AnyHttpUrl
+    exists: bool
+
+
+class LinkShortUrlSuggestionsResponse(BaseModel):
+    suggested_names: list[str]
+
+
+
+# ===== From querylog.py =====
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+
+
+QUERY_LOG_SAMPLE_RATE = float(os.getenv("QUERY_LOG_SAMPLE_RATE", "0"))
+
+
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "0") == "1"
+
+
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+
+
+QUERY_LOG_ENABLED = SLOW_QUERY_MS >= 0 or QUERY_LOG_SAMPLE_RATE > 0
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+_EXPLAINED_MAX = 1000
+
+
+_explained_at: OrderedDict[str, float] = OrderedDict()
+
+
+def _shape(value) -> str:
+    """Type (and size) of a parameter, never the value: ids, IPs and URLs stay out of logs."""
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}({len(value)})"
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def parameter_shapes(context, parameters, executemany: bool):
+    # bind names when SQLAlchemy compiled the statement, positions otherwise
+    compiled = getattr(context, "compiled_parameters", None)
+    if compiled:
+        rows = compiled
+        first = {name: _shape(value) for name, value in rows[0].items()}
+    else:
+        rows = parameters if executemany else [parameters]
+        first = [_shape(value) for value in (rows[0] if rows else ())]
+    if executemany:
+        return {"rows": len(rows), "first": first}
+    return first
+
+
+def _explain(conn, statement: str, parameters):
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    conn.info["query_log_explaining"] = True
+    try:
+        # in a savepoint: on Postgres a failed statement would otherwise abort
+        # the request's own transaction
+        with conn.begin_nested():
+            rows = conn.exec_driver_sql(prefix + statement, parameters).all()
+    finally:
+        conn.info["query_log_explaining"] = False
+    return [" | ".join(str(value) for value in row) for row in rows]
+
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context._query_log_started = time.perf_counter()
+
+
+def _log_query(conn, cursor, statement, parameters, context, executemany):
+    if conn.info.get("query_log_explaining"):
+        return
+    elapsed_ms = (time.perf_counter() - context._query_log_started) * 1000
+    slow = 0 <= SLOW_QUERY_MS <= elapsed_ms
+    if not slow and (QUERY_LOG_SAMPLE_RATE <= 0 or random.random() >= QUERY_LOG_SAMPLE_RATE):
+        return
+
+    text = _WHITESPACE_RE.sub(" ", statement).strip()
+    entry = {
+        "event": "slow_query" if slow else "sampled_query",
+        "duration_ms": round(elapsed_ms, 2),
+        "statement": text[:1000],
+        "parameters": parameter_shapes(context, parameters, executemany),
+    }
+    if context is not None and not getattr(context, "isddl", False) and context.rowcount >= 0:
+        entry["rowcount"] = context.rowcount
+
+    now = time.monotonic()
+    if (
+        slow
+        and SLOW_QUERY_EXPLAIN
+        and not executemany
+        and text.split(" ", 1)[0].upper() in _EXPLAINABLE
+        and now - _explained_at.get(text, -SLOW_QUERY_EXPLAIN_INTERVAL) >= SLOW_QUERY_EXPLAIN_INTERVAL
+    ):
+        _explained_at[text] = now
+        _explained_at.move_to_end(text)
+        if len(_explained_at) > _EXPLAINED_MAX:
+            _explained_at.popitem(last=False)
+        try:
+            entry["plan"] = _explain(conn, statement, parameters)
+        except Exception as e:
+            entry["plan_error"] = str(e)
+    print(json.dumps(entry))
+
+
+def install_query_log(engine: AsyncEngine):
+    """
+    Log slow statements (and a sample of the rest) as one JSON line each,
+    instead of echoing every statement. The EXPLAIN for a slow statement runs
+    on the same connection inside a savepoint, so it only adds latency to that
+    one request and a failing EXPLAIN leaves its transaction usable.
+    """
+    event.listen(engine.sync_engine, "before_cursor_execute", _start_query_timer)
+    event.listen(engine.sync_engine, "after_cursor_execute", _log_query)
+
+
+
+# ===== From db.py =====
+dotenv.load_dotenv()
+
+
+db_url = os.getenv("DATABASE_URL")
+
+
+db_echo = os.getenv("DB_ECHO", "0") == "1"
+
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+
+
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+
+
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") == "1"
+
+
+Base = declarative_base()
+
+
+pool_options = (
+    {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_POOL_MAX_OVERFLOW,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if DB_POOL_SIZE > 0
+    else {"poolclass": NullPool}
+)
+
+
+async_engine = (
+    create_async_engine(db_url, echo=db_echo, future=True, **pool_options)
+    if db_url
+    else None
+)
+
+
+async_session_factory = (
+    async_sessionmaker(bind=async_engine, expire_on_commit=False)
+    if async_engine is not None
+    else None
+)
+
+
+async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
+    if async_session_factory is None:
+        raise EnvironmentError("DATABASE_URL not set in environment variables")
+    async with async_session_factory() as session:
+        yield session
+
+
+
+# ===== From snapshot.py =====
+SNAPSHOT_MAGIC = b"LNKSNAP1"
+
+
+SNAPSHOT_BUCKET_SIZE = 2
+
+
+_SNAPSHOT_HEADER = struct.Struct("<8sIIQQQd16s")
+
+
+_SNAPSHOT_ENTRY = struct.Struct("<QII")
+
+
+_SNAPSHOT_DISPLACEMENT = struct.Struct("<I")
+
+
+_SNAPSHOT_HASH = struct.Struct("<QII")
+
+
+class SnapshotBuildError(Exception):
+    """Raised when no perfect hash could be found (practically never)."""
+
+
+def _snapshot_hash(key: bytes, salt: bytes) -> tuple[int, int, int]:
+    return _SNAPSHOT_HASH.unpack(hashlib.blake2b(key, digest_size=16, salt=salt).digest())
+
+
+def _displacements(hashes: list, n: int, m: int) -> array:
+    """
+    CHD ("compress, hash and displace"): keys are grouped into `m` buckets,
+    and every bucket, biggest first, gets the smallest displacement d that
+    sends all of its keys to free slots with
+    slot = (f1 + (d // n) * f2 + d % n) % n.
+    """
+    buckets: list[list[int]] = [[] for _ in range(m)]
+    for i, (h0, _, _) in enumerate(hashes):
+        buckets[h0 % m].append(i)
+    taken = bytearray(n)
+    displacements = array("I", bytes(4 * m))
+    next_free = 0
+    for bucket in sorted(range(m), key=lambda b: len(buckets[b]), reverse=True):
+        keys = buckets[bucket]
+        if not keys:
+            break
+        if len(keys) == 1:
+            # any free slot works, so take the next one directly
+            while taken[next_free]:
+                next_free += 1
+            f1 = hashes[keys[0]][1]
+            d = (next_free - f1) % n
+            taken[next_free] = 1
+            displacements[bucket] = d
+            continue
+        params = [hashes[k][1:] for k in keys]
+        for d in range(min(n * n, 2**32)):
+            d0, d1 = divmod(d, n)
+            slots = []
+            for f1, f2 in params:
+                slot = (f1 + d0 * f2 + d1) % n
+                if taken[slot] or slot in slots:
+                    break
+                slots.append(slot)
+            else:
+                break
+        else:
+            raise SnapshotBuildError(f"no displacement for a bucket of {len(keys)} keys")
+        for slot in slots:
+            taken[slot] = 1
+        displacements[bucket] = d
+    return displacements
+
+
+def write_snapshot(path: str, links: Iterable[tuple[str, str]]) -> int:
+    """
+    Compile (id, long_url) pairs into a snapshot file at `path` and return
+    the number of links. The file is written next to `path` and renamed
+    over it, so a process that has the old one mapped keeps reading it.
+    """
+    keys: list[bytes] = []
+    urls: list[bytes] = []
+    for link_id, long_url in links:
+        keys.append(link_id.encode())
+        urls.append(long_url.encode())
+    n = len(keys)
+    m = max(1, (n + SNAPSHOT_BUCKET_SIZE - 1) // SNAPSHOT_BUCKET_SIZE)
+
+    for _ in range(8):
+        salt = os.urandom(16)
+        hashes = [_snapshot_hash(key, salt) for key in keys]
+        try:
+            displacements = _displacements(hashes, n, m) if n else array("I", [0])
+            break
+        except SnapshotBuildError:
+            continue
+    else:
+        raise SnapshotBuildError("could not build a perfect hash, are the ids unique?")
+
+    slot_of = [0] * n
+    for i, (h0, f1, f2) in enumerate(hashes):
+        d0, d1 = divmod(displacements[h0 % m], n)
+        slot_of[(f1 + d0 * f2 + d1) % n] = i
+
+    displacement_offset = _SNAPSHOT_HEADER.size
+    entry_offset = displacement_offset + _SNAPSHOT_DISPLACEMENT.size * m
+    heap_offset = entry_offset + _SNAPSHOT_ENTRY.size * n
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(
+            _SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, n, m, displacement_offset, entry_offset, heap_offset,
+                time.time(), salt,
+            )
+        )
+        f.write(displacements.tobytes())
+        position = 0
+        entries = bytearray()
+        for i in slot_of:
+            entries += _SNAPSHOT_ENTRY.pack(position, len(keys[i]), len(urls[i]))
+            position += len(keys[i]) + len(urls[i])
+        f.write(entries)
+        for i in slot_of:
+            f.write(keys[i])
+            f.write(urls[i])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return n
+
+
+class LinkSnapshot:
+    """
+    Read-only view of a snapshot file. Lookups hash the id once, read two
+    fixed-size records and compare the stored id (so unknown ids are told
+    apart); nothing is loaded per entry, the pages come from the mmap.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (
+            magic, self.count, self._buckets, self._displacement_offset,
+            self._entry_offset, self._heap_offset, self.created_at, self._salt,
+        ) = _SNAPSHOT_HEADER.unpack_from(self._mm, 0)
+        if magic != SNAPSHOT_MAGIC or self._heap_offset > len(self._mm):
+            self._mm.close()
+            raise ValueError(f"{path} is not a link snapshot")
+
+    def __len__(self) -> int:
+        return self.count
+
+    def lookup(self, link_id: str) -> str | None:
+        if not self.count:
+            return None
+        key = link_id.encode()
+        h0, f1, f2 = _snapshot_hash(key, self._salt)
+        (d,) = _SNAPSHOT_DISPLACEMENT.unpack_from(
+            self._mm, self._displacement_offset + _SNAPSHOT_DISPLACEMENT.size * (h0 % self._buckets)
+        )
+        d0, d1 = divmod(d, self.count)
+        slot = (f1 + d0 * f2 + d1) % self.count
+        position, key_length, url_length = _SNAPSHOT_ENTRY.unpack_from(
+            self._mm, self._entry_offset + _SNAPSHOT_ENTRY.size * slot
+        )
+        start = self._heap_offset + position
+        if key_length != len(key) or self._mm[start : start + key_length] != key:
+            return None
+        return self._mm[start + key_length : start + key_length + url_length].decode()
+
+    def close(self):
+        self._mm.close()
+
+
+
+# ===== From tracing.py =====
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "1") == "1"
+
+
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+
+
+TRACE_EXPORT_URL = os.getenv("TRACE_EXPORT_URL")
+
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+
+
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+
+
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "url-shortener")
+
+
+TRACING_ENABLED = SERVER_TIMING_ENABLED or bool(TRACE_EXPORT_FILE or TRACE_EXPORT_URL)
+
+
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "duration_ns", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: str | None, attributes: dict):
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.duration_ns = 0
+        self.attributes = attributes
+        self.error: str | None = None
+
+
+class Trace:
+    """The spans of one request. The root span is the request itself."""
+
+    def __init__(self, trace_id: str | None = None, parent_id: str | None = None):
+        self.trace_id = trace_id or f"{random.getrandbits(128):032x}"
+        self.root = Span("request", parent_id, {})
+        self.spans: list[Span] = []
+
+    def server_timing(self, total_ms: float) -> str:
+        """`Server-Timing` value; repeated spans (e.g. retried LLM calls) are summed."""
+        totals: dict[str, float] = {}
+        for span in self.spans:
+            totals[span.name] = totals.get(span.name, 0) + span.duration_ns / 1e6
+        parts = [f"{name};dur={ms:.2f}" for name, ms in totals.items()]
+        parts.append(f"total;dur={total_ms:.2f}")
+        return ", ".join(parts)
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+_current_span_id: ContextVar[str | None] = ContextVar("current_span_id", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time a phase of the current request. Nests, and does nothing outside a
+    traced request. Names end up in the Server-Timing header, so keep them
+    to letters, digits and underscores.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    current = Span(name, _current_span_id.get(), attributes)
+    token = _current_span_id.set(current.span_id)
+    started = time.perf_counter_ns()
+    try:
+        yield
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.duration_ns = time.perf_counter_ns() - started
+        _current_span_id.reset(token)
+        trace.spans.append(current)
+
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _otlp_span(trace: Trace, span: Span) -> dict:
+    data = {
+        "traceId": trace.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 2 if span is trace.root else 1,  # SERVER / INTERNAL
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.start_ns + span.duration_ns),
+        "attributes": [_attribute(k, v) for k, v in span.attributes.items()],
+        "status": {"code": 2, "message": span.error} if span.error else {},
+    }
+    if span.parent_id:
+        data["parentSpanId"] = span.parent_id
+    return data
+
+
+async def _post_traces(url: str, body: dict):
+    # a plain function, so build.py can defer importing httpx into it
+    import httpx
+    async with httpx.AsyncClient(timeout=5.0) as client:
+        resp = await client.post(url, json=body)
+        resp.raise_for_status()
+
+
+class TraceExporter:
+    """
+    Buffers finished traces and writes them out in batches, off the request
+    path, as OTLP/JSON. Flushed every `interval` seconds by `run()` (started
+    from the lifespan), when the buffer fills up, and on shutdown.
+    """
+
+    def __init__(self, file: str | None, url: str | None, interval: float, batch_size: int = 512):
+        self.file = file
+        self.url = url
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending: list[Trace] = []
+        self._flushing: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.file or self.url)
+
+    def add(self, trace: Trace):
+        self._pending.append(trace)
+        if len(self._pending) >= self.batch_size and (
+            self._flushing is None or self._flushing.done()
+        ):
+            self._flushing = asyncio.create_task(self.flush())
+
+    def _request_body(self, traces: list[Trace]) -> dict:
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [_attribute("service.name", TRACE_SERVICE_NAME)]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "src.tracing"},
+                            "spans": [
+                                _otlp_span(trace, span)
+                                for trace in traces
+                                for span in (trace.root, *trace.spans)
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def _append_to_file(self, line: str):
+        with open(self.file, "a") as f:
+            f.write(line + "\n")
+
+    async def flush(self):
+        traces, self._pending = self._pending, []
+        if not traces:
+            return
+        body = self._request_body(traces)
+        try:
+            if self.file:
+                await asyncio.to_thread(self._append_to_file, json.dumps(body))
+            if self.url:
+                await _post_traces(self.url, body)
+        except Exception as e:
+            print(f"Failed to export {len(traces)} traces: {e}")
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+
+trace_exporter = TraceExporter(TRACE_EXPORT_FILE, TRACE_EXPORT_URL, TRACE_EXPORT_INTERVAL)
+
+
+class TracingMiddleware:
+    """
+    Starts a trace per HTTP request, adds a `Server-Timing` header with the
+    spans finished before the response started, and hands sampled traces to
+    the exporter. Joins the caller's trace when a W3C `traceparent` header
+    is sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace_id = parent_id = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                match = _TRACEPARENT_RE.match(value.decode("latin-1"))
+                if match:
+                    trace_id, parent_id = match.groups()
+                break
+        trace = Trace(trace_id, parent_id)
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span_id.set(trace.root.span_id)
+        started = time.perf_counter_ns()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING_ENABLED:
+                    total_ms = (time.perf_counter_ns() - started) / 1e6
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"server-timing", trace.server_timing(total_ms).encode("latin-1")),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_span_id.reset(span_token)
+            _current_trace.reset(trace_token)
+            trace.root.duration_ns = time.perf_counter_ns() - started
+            if trace_exporter.enabled and random.random() < TRACE_SAMPLE_RATE:
+                trace.root.name = f"{scope['method']} {route_template(scope)}"
+                trace.root.attributes = {
+                    "http.request.method": scope["method"],
+                    "http.route": route_template(scope),
+                    "http.response.status_code": status,
+                }
+                if status >= 500:
+                    trace.root.error = str(status)
+                trace_exporter.add(trace)
+
+
+
+# ===== From profiler.py =====
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "1") == "1"
+
+
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.25"))
+
+
+LOOP_BLOCK_THRESHOLD_MS = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "250"))
+
+
+PROFILE_MAX_SECONDS = 60
+
+
+metrics.histogram(
+    "event_loop_lag_seconds",
+    "How late the loop monitor's periodic wakeups run.",
+    LATENCY_BUCKETS,
+)
+
+
+metrics.counter(
+    "event_loop_blocked_total",
+    "Times a callback kept the event loop busy past LOOP_BLOCK_THRESHOLD_MS.",
+)
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+def check_admin_token(request) -> dict | None:
+    """The error to answer with, or None when the request carries the admin token."""
+    if not ADMIN_TOKEN:
+        return {"error": "NOT_FOUND", "message": "The requested URL was not found"}
+    supplied = request.headers.get("x-admin-token", "")
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        supplied = authorization[7:]
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        return {"error": "UNAUTHORIZED", "message": "A valid admin token is required"}
+    return None
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag by sleeping `interval` seconds in a loop and
+    checking how late it wakes up. A watchdog thread notices when the loop
+    hasn't woken up for longer than `block_threshold_ms` and prints what the
+    loop thread is running at that moment, which is the blocking callback
+    (a sync HTTP call, a big BeautifulSoup parse, ...).
+    """
+
+    def __init__(self, interval: float, block_threshold_ms: float):
+        self.interval = interval
+        self.block_threshold = block_threshold_ms / 1000
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.blocked = 0
+        self._heartbeat = time.monotonic()
+        self._loop_thread: int | None = None
+        self._stop = threading.Event()
+
+    def stats(self) -> dict:
+        return {
+            "lag_ms": round(self.last_lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "blocked": self.blocked,
+            "block_threshold_ms": self.block_threshold * 1000,
+        }
+
+    def _watch(self):
+        reported = False
+        while not self._stop.wait(self.block_threshold / 4):
+            blocked_for = time.monotonic() - self._heartbeat - self.interval
+            if blocked_for <= self.block_threshold:
+                reported = False
+                continue
+            if reported:
+                continue  # one report per stall
+            reported = True
+            self.blocked += 1
+            metrics.inc("event_loop_blocked_total")
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)\n"
+            print(f"Event loop blocked for over {blocked_for * 1000:.0f} ms, loop thread is at:\n{stack}")
+
+    async def run(self):
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        watchdog.start()
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self._heartbeat = now
+                self.last_lag = max(0.0, now - expected)
+                self.max_lag = max(self.max_lag, self.last_lag)
+                metrics.observe("event_loop_lag_seconds", self.last_lag)
+        finally:
+            self._stop.set()
+
+
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD_MS)
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Samples thread stacks from a helper thread with sys._current_frames(),
+    so the profiled code runs unmodified; the cost is one stack walk per
+    sample. Output is the collapsed-stack format flamegraph.pl and
+    speedscope read: "outer;inner;leaf count" per line.
+    """
+
+    def __init__(self):
+        self._running = False
+        self._labels: dict = {}
+
+    def _collapse(self, frame) -> str:
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = _frame_label(code).replace(";", ":")
+            labels.append(label)
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    def _sample(self, target: int | None, seconds: float, interval: float) -> Counter:
+        stacks: Counter = Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != me and (target is None or thread_id == target):
+                    stacks[self._collapse(frame)] += 1
+            time.sleep(interval)
+        return stacks
+
+    async def profile(self, seconds: float, interval_ms: float, all_threads: bool = False) -> str:
+        if self._running:
+            raise ProfilerBusyError("A profile is already running")
+        self._running = True
+        try:
+            target = None if all_threads else threading.get_ident()  # the loop thread
+            stacks = await asyncio.to_thread(
+                self._sample, target, min(seconds, PROFILE_MAX_SECONDS), interval_ms / 1000
+            )
+        finally:
+            self._running = False
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+profiler = SamplingProfiler()
+
+
+class MemoryTracker:
+    """tracemalloc on demand; every snapshot is compared with the previous one."""
+
+    def __init__(self):
+        self._previous: tracemalloc.Snapshot | None = None
+
+    def start(self, frames: int = 10) -> dict:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._previous = None
+        return self.status()
+
+    def stop(self) -> dict:
+        tracemalloc.stop()
+        self._previous = None
+        return self.status()
+
+    def status(self) -> dict:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {
+            "tracing": tracing,
+            "traced_kb": round(current / 1024, 1),
+            "peak_kb": round(peak / 1024, 1),
+        }
+
+    def snapshot(self, top: int = 25, group_by: str = "lineno") -> dict:
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ]
+        )
+        result = self.status()
+        result["top"] = [
+            {
+                "location": str(stat.traceback),
+                "size_kb": round(stat.size / 1024, 1),
+                "count": stat.count,
+            }
+            for stat in snapshot.statistics(group_by)[:top]
+        ]
+        if self._previous is not None:
+            result["growth"] = [
+                {
+                    "location": str(stat.traceback),
+                    "size_diff_kb": round(stat.size_diff / 1024, 1),
+                    "count_diff": stat.count_diff,
+                }
+                for stat in snapshot.compare_to(self._previous, group_by)[:top]
+            ]
+        self._previous = snapshot
+        return result
+
+
+memory_tracker = MemoryTracker()
+
+
+
+# ===== From cache.py =====
+NEGATIVE_CACHE_TTL = float(os.getenv("NEGATIVE_CACHE_TTL", "0"))
+
+
+NEGATIVE_CACHE_SIZE = int(os.getenv("NEGATIVE_CACHE_SIZE", "10000"))
+
+
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", "100000"))
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel: keys are filed under the tick they expire in, in
+    `slots` buckets (tick % slots), so scheduling, cancelling and expiring a
+    key are O(1) and `advance` only visits the buckets of the ticks that
+    passed. Keys due more than a full turn ahead stay in their bucket until
+    their turn comes round. Times are in whatever clock the caller uses.
+    """
+
+    def __init__(self, tick: float, slots: int, now: float):
+        self.tick = tick
+        self._buckets: list[set] = [set() for _ in range(slots)]
+        self._due: dict = {}
+        self._current = int(now / tick)
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def schedule(self, key, at: float):
+        self.cancel(key)
+        # rounded up, so a key never comes out before its time
+        due = max(math.ceil(at / self.tick), self._current + 1)
+        self._due[key] = due
+        self._buckets[due % len(self._buckets)].add(key)
+
+    def cancel(self, key):
+        due = self._due.pop(key, None)
+        if due is not None:
+            self._buckets[due % len(self._buckets)].discard(key)
+
+    def advance(self, now: float) -> list:
+        """Remove and return the keys due by `now`."""
+        target = int(now / self.tick)
+        if target <= self._current:
+            return []
+        expired = []
+        slots = len(self._buckets)
+        ticks = range(self._current + 1, target + 1)
+        if len(ticks) > slots:
+            ticks = range(target - slots + 1, target + 1)  # every bucket once
+        for tick in ticks:
+            bucket = self._buckets[tick % slots]
+            for key in [key for key in bucket if self._due[key] <= target]:
+                bucket.discard(key)
+                del self._due[key]
+                expired.append(key)
+        self._current = target
+        return expired
+
+
+class NegativeCache:
+    """
+    Bounded TTL set of short ids that were recently looked up and not found,
+    so repeated misses (scanners, typos) can be answered without a query.
+
+    Usage:
+
+        token = cache.token()
+        ... look the id up ...
+        if not found:
+            cache.add(short_id, token)
+
+    `discard` is called when an id gets taken. The token makes sure a lookup
+    that started before the discard cannot put the id back afterwards.
+    Entries are evicted when they expire by a timing wheel, instead of
+    lingering until they are looked up again or pushed out by newer ones.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expires: OrderedDict[str, float] = OrderedDict()
+        self._wheel = TimingWheel(max(ttl / 32, 0.05), 64, time.monotonic())
+        self._seq = 0
+        self._discarded: OrderedDict[str, int] = OrderedDict()
+
+    def _evict_expired(self, now: float):
+        for key in self._wheel.advance(now):
+            self._expires.pop(key, None)
+
+    def __contains__(self, key: str) -> bool:
+        now = time.monotonic()
+        self._evict_expired(now)
+        expires = self._expires.get(key)
+        # the wheel works in ticks, so check the exact time too
+        return expires is not None and expires >= now
+
+    def __len__(self) -> int:
+        return len(self._expires)
+
+    def token(self) -> int:
+        return self._seq
+
+    def add(self, key: str, token: int):
+        if self.ttl <= 0:
+            return  # disabled
+        if self._discarded.get(key, -1) >= token:
+            return  # taken while we were looking it up
+        now = time.monotonic()
+        self._evict_expired(now)
+        self._expires[key] = now + self.ttl
+        self._expires.move_to_end(key)
+        self._wheel.schedule(key, now + self.ttl)
+        while len(self._expires) > self.max_size:
+            self._wheel.cancel(self._expires.popitem(last=False)[0])
+
+    def discard(self, key: str):
+        self._expires.pop(key, None)
+        self._wheel.cancel(key)
+        self._discarded[key] = self._seq
+        self._discarded.move_to_end(key)
+        self._seq += 1
+        while len(self._discarded) > self.max_size:
+            self._discarded.popitem(last=False)
+
+
+class LinkCache:
+    """
+    Bounded LRU of link id -> long URL for links that were recently
+    followed. Links don't change, so an entry stays right until the link
+    expires; `expires_at` (unix seconds) entries are evicted then by a
+    timing wheel. Links limited by max_clicks must not be put here.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._links: OrderedDict[str, tuple[str, float | None]] = OrderedDict()
+        self._wheel = TimingWheel(1.0, 3600, time.time())
+
+    def __len__(self) -> int:
+        return len(self._links)
+
+    def get(self, link_id: str) -> str | None:
+        now = time.time()
+        for key in self._wheel.advance(now):
+            self._links.pop(key, None)
+        entry = self._links.get(link_id)
+        if entry is None or (entry[1] is not None and entry[1] <= now):
+            return None
+        self._links.move_to_end(link_id)
+        return entry[0]
+
+    def put(self, link_id: str, long_url: str, expires_at: float | None = None):
+        self._links[link_id] = (long_url, expires_at)
+        self._links.move_to_end(link_id)
+        if expires_at is not None:
+            self._wheel.schedule(link_id, expires_at)
+        else:
+            self._wheel.cancel(link_id)
+        while len(self._links) > self.max_size:
+            self._wheel.cancel(self._links.popitem(last=False)[0])
+
+
+missing_link_ids = NegativeCache(NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_SIZE)
+
+
+metrics.gauge(
+    "negative_cache_entries",
+    "Short ids currently cached as not found.",
+    lambda: len(missing_link_ids),
+)
+
+
+
+# ===== From breaker.py =====
+DB_BREAKER_ENABLED = os.getenv("DB_BREAKER_ENABLED", "1") == "1"
+
+
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "5"))
+
+
+DB_BREAKER_RESET_TIMEOUT = float(os.getenv("DB_BREAKER_RESET_TIMEOUT", "10"))
+
+
+DB_CALL_TIMEOUT = float(os.getenv("DB_CALL_TIMEOUT", "5"))
+
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+metrics.counter(
+    "db_breaker_transitions_total", "Database circuit breaker state changes, by new state."
+)
+
+
+class DatabaseUnavailableError(Exception):
+    """Raised instead of calling the database while the breaker is open, or when a call failed."""
+
+
+def is_database_error(e: BaseException) -> bool:
+    """Errors that say the database is unreachable or too slow, as opposed to a bad request."""
+    return isinstance(
+        e, (OperationalError, InterfaceError, PoolTimeoutError, TimeoutError, OSError)
+    )
+
+
+class CircuitBreaker:
+    """
+    closed: calls go through, and `failures` consecutive database errors open it.
+    open: calls are refused for `reset_timeout` seconds.
+    half_open: one call goes through as a probe; success closes the
+    breaker, failure opens it again.
+    """
+
+    def __init__(self, failures: int, reset_timeout: float):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failed = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            metrics.inc("db_breaker_transitions_total", state=state)
+            print(f"Database circuit breaker {state}")
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._set_state("half_open")
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self._failed = 0
+        self._probing = False
+        self._set_state("closed")
+
+    def abandon(self):
+        """The call was cancelled before it told us anything."""
+        self._probing = False
+
+    def record_failure(self):
+        self._failed += 1
+        self._probing = False
+        if self.state == "half_open" or self._failed >= self.failures:
+            self._opened_at = time.monotonic()
+            self._set_state("open")
+
+
+
+# ===== From utils.py =====
+T = TypeVar("T")
+
+
+_genai_client: "GenAIClient | None" = None
+
+
+async def get_genai_client() -> "GenAIClient":
+    from google.genai import Client as GenAIClient
+    global _genai_client
+    if _genai_client is None:
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            raise EnvironmentError("GOOGLE_API_KEY not found in environment variables")
+        # GOOGLE_GENAI_BASE_URL lets us point the client at a local fake model
+        # server (see scripts/fake_genai_server.py) instead of Gemini.
+        base_url = os.getenv("GOOGLE_GENAI_BASE_URL")
+        _genai_client = GenAIClient(
+            api_key=api_key,
+            http_options={"base_url": base_url} if base_url else None,
+        )
+    return _genai_client
+
+
+async def close_genai_client():
+    global _genai_client
+    if _genai_client is not None:
+        await _genai_client.aio.aclose()
+        _genai_client = None
+
+
+class LLMBusyError(Exception):
+    """Raised when an LLM call cannot get a slot within the queue limits."""
+
+
+def _is_retryable(exc: Exception) -> bool:
+    from google.genai import errors as genai_errors
+    import httpx
+    if isinstance(exc, genai_errors.ServerError):
+        return True
+    if isinstance(exc, genai_errors.ClientError):
+        return exc.code == 429  # rate limited by the provider
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class LLMLimiter:
+    """
+    Bounds the number of in-flight LLM calls.
+
+    At most `max_concurrency` calls run at once, at most `max_waiting` callers
+    wait for a slot, and a waiter gives up after `wait_timeout` seconds.
+    Retryable failures (5xx, 429, transport errors) are retried with
+    full-jitter exponential backoff while still holding the slot.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_waiting: int,
+        wait_timeout: float,
+        max_retries: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one concurrency slot, e.g. for the lifetime of a streamed call."""
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()  # free slot, does not suspend
+        elif self._waiting >= self.max_waiting:
+            raise LLMBusyError("Too many pending AI requests, try again later")
+        else:
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                raise LLMBusyError("Timed out waiting for an AI request slot")
+            finally:
+                self._waiting -= 1
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    def should_retry(self, exc: Exception, attempt: int) -> bool:
+        return attempt < self.max_retries and _is_retryable(exc)
+
+    async def backoff(self, attempt: int):
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        await asyncio.sleep(random.uniform(0, delay))
+
+    async def run(self, call: Callable[[], Awaitable[T]]) -> T:
+        async with self.slot():
+            attempt = 0
+            while True:
+                try:
+                    return await call()
+                except Exception as e:
+                    if not self.should_retry(e, attempt):
+                        raise
+                    await self.backoff(attempt)
+                    attempt += 1
+
+
+llm_limiter = LLMLimiter(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+    max_waiting=int(os.getenv("LLM_MAX_WAITING", "16")),
+    wait_timeout=float(os.getenv("LLM_WAIT_TIMEOUT", "10")),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+    base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5")),
+)
+
+
+metrics.gauge(
+    "llm_waiting_requests",
+    "Callers waiting for an LLM concurrency slot.",
+    lambda: llm_limiter.waiting,
+)
+
+
+PROMPT = """
+You are a helpful assistant that generates concise and relevant names for URLs based on their content. Given a URL, provide a short, descriptive name that captures the essence of the webpage.
+For example, for the URL "https://www.example.com/articles/how-to-learn-python", a suitable name could be "learn-python", "learn-python-tutorial", or "python-basics". Include the reference from the webpage to ensure relevance.
+Provide {needed} suggestive names for the following URL: {url}
+Ensure that the names are unique, easy to remember, and do not contain special characters or spaces.
+Keep the text length of each name under 15 characters.
+The names must be URL-friendly (only alphanumeric characters and hyphens).
+
+The contents of the page linked by the URL is provided below for your reference.
+{text}
+"""
+
+
+
+# ===== From models.py =====
+class LinkClickLog(Base):
+    __tablename__ = "link_click_log"
+    __table_args__ = (
+        # the sweeper deletes by link_id; a link's clicks come out in time order
+        Index("ix_link_click_log_link_id_timestamp", "link_id", "timestamp"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    link_id: Mapped[str] = mapped_column(ForeignKey("links.id"))
+    click_ip: Mapped[Optional[str]] = mapped_column(String)
+    timestamp: Mapped[Optional[datetime]] = mapped_column(DateTime)
+    user_agent: Mapped[Optional[str]] = mapped_column(String)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+
+    link: Mapped["Link"] = relationship("Link", back_populates="logs")
+
+
+class LinkClickShard(Base):
+    __tablename__ = "link_click_shards"
+
+    link_id: Mapped[str] = mapped_column(ForeignKey("links.id"), primary_key=True)
+    shard: Mapped[int] = mapped_column(Integer, primary_key=True)
+    clicks: Mapped[int] = mapped_column(Integer, default=0)
+    last_ip: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class Link(Base):
+    __tablename__ = "links"
+    __table_args__ = (
+        # only expiring links are indexed; the sweeper reads it in expiry order
+        Index(
+            "ix_links_expires_at",
+            "expires_at",
+            postgresql_where=text("expires_at IS NOT NULL"),
+            sqlite_where=text("expires_at IS NOT NULL"),
+        ),
+    )
+
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    long_url: Mapped[str] = mapped_column(String)
+    # what used to be link_metadata, so a redirect or a metadata lookup
+    # reads one row
+    name: Mapped[str] = mapped_column(String, default="", server_default="")
+    clicks: Mapped[int] = mapped_column(Integer, default=0, server_default="0")
+    last_ip: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    # naive UTC; NULL for links that never expire
+    expires_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    max_clicks: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+    updated_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    logs: Mapped[list["LinkClickLog"]] = relationship("LinkClickLog", back_populates="link")
+
+
+
+# ===== From counters.py =====
+CLICK_COUNTER_SHARDS = int(os.getenv("CLICK_COUNTER_SHARDS", "1"))
+
+
+CLICK_SHARD_COMPACT_INTERVAL = float(os.getenv("CLICK_SHARD_COMPACT_INTERVAL", "30"))
+
+
+CLICK_SHARD_COMPACT_BATCH = int(os.getenv("CLICK_SHARD_COMPACT_BATCH", "5000"))
+
+
+metrics.counter("click_shards_compacted_total", "Counter shard rows folded into links.clicks.")
+
+
+def shard_increment(dialect: str):
+    """
+    Upsert adding one click to shard `b_shard` of link `b_link_id`, with
+    `b_ip` as its last_ip. Callers pick a random shard per click, so two
+    clicks only wait on each other when they pick the same one.
+    """
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    statement = insert(LinkClickShard).values(
+        link_id=bindparam("b_link_id"),
+        shard=bindparam("b_shard"),
+        clicks=1,
+        last_ip=bindparam("b_ip", type_=String),
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[LinkClickShard.link_id, LinkClickShard.shard],
+        set_={
+            # inline, not a bind parameter: the conflict clause doesn't render
+            # literal binds, which benchmarks.scenarios needs to EXPLAIN it
+            "clicks": LinkClickShard.clicks + literal_column("1"),
+            "last_ip": statement.excluded.last_ip,
+            "updated_at": func.now(),
+        },
+    )
+
+
+def sharded_clicks(link_id_column):
+    """Scalar subqueries for the unfolded clicks and the latest last_ip of a link."""
+    clicks = (
+        select(func.coalesce(func.sum(LinkClickShard.clicks), 0))
+        .where(LinkClickShard.link_id == link_id_column)
+        .scalar_subquery()
+    )
+    last_ip = (
+        select(LinkClickShard.last_ip)
+        .where(LinkClickShard.link_id == link_id_column)
+        .order_by(LinkClickShard.updated_at.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    return clicks, last_ip
+
+
+async def compact_click_shards(engine: AsyncEngine, batch: int = CLICK_SHARD_COMPACT_BATCH) -> int:
+    """
+    Move up to `batch` shard rows into links.clicks (and last_ip)
+    and return how many. The shards are deleted and read back by the same
+    statement, so a click racing with it lands either in the fold or in a
+    new shard row, never in neither.
+    """
+    async with engine.connect() as conn:
+        # SKIP LOCKED: shards a redirect is incrementing right now wait for the next run
+        keys = (
+            select(LinkClickShard.link_id, LinkClickShard.shard)
+            .limit(batch)
+            .with_for_update(skip_locked=True)
+        )
+        rows = (
+            await conn.execute(
+                LinkClickShard.__table__.delete()
+                .where(tuple_(LinkClickShard.link_id, LinkClickShard.shard).in_(keys))
+                .returning(
+                    LinkClickShard.link_id,
+                    LinkClickShard.clicks,
+                    LinkClickShard.last_ip,
+                    LinkClickShard.updated_at,
+                )
+            )
+        ).all()
+        if not rows:
+            return 0
+        folded: dict[str, list] = {}
+        for link_id, clicks, last_ip, updated_at in rows:
+            entry = folded.setdefault(link_id, [0, last_ip, updated_at])
+            entry[0] += clicks
+            if updated_at >= entry[2]:
+                entry[1], entry[2] = last_ip, updated_at
+        await conn.execute(
+            update(Link)
+            .where(Link.id == bindparam("b_link_id"))
+            .values(
+                clicks=Link.clicks + bindparam("b_clicks"),
+                last_ip=func.coalesce(bindparam("b_last_ip", type_=String), Link.last_ip),
+            ),
+            [
+                {"b_link_id": link_id, "b_clicks": clicks, "b_last_ip": last_ip}
+                for link_id, (clicks, last_ip, _) in folded.items()
+            ],
+        )
+        await conn.commit()
+    metrics.inc("click_shards_compacted_total", len(rows))
+    return len(rows)
+
+
+async def keep_compacting(
+    engine: AsyncEngine,
+    interval: float = CLICK_SHARD_COMPACT_INTERVAL,
+    batch: int = CLICK_SHARD_COMPACT_BATCH,
+):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            while await compact_click_shards(engine, batch) >= batch:
+                await asyncio.sleep(0)  # let requests in between batches
+        except Exception as e:
+            print(f"Failed to compact click counter shards: {e}")
+
+
+
+# ===== From clicks.py =====
+CLICK_BUFFER_ENABLED = os.getenv("CLICK_BUFFER_ENABLED", "0") == "1"
+
+
+CLICK_BUFFER_SIZE = int(os.getenv("CLICK_BUFFER_SIZE", "1000"))
+
+
+CLICK_BUFFER_INTERVAL = float(os.getenv("CLICK_BUFFER_INTERVAL", "1"))
+
+
+CLICK_BUFFER_MAX = int(os.getenv("CLICK_BUFFER_MAX", "100000"))
+
+
+CLICK_COLUMNS = ("link_id", "click_ip", "timestamp", "user_agent")
+
+
+metrics.counter("click_rows_written_total", "Click log rows written in bulk, by method.")
+
+
+metrics.counter("click_rows_dropped_total", "Buffered clicks dropped, by reason.")
+
+
+metrics.histogram("click_flush_seconds", "Time to write one batch of click log rows.")
+
+
+async def insert_click_rows(conn: AsyncConnection, rows: list[tuple]) -> str:
+    """
+    Write (link_id, click_ip, timestamp, user_agent) records to
+    link_click_log on `conn` and return the method used. On asyncpg that is
+    a binary COPY (copy_records_to_table), which skips statement parsing and
+    per-row parameters; everything else gets one executemany INSERT. The
+    caller commits.
+    """
+    if conn.dialect.driver == "asyncpg":
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            LinkClickLog.__tablename__, records=rows, columns=CLICK_COLUMNS
+        )
+        method = "copy"
+    else:
+        await conn.execute(insert(LinkClickLog), [dict(zip(CLICK_COLUMNS, row)) for row in rows])
+        method = "executemany"
+    metrics.inc("click_rows_written_total", len(rows), method=method)
+    return method
+
+
+class ClickBuffer:
+    """
+    Click log rows waiting to be written. `add` only appends to a list; `run`
+    writes them with insert_click_rows in one transaction per batch, every
+    `interval` seconds or as soon as `size` are waiting. A failed batch is
+    kept for the next flush (up to `max_pending` clicks in total), and a
+    final flush happens when `run` is cancelled.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        size: int = CLICK_BUFFER_SIZE,
+        interval: float = CLICK_BUFFER_INTERVAL,
+        max_pending: int = CLICK_BUFFER_MAX,
+    ):
+        self.engine = engine
+        self.size = size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: list[tuple] = []
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, link_id: str, ip: str | None, timestamp, user_agent: str | None):
+        self._pending.append((link_id, ip, timestamp, user_agent))
+        if len(self._pending) >= self.size:
+            self._full.set()
+
+    def _keep(self, rows: list[tuple]):
+        self._pending[:0] = rows
+        overflow = len(self._pending) - self.max_pending
+        if overflow > 0:
+            del self._pending[:overflow]
+            metrics.inc("click_rows_dropped_total", overflow, reason="overflow")
+
+    async def _write(self, rows: list[tuple]) -> int:
+        async with self.engine.connect() as conn:
+            await insert_click_rows(conn, rows)
+            await conn.commit()
+        return len(rows)
+
+    async def _write_existing(self, rows: list[tuple]) -> int:
+        """Write the rows whose link still exists; returns how many that was."""
+        # a link can be reaped (see src/expiry.py) while its clicks wait here
+        link_ids = list({row[0] for row in rows})
+        async with self.engine.connect() as conn:
+            existing = set(
+                (await conn.execute(select(Link.id).where(Link.id.in_(link_ids)))).scalars()
+            )
+        kept = [row for row in rows if row[0] in existing]
+        if len(kept) < len(rows):
+            metrics.inc("click_rows_dropped_total", len(rows) - len(kept), reason="deleted_link")
+        if not kept:
+            return 0
+        return await self._write(kept)
+
+    async def flush(self) -> int:
+        """Write everything pending; returns the number of rows written."""
+        async with self._flush_lock:
+            written = 0
+            while self._pending:
+                rows, self._pending = self._pending[: self.size], self._pending[self.size :]
+                if len(self._pending) < self.size:
+                    self._full.clear()
+                start = time.perf_counter()
+                try:
+                    try:
+                        written += await self._write(rows)
+                    except Exception:
+                        written += await self._write_existing(rows)
+                except Exception:
+                    self._keep(rows)
+                    raise
+                finally:
+                    metrics.observe("click_flush_seconds", time.perf_counter() - start)
+            return written
+
+    async def run(self):
+        self._full = asyncio.Event()  # bound to the running loop
+        if len(self._pending) >= self.size:
+            self._full.set()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                try:
+                    await self.flush()
+                except Exception as e:
+                    print(f"Failed to flush {len(self._pending)} buffered clicks: {e}")
+                    await asyncio.sleep(self.interval)
+        finally:
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Failed to flush {len(self._pending)} buffered clicks on shutdown: {e}")
+
+
+
+# ===== From spool.py =====
+CLICK_SPOOL_DIR = os.getenv("CLICK_SPOOL_DIR")
+
+
+CLICK_SPOOL_FSYNC_INTERVAL = float(os.getenv("CLICK_SPOOL_FSYNC_INTERVAL", "0.5"))
+
+
+CLICK_SPOOL_REPLAY_INTERVAL = float(os.getenv("CLICK_SPOOL_REPLAY_INTERVAL", "5"))
+
+
+CLICK_SPOOL_REPLAY_BATCH = int(os.getenv("CLICK_SPOOL_REPLAY_BATCH", "5000"))
+
+
+_SPOOL_RECORD = struct.Struct("<II")
+
+
+metrics.counter("click_spool_appended_total", "Clicks appended to the click spool.")
+
+
+metrics.counter("click_spool_replayed_total", "Spooled clicks written to the database.")
+
+
+metrics.counter("click_spool_dropped_total", "Spooled clicks not replayed, by reason.")
+
+
+class ClickSpool:
+    """
+    Append-only click log on local disk, in numbered segment files of
+    length-prefixed, CRC-checked JSON records. `append` writes into the
+    file's buffer and returns; `run` flushes and fsyncs every
+    `fsync_interval` seconds, so a crash loses at most that much, and a
+    torn last record is detected and skipped on reading.
+
+    Several processes can share the directory: each names its segments
+    after a random instance id and holds an exclusive lock on the one it
+    appends to. `rotate` closes the active segment; every other segment
+    whose lock can be taken (closed, or left by a process that is gone) is
+    what the replayer drains, deleting each one once it is in the database.
+    """
+
+    def __init__(self, directory: str, fsync_interval: float = CLICK_SPOOL_FSYNC_INTERVAL):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        self.instance = secrets.token_hex(4)
+        self._seq = 0
+        self._file = None
+        self._records = 0
+        self._unsynced = False
+        # rotate and the fsync in run never touch the file at the same time
+        self._sync_lock = asyncio.Lock()
+        self._open_next()
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{self.instance}-{seq:012d}.spool")
+
+    def _open_next(self):
+        self._seq += 1
+        self._file = open(self._segment_path(self._seq), "ab")
+        # held until the segment is closed; replayers skip locked segments
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._records = 0
+
+    def closed_segments(self) -> list[str]:
+        """
+        Segment files other than the one being appended to, oldest first.
+        Other processes' active segments are listed too; claim_segment
+        tells them apart.
+        """
+        active = self._segment_path(self._seq)
+        return sorted(
+            (
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(".spool") and os.path.join(self.directory, name) != active
+            ),
+            key=_modified_at,
+        )
+
+    def backlog_bytes(self) -> int:
+        total = self._file.tell()
+        for path in self.closed_segments():
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass  # replayed in the meantime
+        return total
+
+    def append(self, link_id: str, ip: str | None, timestamp: datetime, user_agent: str | None):
+        payload = json.dumps(
+            [link_id, ip, timestamp.isoformat(), user_agent], separators=(",", ":")
+        ).encode()
+        self._file.write(_SPOOL_RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._records += 1
+        self._unsynced = True
+        metrics.inc("click_spool_appended_total")
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = False
+
+    @staticmethod
+    def _sync_and_close(file):
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()  # releases the lock
+
+    async def rotate(self) -> bool:
+        """Close the active segment if it has records; True when it did."""
+        if not self._records:
+            return False
+        async with self._sync_lock:
+            closing = self._file
+            self._open_next()
+            self._unsynced = False
+            # the fsync waits for the disk; keep it off the loop
+            await asyncio.to_thread(self._sync_and_close, closing)
+        return True
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.fsync_interval)
+                if not self._unsynced:
+                    continue
+                async with self._sync_lock:
+                    self._unsynced = False
+                    try:
+                        self._file.flush()
+                        await asyncio.to_thread(os.fsync, self._file.fileno())
+                    except OSError as e:
+                        self._unsynced = True
+                        print(f"Failed to fsync the click spool, retrying: {e}")
+        finally:
+            self.sync()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+def _modified_at(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0.0
+
+
+def claim_segment(path: str):
+    """
+    The segment opened and locked for replaying, or None when its writer
+    still appends to it, another replayer has it, or it is gone already.
+    """
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # replayed and deleted between our open and our lock
+        if os.stat(path).st_ino != os.fstat(file.fileno()).st_ino:
+            raise FileNotFoundError(path)
+    except (BlockingIOError, FileNotFoundError):
+        file.close()
+        return None
+    return file
+
+
+def read_spool_segment(file) -> Iterator[tuple]:
+    """(link_id, ip, timestamp, user_agent) records of a segment, up to a torn or corrupt one."""
+    data = file.read()
+    position = 0
+    while position + _SPOOL_RECORD.size <= len(data):
+        length, crc = _SPOOL_RECORD.unpack_from(data, position)
+        start = position + _SPOOL_RECORD.size
+        payload = data[start : start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            print(f"Skipping the torn end of click spool segment {file.name} at byte {position}")
+            break
+        link_id, ip, timestamp, user_agent = json.loads(payload)
+        yield link_id, ip, datetime.fromisoformat(timestamp), user_agent
+        position = start + length
+
+
+async def _replay_batch(conn: AsyncConnection, rows: list[tuple]) -> int:
+    """Write a batch of clicks, the log rows plus the per-link counters; returns how many."""
+    link_ids = list({row[0] for row in rows})
+    # links reaped by the expiry sweeper since the click was spooled
+    existing = set(
+        (await conn.execute(select(Link.id).where(Link.id.in_(link_ids)))).scalars()
+    )
+    kept = [row for row in rows if row[0] in existing]
+    if len(kept) < len(rows):
+        metrics.inc("click_spool_dropped_total", len(rows) - len(kept), reason="deleted_link")
+    if not kept:
+        return 0
+    await insert_click_rows(conn, kept)
+    counters: dict[str, list] = {}
+    for link_id, ip, _, _ in kept:
+        counter = counters.setdefault(link_id, [0, None])
+        counter[0] += 1
+        counter[1] = ip
+    await conn.execute(
+        update(Link)
+        .where(Link.id == bindparam("b_link_id"))
+        .values(
+            clicks=Link.clicks + bindparam("b_clicks"),
+            last_ip=bindparam("b_last_ip"),
+        ),
+        [
+            {"b_link_id": link_id, "b_clicks": clicks, "b_last_ip": ip}
+            for link_id, (clicks, ip) in counters.items()
+        ],
+    )
+    return len(kept)
+
+
+async def replay_click_spool(
+    spool: ClickSpool, engine: AsyncEngine, batch: int = CLICK_SPOOL_REPLAY_BATCH
+) -> int:
+    """
+    Rotate the spool and write every closed segment to the database, one
+    transaction per segment and `batch` clicks per statement; returns the
+    number of clicks replayed. Stops at the first failure, leaving that
+    segment for the next call, so a failed segment is not counted twice.
+    """
+    await spool.rotate()
+    replayed = 0
+    for path in spool.closed_segments():
+        segment = claim_segment(path)
+        if segment is None:
+            continue
+        try:
+            rows = list(read_spool_segment(segment))
+            written = 0
+            async with engine.connect() as conn:
+                for offset in range(0, len(rows), batch):
+                    written += await _replay_batch(conn, rows[offset : offset + batch])
+                await conn.commit()
+            # still locked, so no other replayer can pick it up in between
+            os.remove(path)
+        finally:
+            segment.close()
+        metrics.inc("click_spool_replayed_total", written)
+        replayed += written
+    return replayed
+
+
+async def keep_replaying(
+    spool: ClickSpool,
+    engine: AsyncEngine,
+    interval: float = CLICK_SPOOL_REPLAY_INTERVAL,
+    batch: int = CLICK_SPOOL_REPLAY_BATCH,
+):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await replay_click_spool(spool, engine, batch)
+        except Exception as e:
+            # the database is down or slow; the clicks wait on disk
+            print(f"Failed to replay the click spool, {spool.backlog_bytes()} bytes waiting: {e}")
+
+
+
+# ===== From storage.py =====
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlalchemy")
+
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "shortener.db")
+
+
+MEMORY_CLICK_LOG_SIZE = int(os.getenv("MEMORY_CLICK_LOG_SIZE", "100000"))
+
+
+LINK_SNAPSHOT_PATH = os.getenv("LINK_SNAPSHOT_PATH")
+
+
+LINK_SNAPSHOT_REFRESH = float(os.getenv("LINK_SNAPSHOT_REFRESH", "60"))
+
+
+metrics.counter(
+    "link_snapshot_lookups_total",
+    "Redirect lookups answered by the link snapshot (hit) or passed on (miss).",
+)
+
+
+metrics.counter(
+    "degraded_redirects_total",
+    "Redirects while the database was unavailable, served stale (hit) or not (miss).",
+)
+
+
+class LinkExistsError(Exception):
+    """Raised by `create_link` when the id is already taken."""
+
+
+@dataclass
+class StoredLink:
+    id: str
+    long_url: str
+    name: str = ""
+    clicks: int = 0
+    last_ip: str | None = None
+    expires_at: datetime | None = None
+    max_clicks: int | None = None
+
+
+@dataclass
+class Click:
+    link_id: str
+    ip: str | None
+    user_agent: str | None
+    timestamp: datetime
+
+
+def utc_now() -> datetime:
+    """Naive UTC, the way expires_at is stored."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def link_expired(expires_at: datetime | None, max_clicks: int | None, clicks: int) -> bool:
+    return (expires_at is not None and expires_at <= utc_now()) or (
+        max_clicks is not None and clicks >= max_clicks
+    )
+
+
+class LinkStore(ABC):
+    """
+    What the endpoints need from storage. Every method is one unit of work:
+    it either commits or leaves nothing behind.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        """The link with its name and click count, or None (also when it expired)."""
+
+    @abstractmethod
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        """Insert a link; raises LinkExistsError when `link_id` is taken."""
+
+    @abstractmethod
+    async def record_click(self, click: Click) -> bool:
+        """Count a click and log it; False when the link doesn't exist."""
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        """
+        The link `click.link_id` points to (None when it doesn't exist or
+        has expired), with the click recorded. The redirect path: backends
+        override this to do the lookup and the write together, and to enforce
+        max_clicks atomically. Only the id, long_url and expiry fields of the
+        result are reliably filled in.
+        """
+        link = await self.get_link(click.link_id)
+        if link is None:
+            return None
+        await self.record_click(click)
+        return link
+
+    @abstractmethod
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        """The subset of `link_ids` already used."""
+
+    @abstractmethod
+    async def count_links(self) -> int:
+        ...
+
+    @abstractmethod
+    def iter_link_ids(self) -> AsyncIterator[str]:
+        ...
+
+    @abstractmethod
+    def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        """(id, long_url) of every link that never expires, for export_snapshot.py."""
+
+    @abstractmethod
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        """Delete up to `limit` links that expired by `now`, with their clicks."""
+
+    async def close(self):
+        pass
+
+
+def link_statements(dialect: str, counter_shards: int = 1) -> dict:
+    """
+    The SQLAlchemy store's statements, built once with bind parameters
+    instead of per call. A statement object memoizes its cache key, so
+    running it again goes straight to the compiled SQL (and, on asyncpg,
+    the connection's prepared statement) without building and hashing the
+    expression first.
+    """
+    link_columns = [Link.long_url, Link.name, Link.clicks, Link.last_ip]
+    if counter_shards > 1:
+        shard_clicks, shard_last_ip = sharded_clicks(Link.id)
+        link_columns += [shard_clicks.label("shard_clicks"), shard_last_ip.label("shard_last_ip")]
+    now = bindparam("b_now", type_=DateTime)
+    return {
+        "get_link": select(*link_columns, Link.expires_at, Link.max_clicks).where(
+            Link.id == bindparam("b_link_id")
+        ),
+        "lookup": select(Link.long_url, Link.expires_at, Link.max_clicks).where(
+            Link.id == bindparam("b_link_id")
+        ),
+        # counts a click unless the link has expired or is used up. The
+        # limit is checked by the statement that counts, so concurrent
+        # redirects can't go past it, and the last allowed click sets
+        # expires_at: from then on the sweeper owns the link
+        "count_click": update(Link)
+        .where(
+            Link.id == bindparam("b_link_id"),
+            or_(Link.expires_at.is_(None), Link.expires_at > now),
+            or_(Link.max_clicks.is_(None), Link.clicks < Link.max_clicks),
+        )
+        .values(
+            clicks=Link.clicks + 1,
+            last_ip=bindparam("b_ip", type_=String),
+            expires_at=case((Link.clicks + 1 >= Link.max_clicks, now), else_=Link.expires_at),
+        )
+        .returning(Link.long_url, Link.expires_at, Link.max_clicks),
+        "increment_shard": shard_increment(dialect),
+        "insert_link": insert(Link),
+        "insert_click": insert(LinkClickLog),
+        "taken_ids": select(Link.id).where(Link.id.in_(bindparam("b_link_ids", expanding=True))),
+    }
+
+
+class SQLAlchemyLinkStore(LinkStore):
+    """
+    The links and link_click_log tables through `src.db`, with Core
+    statements built once (see link_statements) on pooled connections. A
+    redirect is a single UPDATE of the link's row that checks expiry and
+    max_clicks, counts the click and returns long_url, plus the click log
+    insert. With a ClickBuffer the click log rows are left to it. With a
+    ClickSpool the whole click (count and log row) goes to the spool and a
+    redirect is a single read; links with max_clicks are still counted
+    inline, since the limit has to be checked by the statement that
+    counts. With `counter_shards` > 1 clicks are counted in
+    link_click_shards rows (see src/counters.py) instead of the link's row.
+    """
+
+    name = "sqlalchemy"
+
+    def __init__(
+        self,
+        click_buffer: ClickBuffer | None = None,
+        click_spool: ClickSpool | None = None,
+        counter_shards: int = 1,
+    ):
+        if async_engine is None:
+            raise EnvironmentError("DATABASE_URL not set in environment variables")
+        self.engine = async_engine
+        self.click_buffer = click_buffer
+        self.click_spool = click_spool
+        self.counter_shards = counter_shards
+        self.statements = link_statements(async_engine.dialect.name, counter_shards)
+
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        async with self.engine.connect() as conn:
+            with span("link_lookup"):
+                row = (
+                    await conn.execute(self.statements["get_link"], {"b_link_id": link_id})
+                ).one_or_none()
+        if row is None:
+            return None
+        clicks, last_ip = row.clicks, row.last_ip
+        if self.counter_shards > 1:
+            clicks += row.shard_clicks
+            last_ip = row.shard_last_ip or last_ip
+        if link_expired(row.expires_at, row.max_clicks, clicks):
+            return None
+        return StoredLink(
+            link_id, row.long_url, row.name, clicks, last_ip, row.expires_at, row.max_clicks
+        )
+
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        async with self.engine.connect() as conn:
+            try:
+                with span("insert"):
+                    await conn.execute(
+                        self.statements["insert_link"],
+                        {
+                            "id": link_id,
+                            "long_url": long_url,
+                            "name": name,
+                            "clicks": 0,
+                            "expires_at": expires_at,
+                            "max_clicks": max_clicks,
+                        },
+                    )
+                with span("commit"):
+                    await conn.commit()
+            except IntegrityError:
+                # the primary key is the check for a taken id
+                raise LinkExistsError(link_id)
+        return StoredLink(link_id, long_url, name, expires_at=expires_at, max_clicks=max_clicks)
+
+    async def _count_click(self, conn, click: Click):
+        """The link's (long_url, expires_at, max_clicks) if the click counted, else None."""
+        return (
+            await conn.execute(
+                self.statements["count_click"],
+                {"b_link_id": click.link_id, "b_ip": click.ip, "b_now": utc_now()},
+            )
+        ).one_or_none()
+
+    async def _increment_shard(self, conn, click: Click) -> bool:
+        try:
+            with span("clicks_update"):
+                await conn.execute(
+                    self.statements["increment_shard"],
+                    {
+                        "b_link_id": click.link_id,
+                        "b_shard": random.randrange(self.counter_shards),
+                        "b_ip": click.ip,
+                    },
+                )
+        except IntegrityError:
+            return False  # no such link
+        return True
+
+    async def _log_click(self, conn, click: Click) -> bool:
+        if self.click_buffer is None:
+            with span("click_insert"):
+                await conn.execute(
+                    self.statements["insert_click"],
+                    {
+                        "link_id": click.link_id,
+                        "click_ip": click.ip,
+                        "timestamp": click.timestamp,
+                        "user_agent": click.user_agent,
+                    },
+                )
+        with span("commit"):
+            await conn.commit()
+        if self.click_buffer is not None:
+            self.click_buffer.add(click.link_id, click.ip, click.timestamp, click.user_agent)
+        return True
+
+    def _spool_click(self, click: Click):
+        self.click_spool.append(click.link_id, click.ip, click.timestamp, click.user_agent)
+
+    async def record_click(self, click: Click) -> bool:
+        if self.click_spool is not None:
+            # not checked against the database; the replayer skips unknown links
+            self._spool_click(click)
+            return True
+        async with self.engine.connect() as conn:
+            if self.counter_shards > 1:
+                if not await self._increment_shard(conn, click):
+                    return False
+            else:
+                with span("clicks_update"):
+                    if await self._count_click(conn, click) is None:
+                        return False
+            return await self._log_click(conn, click)
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        # one connection for the lookup and the write
+        async with self.engine.connect() as conn:
+            if self.click_spool is None and self.counter_shards <= 1:
+                # the lookup is the UPDATE that counts the click
+                with span("link_lookup"):
+                    row = await self._count_click(conn, click)
+                if row is None:
+                    return None
+                await self._log_click(conn, click)
+                return StoredLink(
+                    click.link_id,
+                    row.long_url,
+                    expires_at=row.expires_at,
+                    max_clicks=row.max_clicks,
+                )
+            with span("link_lookup"):
+                row = (
+                    await conn.execute(self.statements["lookup"], {"b_link_id": click.link_id})
+                ).one_or_none()
+            if row is None or link_expired(row.expires_at, None, 0):
+                return None
+            if row.max_clicks is not None:
+                with span("clicks_update"):
+                    row = await self._count_click(conn, click)
+                if row is None:
+                    return None  # used up
+                await self._log_click(conn, click)
+            elif self.click_spool is not None:
+                self._spool_click(click)
+            elif not await self._increment_shard(conn, click):
+                return None  # deleted since the lookup
+            else:
+                await self._log_click(conn, click)
+        return StoredLink(
+            click.link_id, row.long_url, expires_at=row.expires_at, max_clicks=row.max_clicks
+        )
+
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        async with self.engine.connect() as conn:
+            return set(
+                (
+                    await conn.execute(self.statements["taken_ids"], {"b_link_ids": list(link_ids)})
+                ).scalars()
+            )
+
+    async def count_links(self) -> int:
+        async with self.engine.connect() as conn:
+            return (await conn.execute(select(func.count()).select_from(Link))).scalar_one()
+
+    async def iter_link_ids(self) -> AsyncIterator[str]:
+        async with self.engine.connect() as conn:
+            result = await conn.stream_scalars(select(Link.id).execution_options(yield_per=10_000))
+            async for link_id in result:
+                yield link_id
+
+    async def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        async with self.engine.connect() as conn:
+            result = await conn.stream(
+                select(Link.id, Link.long_url)
+                .where(Link.expires_at.is_(None), Link.max_clicks.is_(None))
+                .execution_options(yield_per=10_000)
+            )
+            async for link_id, long_url in result:
+                yield link_id, long_url
+
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        async with self.engine.connect() as conn:
+            # walks the partial ix_links_expires_at index; SKIP LOCKED lets
+            # several instances sweep at once (ignored on SQLite)
+            link_ids = list(
+                (
+                    await conn.execute(
+                        select(Link.id)
+                        .where(Link.expires_at <= now)
+                        .order_by(Link.expires_at)
+                        .limit(limit)
+                        .with_for_update(skip_locked=True)
+                    )
+                ).scalars()
+            )
+            if not link_ids:
+                return []
+            await conn.execute(delete(LinkClickLog).where(LinkClickLog.link_id.in_(link_ids)))
+            await conn.execute(
+                delete(LinkClickShard).where(LinkClickShard.link_id.in_(link_ids))
+            )
+            await conn.execute(delete(Link).where(Link.id.in_(link_ids)))
+            await conn.commit()
+        return link_ids
+
+    async def close(self):
+        await self.engine.dispose()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (
+    id VARCHAR NOT NULL PRIMARY KEY,
+    long_url VARCHAR NOT NULL,
+    name VARCHAR NOT NULL DEFAULT '',
+    clicks INTEGER NOT NULL DEFAULT 0,
+    last_ip VARCHAR,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at DATETIME,
+    max_clicks INTEGER
+);
+CREATE TABLE IF NOT EXISTS link_click_log (
+    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    link_id VARCHAR NOT NULL REFERENCES links (id),
+    click_ip VARCHAR,
+    timestamp DATETIME,
+    user_agent VARCHAR,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS ix_link_click_log_link_id_timestamp
+    ON link_click_log (link_id, timestamp);
+DROP INDEX IF EXISTS ix_link_click_log_link_id;
+"""
+
+
+SQLITE_ADDED_COLUMNS = {
+    "expires_at": "DATETIME",
+    "max_clicks": "INTEGER",
+    "name": "VARCHAR NOT NULL DEFAULT ''",
+    "clicks": "INTEGER NOT NULL DEFAULT 0",
+    "last_ip": "VARCHAR",
+}
+
+
+SQLITE_FOLD_METADATA = """
+UPDATE links SET
+    name = (SELECT name FROM link_metadata WHERE link_id = links.id),
+    clicks = (SELECT clicks FROM link_metadata WHERE link_id = links.id),
+    last_ip = (SELECT last_ip FROM link_metadata WHERE link_id = links.id)
+WHERE id IN (SELECT link_id FROM link_metadata);
+DROP TABLE link_metadata;
+"""
+
+
+def _sqlite_time(value: datetime | None) -> str | None:
+    # fixed width, so comparing the text compares the times
+    return value.isoformat(" ", timespec="microseconds") if value is not None else None
+
+
+def _from_sqlite_time(value: str | None) -> datetime | None:
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+class SQLiteLinkStore(LinkStore):
+    """
+    A local SQLite file in WAL mode through the stdlib driver, without an
+    ORM or a connection pool. Statements run directly on the event loop: a
+    point lookup or a WAL commit with synchronous=NORMAL (no fsync until
+    checkpoint) takes microseconds, less than handing it to a thread would.
+    Only one process should write to the file.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SQLITE_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(links)")}
+        for column, column_type in SQLITE_ADDED_COLUMNS.items():
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE links ADD COLUMN {column} {column_type}")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_links_expires_at ON links (expires_at)"
+            " WHERE expires_at IS NOT NULL"
+        )
+        if self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'link_metadata'"
+        ).fetchone():
+            self._conn.executescript(f"BEGIN IMMEDIATE; {SQLITE_FOLD_METADATA} COMMIT;")
+
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        with span("link_lookup"):
+            row = self._conn.execute(
+                "SELECT long_url, name, clicks, last_ip, expires_at, max_clicks"
+                " FROM links WHERE id = ?",
+                (link_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        expires_at = _from_sqlite_time(row[4])
+        if link_expired(expires_at, row[5], row[2]):
+            return None
+        return StoredLink(link_id, row[0], row[1], row[2], row[3], expires_at, row[5])
+
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        with span("insert"):
+            try:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT INTO links (id, long_url, name, clicks, expires_at, max_clicks)"
+                        " VALUES (?, ?, ?, 0, ?, ?)",
+                        (link_id, long_url, name, _sqlite_time(expires_at), max_clicks),
+                    )
+            except sqlite3.IntegrityError:
+                raise LinkExistsError(link_id)
+        return StoredLink(link_id, long_url, name, expires_at=expires_at, max_clicks=max_clicks)
+
+    def _write_click(self, click: Click) -> tuple | None:
+        """
+        Count and log `click` unless its link has expired or is used up;
+        returns the link's (long_url, expires_at, max_clicks). The UPDATE
+        checks max_clicks as it counts, and the last allowed click sets
+        expires_at so the sweeper takes the link from there.
+        """
+        now = _sqlite_time(utc_now())
+        with span("click_write"), self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "UPDATE links SET clicks = clicks + 1, last_ip = ?,"
+                " updated_at = CURRENT_TIMESTAMP,"
+                " expires_at = CASE WHEN clicks + 1 >= max_clicks THEN ? ELSE expires_at END"
+                " WHERE id = ? AND (expires_at IS NULL OR expires_at > ?)"
+                " AND (max_clicks IS NULL OR clicks < max_clicks)"
+                " RETURNING long_url, expires_at, max_clicks",
+                (click.ip, now, click.link_id, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "INSERT INTO link_click_log (link_id, click_ip, timestamp, user_agent)"
+                " VALUES (?, ?, ?, ?)",
+                (click.link_id, click.ip, click.timestamp.isoformat(" "), click.user_agent),
+            )
+        return row
+
+    async def record_click(self, click: Click) -> bool:
+        return self._write_click(click) is not None
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        row = self._write_click(click)
+        if row is None:
+            return None
+        return StoredLink(
+            click.link_id, row[0], expires_at=_from_sqlite_time(row[1]), max_clicks=row[2]
+        )
+
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        link_ids = list(link_ids)
+        if not link_ids:
+            return set()
+        placeholders = ",".join("?" * len(link_ids))
+        rows = self._conn.execute(
+            f"SELECT id FROM links WHERE id IN ({placeholders})", link_ids
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    async def count_links(self) -> int:
+        return self._conn.execute("SELECT count(*) FROM links").fetchone()[0]
+
+    async def iter_link_ids(self) -> AsyncIterator[str]:
+        cursor = self._conn.execute("SELECT id FROM links")
+        while rows := cursor.fetchmany(10_000):
+            for row in rows:
+                yield row[0]
+
+    async def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        cursor = self._conn.execute(
+            "SELECT id, long_url FROM links WHERE expires_at IS NULL AND max_clicks IS NULL"
+        )
+        while rows := cursor.fetchmany(10_000):
+            for link_id, long_url in rows:
+                yield link_id, long_url
+
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            link_ids = [
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT id FROM links WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                    (_sqlite_time(now), limit),
+                )
+            ]
+            if link_ids:
+                placeholders = ",".join("?" * len(link_ids))
+                for table, column in (
+                    ("link_click_log", "link_id"),
+                    ("links", "id"),
+                ):
+                    self._conn.execute(
+                        f"DELETE FROM {table} WHERE {column} IN ({placeholders})", link_ids
+                    )
+        return link_ids
+
+    async def close(self):
+        self._conn.close()
+
+
+class MemoryLinkStore(LinkStore):
+    """
+    Dicts in process memory; nothing survives a restart. Expiring links are
+    also filed in a timing wheel, which plays the part of the expires_at
+    index for delete_expired.
+    """
+
+    name = "memory"
+
+    def __init__(self, click_log_size: int = MEMORY_CLICK_LOG_SIZE):
+        self.links: dict[str, StoredLink] = {}
+        self.clicks: deque[Click] = deque(maxlen=click_log_size)
+        self._expiring = TimingWheel(1.0, 3600, utc_now().timestamp())
+
+    def _schedule_expiry(self, link: StoredLink):
+        at = link.expires_at.replace(tzinfo=timezone.utc).timestamp()
+        self._expiring.schedule(link.id, at)
+
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        link = self.links.get(link_id)
+        if link is None or link_expired(link.expires_at, link.max_clicks, link.clicks):
+            return None
+        return link
+
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        if link_id in self.links:
+            raise LinkExistsError(link_id)
+        link = self.links[link_id] = StoredLink(
+            link_id, long_url, name, expires_at=expires_at, max_clicks=max_clicks
+        )
+        if expires_at is not None:
+            self._schedule_expiry(link)
+        return link
+
+    async def record_click(self, click: Click) -> bool:
+        link = self.links.get(click.link_id)
+        if link is None:
+            return False
+        link.clicks += 1
+        link.last_ip = click.ip
+        self.clicks.append(click)
+        if link.max_clicks is not None and link.clicks >= link.max_clicks:
+            link.expires_at = utc_now()
+            self._schedule_expiry(link)
+        return True
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        link = await self.get_link(click.link_id)
+        if link is None:
+            return None
+        await self.record_click(click)
+        return link
+
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        return {link_id for link_id in link_ids if link_id in self.links}
+
+    async def count_links(self) -> int:
+        return len(self.links)
+
+    async def iter_link_ids(self) -> AsyncIterator[str]:
+        for link_id in list(self.links):
+            yield link_id
+
+    async def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        for link in list(self.links.values()):
+            if link.expires_at is None and link.max_clicks is None:
+                yield link.id, link.long_url
+
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        # the wheel hands out everything that is due, limit or not
+        link_ids = self._expiring.advance(now.replace(tzinfo=timezone.utc).timestamp())
+        for link_id in link_ids:
+            self.links.pop(link_id, None)
+        return link_ids
+
+
+class SnapshotLinkStore(LinkStore):
+    """
+    Answers redirect lookups from an immutable LinkSnapshot (see
+    src/snapshot.py) and everything else from `inner`: metadata and clicks,
+    new links, and the lookups for links created after the snapshot. Links
+    never change once created and expiring ones are left out of snapshots
+    (see iter_links), so a snapshot hit is always right.
+
+    A hit only skips the database when its click can go to `click_spool`.
+    Without one, counting the click takes the same statement as looking the
+    link up (see SQLAlchemyLinkStore.follow_link), so hits go to `inner`
+    too; the snapshot then still answers alias checks, and redirects while
+    the database is unavailable (see GuardedLinkStore).
+    """
+
+    def __init__(self, inner: LinkStore, path: str, click_spool: ClickSpool | None = None):
+        self.inner = inner
+        self.click_spool = click_spool
+        self.name = f"snapshot+{inner.name}"
+        self.path = path
+        self.snapshot: LinkSnapshot | None = None
+        self._loaded_mtime: int | None = None
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """Load the file if it changed since the last load; True when it did."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._loaded_mtime:
+            return False
+        try:
+            snapshot = LinkSnapshot(self.path)
+        except (OSError, ValueError) as e:
+            print(f"Failed to load link snapshot {self.path}: {e}")
+            return False
+        previous, self.snapshot, self._loaded_mtime = self.snapshot, snapshot, mtime
+        if previous is not None:
+            previous.close()
+        print(f"Loaded link snapshot {self.path} with {len(snapshot)} links")
+        return True
+
+    async def keep_fresh(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.refresh()
+
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        return await self.inner.get_link(link_id)
+
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        return await self.inner.create_link(link_id, long_url, name, expires_at, max_clicks)
+
+    async def record_click(self, click: Click) -> bool:
+        return await self.inner.record_click(click)
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        long_url = self.snapshot.lookup(click.link_id) if self.snapshot is not None else None
+        if long_url is None:
+            metrics.inc("link_snapshot_lookups_total", result="miss")
+            return await self.inner.follow_link(click)
+        metrics.inc("link_snapshot_lookups_total", result="hit")
+        if self.click_spool is None:
+            return await self.inner.follow_link(click)
+        self.click_spool.append(click.link_id, click.ip, click.timestamp, click.user_agent)
+        return StoredLink(click.link_id, long_url)
+
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        link_ids = list(link_ids)
+        taken = set()
+        if self.snapshot is not None:
+            taken = {link_id for link_id in link_ids if self.snapshot.lookup(link_id) is not None}
+        rest = [link_id for link_id in link_ids if link_id not in taken]
+        if rest:
+            taken |= await self.inner.taken_ids(rest)
+        return taken
+
+    async def count_links(self) -> int:
+        return await self.inner.count_links()
+
+    def iter_link_ids(self) -> AsyncIterator[str]:
+        return self.inner.iter_link_ids()
+
+    def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        return self.inner.iter_links()
+
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        return await self.inner.delete_expired(now, limit)
+
+    async def close(self):
+        await self.inner.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
+
+
+class GuardedLinkStore(LinkStore):
+    """
+    Puts a CircuitBreaker in front of `inner`. Calls that fail with a
+    database error, or take longer than `timeout`, count against it, and
+    while it is open they raise DatabaseUnavailableError right away instead
+    of waiting on the database.
+
+    Redirects degrade instead: every followed link is kept in a LinkCache,
+    and while the database is unavailable a redirect is answered from it
+    (or from the link snapshot), stale-while-revalidate: the first request
+    let through by the half-open breaker revalidates against the database.
+    Links limited by max_clicks are never served stale. The clicks of stale
+    redirects go to the click spool if there is one, and are lost otherwise.
+    """
+
+    def __init__(
+        self,
+        inner: LinkStore,
+        breaker: CircuitBreaker,
+        link_cache: LinkCache,
+        timeout: float = DB_CALL_TIMEOUT,
+        click_spool: ClickSpool | None = None,
+    ):
+        self.inner = inner
+        self.name = f"guarded+{inner.name}"
+        self.breaker = breaker
+        self.link_cache = link_cache
+        self.timeout = timeout
+        self.click_spool = click_spool
+
+    async def _call(self, operation):
+        if not self.breaker.allow():
+            raise DatabaseUnavailableError("The database is unavailable, try again shortly")
+        try:
+            async with asyncio.timeout(self.timeout):
+                result = await operation()
+        except Exception as e:
+            if not is_database_error(e):
+                self.breaker.record_success()  # the database answered
+                raise
+            self.breaker.record_failure()
+            print(f"Database call failed: {e!r}")
+            raise DatabaseUnavailableError("The database is unavailable, try again shortly") from e
+        except BaseException:
+            self.breaker.abandon()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def _stale_url(self, link_id: str) -> str | None:
+        long_url = self.link_cache.get(link_id)
+        snapshot = getattr(self.inner, "snapshot", None)
+        if long_url is None and snapshot is not None:
+            long_url = snapshot.lookup(link_id)
+        return long_url
+
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        return await self._call(lambda: self.inner.get_link(link_id))
+
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        return await self._call(
+            lambda: self.inner.create_link(link_id, long_url, name, expires_at, max_clicks)
+        )
+
+    async def record_click(self, click: Click) -> bool:
+        return await self._call(lambda: self.inner.record_click(click))
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        try:
+            link = await self._call(lambda: self.inner.follow_link(click))
+        except DatabaseUnavailableError:
+            long_url = self._stale_url(click.link_id)
+            if long_url is None:
+                metrics.inc("degraded_redirects_total", result="miss")
+                raise
+            metrics.inc("degraded_redirects_total", result="hit")
+            if self.click_spool is not None:
+                self.click_spool.append(click.link_id, click.ip, click.timestamp, click.user_agent)
+            return StoredLink(click.link_id, long_url)
+        if link is not None and link.max_clicks is None:
+            expires_at = link.expires_at
+            self.link_cache.put(
+                link.id,
+                link.long_url,
+                expires_at.replace(tzinfo=timezone.utc).timestamp() if expires_at else None,
+            )
+        return link
+
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        return await self._call(lambda: self.inner.taken_ids(link_ids))
+
+    async def count_links(self) -> int:
+        return await self._call(self.inner.count_links)
+
+    def iter_link_ids(self) -> AsyncIterator[str]:
+        return self.inner.iter_link_ids()
+
+    def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        return self.inner.iter_links()
+
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        return await self._call(lambda: self.inner.delete_expired(now, limit))
+
+    async def close(self):
+        await self.inner.close()
+
+
+def create_link_store(backend: str) -> LinkStore:
+    if backend == "sqlalchemy":
+        return SQLAlchemyLinkStore(click_buffer, click_spool, CLICK_COUNTER_SHARDS)
+    if backend == "sqlite":
+        return SQLiteLinkStore(SQLITE_PATH)
+    if backend == "memory":
+        return MemoryLinkStore()
+    raise EnvironmentError(f"Unknown STORAGE_BACKEND {backend!r}, use sqlalchemy, sqlite or memory")
+
+
+click_buffer = (
+    ClickBuffer(async_engine)
+    if CLICK_BUFFER_ENABLED and STORAGE_BACKEND == "sqlalchemy" and async_engine is not None
+    else None
+)
+
+
+if click_buffer is not None:
+    metrics.gauge(
+        "click_buffer_pending",
+        "Clicks waiting to be written to the click log.",
+        lambda: len(click_buffer),
+    )
+
+
+click_spool = (
+    ClickSpool(CLICK_SPOOL_DIR)
+    if CLICK_SPOOL_DIR and STORAGE_BACKEND == "sqlalchemy" and async_engine is not None
+    else None
+)
+
+
+if click_spool is not None:
+    metrics.gauge(
+        "click_spool_backlog_bytes",
+        "Bytes of spooled clicks not yet replayed to the database.",
+        click_spool.backlog_bytes,
+    )
+
+
+link_store = create_link_store(STORAGE_BACKEND)
+
+
+link_snapshot_store = None
+
+
+if LINK_SNAPSHOT_PATH:
+    link_store = link_snapshot_store = SnapshotLinkStore(
+        link_store, LINK_SNAPSHOT_PATH, click_spool=click_spool
+    )
+    metrics.gauge(
+        "link_snapshot_entries",
+        "Links in the loaded snapshot.",
+        lambda: len(link_snapshot_store.snapshot) if link_snapshot_store.snapshot is not None else 0,
+    )
+
+
+db_breaker = None
+
+
+if DB_BREAKER_ENABLED and STORAGE_BACKEND == "sqlalchemy":
+    db_breaker = CircuitBreaker(DB_BREAKER_FAILURES, DB_BREAKER_RESET_TIMEOUT)
+    link_store = GuardedLinkStore(
+        link_store, db_breaker, LinkCache(LINK_CACHE_SIZE), click_spool=click_spool
+    )
+    metrics.gauge(
+        "db_breaker_state",
+        "Database circuit breaker: 0 closed, 1 half open, 2 open.",
+        lambda: BREAKER_STATES[db_breaker.state],
+    )
+    metrics.gauge(
+        "link_cache_entries",
+        "Links kept for redirects while the database is unavailable.",
+        lambda: len(link_store.link_cache),
+    )
+
+
+def get_link_store() -> LinkStore:
+    """FastAPI dependency, so tests can swap the store with dependency_overrides."""
+    return link_store
+
+
+
+# ===== From filters.py =====
+ALIAS_FILTER_ENABLED = os.getenv("ALIAS_FILTER_ENABLED", "1") == "1"
+
+
+ALIAS_FILTER_FP_RATE = float(os.getenv("ALIAS_FILTER_FP_RATE", "0.01"))
+
+
+ALIAS_FILTER_REFRESH = float(os.getenv("ALIAS_FILTER_REFRESH", "60"))
+
+
+ALIAS_FILTER_MAX_AGE = float(os.getenv("ALIAS_FILTER_MAX_AGE", "90"))
+
+
+class BloomFilter:
+    """Plain bit-array Bloom filter using double hashing of a blake2b digest."""
+
+    def __init__(self, capacity: int, fp_rate: float):
+        capacity = max(capacity, 1024)
+        self.size = max(8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class LinkIdFilter:
+    """
+    In-memory membership filter over every link id in the link store.
 
-import dotenv
-import fastapi
-from bs4 import BeautifulSoup
-from fastapi.middleware.cors import CORSMiddleware
-from google.genai import Client as GenAIClient
-from pydantic import AnyHttpUrl, BaseModel, Field
-from sqlalchemy import DateTime, ForeignKey, Integer, NullPool, String, func, select, update
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
-from sqlalchemy.orm import Mapped, declarative_base, mapped_column, relationship
+    A miss means the id is definitely not taken (as of the last rebuild plus
+    the links created by this process), so availability checks can skip the
+    store. A hit only means "maybe", and has to be confirmed by the store.
+    Until the first rebuild finishes every id is a "maybe".
 
+    Links created by other instances only show up after the next rebuild,
+    so a filter older than `max_age` seconds (counted from the start of its
+    rebuild) answers "maybe" for everything, like one that is not built yet.
+    That bounds how long such a link can look available; create_url still
+    checks the store, so a taken one is never handed out.
+    """
 
-# ===== From db.py =====
-dotenv.load_dotenv()
+    def __init__(self, fp_rate: float, max_age: float):
+        self.fp_rate = fp_rate
+        self.max_age = max_age
+        self._bloom: BloomFilter | None = None
+        self._built_at = 0.0
+        self._added_during_rebuild: list[str] | None = None
 
+    @property
+    def ready(self) -> bool:
+        return self._bloom is not None and time.monotonic() - self._built_at <= self.max_age
 
-db_url = os.getenv("DATABASE_URL")
+    def might_exist(self, link_id: str) -> bool:
+        return not self.ready or link_id in self._bloom
 
+    def add(self, link_id: str):
+        if self._added_during_rebuild is not None:
+            self._added_during_rebuild.append(link_id)
+        if self._bloom is not None:
+            if self._bloom.count >= self._bloom.capacity:
+                # past capacity the false positive rate climbs quickly
+                self._bloom = None
+                return
+            self._bloom.add(link_id)
 
-if db_url is None:
-    raise EnvironmentError("DATABASE_URL not set in environment variables")
+    async def rebuild(self):
+        self._added_during_rebuild = []
+        started = time.monotonic()
+        try:
+            total = await link_store.count_links()
+            # leave room to grow until the next rebuild
+            bloom = BloomFilter(total * 2, self.fp_rate)
+            async for link_id in link_store.iter_link_ids():
+                bloom.add(link_id)
+            for link_id in self._added_during_rebuild:
+                bloom.add(link_id)
+            self._bloom = bloom
+            self._built_at = started
+        finally:
+            self._added_during_rebuild = None
 
+    async def keep_fresh(self, interval: float):
+        while True:
+            try:
+                await self.rebuild()
+            except Exception as e:
+                print(f"Failed to rebuild link id filter: {e}")
+            await asyncio.sleep(interval)
 
-Base = declarative_base()
 
+link_id_filter = LinkIdFilter(ALIAS_FILTER_FP_RATE, ALIAS_FILTER_MAX_AGE)
 
-async_engine = create_async_engine(db_url, echo=True, future=True, poolclass=NullPool)
 
 
-async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
-    async with async_sessionmaker(
-        bind=async_engine,
-        expire_on_commit=False,
-    )() as session:
-        yield session
+# ===== From expiry.py =====
+EXPIRY_SWEEP_ENABLED = os.getenv("EXPIRY_SWEEP_ENABLED", "1") == "1"
 
 
+EXPIRY_SWEEP_INTERVAL = float(os.getenv("EXPIRY_SWEEP_INTERVAL", "60"))
 
-# ===== From schemas.py =====
-class LinkCreate(BaseModel):
-    long_url: AnyHttpUrl
-    name: str | None = None
 
+EXPIRY_SWEEP_BATCH = int(os.getenv("EXPIRY_SWEEP_BATCH", "500"))
 
-class LinkMetadataResponse(BaseModel):
-    clicks: int
-    last_ip: str | None
-    custom_name: str | None = None
 
+metrics.counter("expired_links_reaped_total", "Expired links deleted by the sweeper.")
 
-class LinkResponse(BaseModel):
-    shortened_url: str
-    long_url: AnyHttpUrl
-    link_metadata: LinkMetadataResponse = Field(alias="metadata")
 
+async def sweep_expired_links(store: LinkStore, batch: int = EXPIRY_SWEEP_BATCH) -> int:
+    """
+    Delete every link that has expired so far, `batch` at a time, and return
+    how many went. Each batch is its own short transaction, walking the
+    partial index on expires_at, so the sweep never holds many rows locked.
+    """
+    now = utc_now()
+    reaped = 0
+    while True:
+        link_ids = await store.delete_expired(now, batch)
+        reaped += len(link_ids)
+        metrics.inc("expired_links_reaped_total", len(link_ids))
+        if len(link_ids) < batch:
+            return reaped
+        await asyncio.sleep(0)  # let requests in between batches
 
-class ErrorResponse(BaseModel):
-    error: str
-    message: str
-    redirect_to: str | None = None
 
+async def keep_sweeping(
+    store: LinkStore,
+    interval: float = EXPIRY_SWEEP_INTERVAL,
+    batch: int = EXPIRY_SWEEP_BATCH,
+):
+    while True:
+        try:
+            reaped = await sweep_expired_links(store, batch)
+            if reaped:
+                print(f"Reaped {reaped} expired links")
+        except Exception as e:
+            print(f"Failed to sweep expired links: {e}")
+        await asyncio.sleep(interval)
 
-class LinkRedirectResponse(BaseModel):
-    message: str = "Redirecting to the original URL"
-    redirect_to: str = Field(alias="long_url")
 
 
-class LinkAliasAvailabilityResponse(BaseModel):
-    alias: str
-    is_available: bool
+# ===== From suggest.py =====
+class LLMEmptyError(Exception):
+    """Raised when the LLM answers without any alias suggestions."""
 
 
-class LinkAliasSuggestionResponse(BaseModel):
-    suggested_aliases: list[str]
-    time_taken: float
+ALIAS_SUGGEST_MODE = os.getenv("ALIAS_SUGGEST_MODE", "local")
 
 
-class LinkURLExistenceResponse(BaseModel):
-    long_url: AnyHttpUrl
-    exists: bool
+ALIAS_SUGGEST_LLM_BUDGET = float(os.getenv("ALIAS_SUGGEST_LLM_BUDGET", "2.0"))
 
 
-class LinkShortUrlSuggestionsResponse(BaseModel):
-    suggested_names: list[str]
+ALIAS_MIN_LENGTH = 5
 
 
+ALIAS_MAX_LENGTH = 14
 
-# ===== From utils.py =====
-async def get_genai_client() -> GenAIClient:
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        raise EnvironmentError("GOOGLE_API_KEY not found in environment variables")
-    return GenAIClient(api_key=api_key)
 
+FETCH_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/143.0.0.0 Safari/537.36 Edg/143.0.0.0"
+}
 
-PROMPT = """
-You are a helpful assistant that generates concise and relevant names for URLs based on their content. Given a URL, provide a short, descriptive name that captures the essence of the webpage.
-For example, for the URL "https://www.example.com/articles/how-to-learn-python", a suitable name could be "learn-python", "learn-python-tutorial", or "python-basics". Include the reference from the webpage to ensure relevance.
-Provide {needed} suggestive names for the following URL: {url}
-Ensure that the names are unique, easy to remember, and do not contain special characters or spaces.
-Keep the text length of each name under 15 characters.
-The names must be URL-friendly (only alphanumeric characters and hyphens).
 
-The contents of the page linked by the URL is provided below for your reference.
-{text}
-"""
+STOPWORDS = {
+    "a", "about", "an", "and", "are", "as", "at", "be", "by", "can", "com",
+    "de", "do", "does", "en", "for", "from", "has", "have", "how", "htm",
+    "html", "http", "https", "i", "in", "index", "into", "is", "it", "its",
+    "js", "me", "my", "net", "of", "on", "or", "org", "our", "page", "php",
+    "s", "the", "their", "this", "to", "was", "we", "what", "when", "where",
+    "which", "who", "why", "will", "with", "www", "you", "your",
+}
 
 
+ABBREVIATIONS = {
+    "administration": "admin",
+    "application": "app",
+    "applications": "apps",
+    "architecture": "arch",
+    "article": "art",
+    "configuration": "config",
+    "database": "db",
+    "development": "dev",
+    "developer": "dev",
+    "developers": "devs",
+    "documentation": "docs",
+    "download": "dl",
+    "example": "ex",
+    "examples": "ex",
+    "government": "gov",
+    "information": "info",
+    "international": "intl",
+    "introduction": "intro",
+    "javascript": "js",
+    "kubernetes": "k8s",
+    "library": "lib",
+    "management": "mgmt",
+    "performance": "perf",
+    "presentation": "pres",
+    "production": "prod",
+    "programming": "prog",
+    "python": "py",
+    "reference": "ref",
+    "repository": "repo",
+    "specification": "spec",
+    "statistics": "stats",
+    "tutorial": "tut",
+    "typescript": "ts",
+}
 
-# ===== From models.py =====
-class LinkMetadata(Base):
-    __tablename__ = "link_metadata"
 
-    link_id: Mapped[str] = mapped_column(ForeignKey("links.id"), primary_key=True, index=True)
-    name: Mapped[str] = mapped_column(String, index=True)
-    long_url: Mapped[str] = mapped_column(String)
-    clicks: Mapped[int] = mapped_column(Integer, default=0)
-    last_ip: Mapped[Optional[str]] = mapped_column(String, nullable=True)
-    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
-    updated_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now(), onupdate=func.now())
+_SPLIT_RE = re.compile(r"[^A-Za-z0-9]+")
 
-    link: Mapped["Link"] = relationship("Link", back_populates="link_metadata")
 
+_CAMEL_RE = re.compile(r"(?<=[a-z])(?=[A-Z])")
 
-class LinkClickLog(Base):
-    __tablename__ = "link_click_log"
 
-    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True, autoincrement=True)
-    link_id: Mapped[str] = mapped_column(ForeignKey("links.id"), index=True)
-    click_ip: Mapped[Optional[str]] = mapped_column(String)
-    timestamp: Mapped[Optional[datetime]] = mapped_column(DateTime)
-    user_agent: Mapped[Optional[str]] = mapped_column(String)
-    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
+_UNSAFE_RE = re.compile(r"[^a-z0-9-]")
 
-    link: Mapped["Link"] = relationship("Link", back_populates="logs")
 
+def _tokens(text: str) -> list[str]:
+    words = []
+    for chunk in _SPLIT_RE.split(text):
+        for word in _CAMEL_RE.split(chunk):
+            word = word.lower()
+            if len(word) < 2 or word in STOPWORDS:
+                continue
+            if word.isdigit() and len(word) > 4:  # ids, timestamps
+                continue
+            words.append(word)
+    return words
 
-class Link(Base):
-    __tablename__ = "links"
 
-    id: Mapped[str] = mapped_column(String, primary_key=True, index=True)
-    long_url: Mapped[str] = mapped_column(String, index=True)
-    created_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now())
-    updated_at: Mapped[datetime] = mapped_column(DateTime, server_default=func.now(), onupdate=func.now())
+def _abbreviate(word: str) -> str:
+    if word in ABBREVIATIONS:
+        return ABBREVIATIONS[word]
+    if len(word) <= 6:
+        return word
+    # keep the first letter and the consonants: "shortener" -> "shrtnr"
+    return (word[0] + re.sub(r"[aeiou]", "", word[1:]))[:6]
+
+
+def _clean_alias(alias: str) -> str:
+    alias = _UNSAFE_RE.sub("", alias.lower().replace("_", "-"))
+    return re.sub(r"-{2,}", "-", alias).strip("-")
+
+
+def _keywords(long_url: str, title: str | None, text: str | None) -> list[str]:
+    """Rank candidate words: title first, then URL path, then frequent page words."""
+    parts = urlsplit(long_url)
+    host_labels = [
+        label for label in (parts.hostname or "").split(".")[:-1] if label != "www"
+    ]
+    # the last path segment is usually the most specific one
+    segments = [s for s in unquote(parts.path).split("/") if s][::-1]
+    path_words = [word for segment in segments for word in _tokens(segment)]
+
+    ranked: list[str] = []
+    for word in _tokens(title or "") + path_words:
+        if word not in ranked:
+            ranked.append(word)
+
+    if text:
+        for word, _ in Counter(w for w in _tokens(text) if len(w) > 3).most_common(8):
+            if word not in ranked:
+                ranked.append(word)
+
+    for label in host_labels[::-1]:
+        for word in _tokens(label):
+            if word not in ranked:
+                ranked.append(word)
+    return ranked
+
+
+def _join(words: list[str], sep: str = "-") -> str | None:
+    """Join words into an alias, abbreviating them if the full form is too long."""
+    for form in (words, [_abbreviate(w) for w in words]):
+        alias = _clean_alias(sep.join(form))
+        if ALIAS_MIN_LENGTH <= len(alias) <= ALIAS_MAX_LENGTH:
+            return alias
+    return None
+
+
+def local_alias_candidates(
+    long_url: str, title: str | None = None, text: str | None = None, limit: int = 30
+) -> list[str]:
+    """
+    Deterministic alias suggestions built from the URL, page title and page
+    keywords. Pure string work, no network or database access.
+    """
+    words = _keywords(long_url, title, text)
+    top = words[:5]
+
+    combos: list[list[str]] = []
+    for i, first in enumerate(top):
+        for second in top[i + 1 :]:
+            combos.append([first, second])
+    for i in range(len(top) - 2):
+        combos.append(top[i : i + 3])
+    combos.extend([word] for word in words[:8])
+
+    candidates: list[str] = []
+    for combo in combos:
+        for sep in ("-", ""):
+            alias = _join(combo, sep)
+            if alias and alias not in candidates:
+                candidates.append(alias)
+                break
+
+    # numbered variants keep the list useful when the good names are taken
+    base = candidates[:3] or [_join(words[:1]) or "link"]
+    n = 2
+    while len(candidates) < limit:
+        for alias in base:
+            numbered = f"{alias[: ALIAS_MAX_LENGTH - len(str(n)) - 1]}-{n}"
+            if numbered not in candidates:
+                candidates.append(numbered)
+        n += 1
+    return candidates[:limit]
+
+
+async def available_aliases(store: LinkStore, names: list[str]) -> list[str]:
+    """
+    Drop the names already used as link ids, keeping order. Names the link id
+    filter has never seen are available without asking the store; the rest
+    are confirmed in a single lookup.
+    """
+    maybe_taken = [name for name in names if link_id_filter.might_exist(name)]
+    if not maybe_taken:
+        return list(names)
+    with span("availability", names=len(maybe_taken)):
+        taken = await store.taken_ids(maybe_taken)
+    return [name for name in names if name not in taken]
+
+
+async def suggest_local_aliases(
+    store: LinkStore,
+    long_url: str,
+    count: int,
+    title: str | None = None,
+    text: str | None = None,
+) -> list[str]:
+    candidates = local_alias_candidates(long_url, title, text, limit=max(30, count * 3))
+    return (await available_aliases(store, candidates))[:count]
+
+
+async def fetch_page(long_url: str) -> "httpx.Response":
+    import httpx
+    with span("fetch"), metrics.time_block("outbound_request_duration_seconds", target="fetch"):
+        async with httpx.AsyncClient(
+            timeout=5.0, follow_redirects=True, headers=FETCH_HEADERS
+        ) as client:
+            return await client.get(long_url)
+
+
+def parse_page(html: str) -> tuple[str | None, str]:
+    """Return the page title and its visible text."""
+    from bs4 import BeautifulSoup
+    with span("parse", bytes=len(html)):
+        soup = BeautifulSoup(html, "html.parser")
+        title = soup.title.get_text(strip=True) if soup.title else None
+        keywords = soup.find("meta", attrs={"name": "keywords"})
+        text = soup.get_text(" ", strip=True)
+    if keywords and keywords.get("content"):
+        text = f"{keywords['content']} {text}"
+    return title, text
+
+
+async def llm_alias_batch(long_url: str, text: str, needed: int) -> list[str]:
+    client = await get_genai_client()
+
+    async def call():
+        with span("llm"), metrics.time_block("outbound_request_duration_seconds", target="llm"):
+            return await client.aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=[
+                    PROMPT.format(
+                        url=long_url, text=text[:5000], needed=int(needed * 2)
+                    )  # take first 5000 chars only from the page, double the needed count to avoid duplicates
+                ],
+                config={
+                    "response_mime_type": "application/json",
+                    "response_schema": LinkShortUrlSuggestionsResponse,
+                },
+            )
+
+    ai_resp = await llm_limiter.run(call)
+    parsed = LinkShortUrlSuggestionsResponse.model_validate(ai_resp.parsed)
+    return list(dict.fromkeys(parsed.suggested_names))
+
+
+async def collect_llm_aliases(
+    store: LinkStore, long_url: str, text: str, count: int
+) -> list[str]:
+    """Ask the LLM for more names until `count` of them are available."""
+    aliases: list[str] = []
+    while len(aliases) < count:
+        batch = await llm_alias_batch(long_url, text, count - len(aliases))
+        if not batch:
+            raise LLMEmptyError()
+        batch = [name for name in batch if name not in aliases]
+        aliases.extend(await available_aliases(store, batch))
+    return aliases[:count]  # return only the requested count
 
-    link_metadata: Mapped["LinkMetadata"] = relationship("LinkMetadata", back_populates="link", uselist=False)
-    logs: Mapped[list["LinkClickLog"]] = relationship("LinkClickLog", back_populates="link")
+
+class _NameStreamParser:
+    """
+    Pulls the complete names out of a partially received
+    `{"suggested_names": [...]}` document, so each one can be used as soon
+    as its closing quote arrives.
+    """
+
+    def __init__(self):
+        self._in_array = False
+        self._in_string = False
+        self._escaped = False
+        self._buffer: list[str] = []
+
+    def feed(self, text: str) -> list[str]:
+        names = []
+        for ch in text:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                    names.append(json.loads('"' + "".join(self._buffer) + '"'))
+                    self._buffer = []
+                    continue
+                self._buffer.append(ch)
+            elif not self._in_array:
+                self._in_array = ch == "["
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "]":
+                self._in_array = False
+        return names
+
+
+async def stream_llm_aliases(
+    store: LinkStore,
+    long_url: str,
+    text: str,
+    count: int,
+    exclude: set[str] | None = None,
+) -> AsyncIterator[str]:
+    """
+    Like `collect_llm_aliases`, but streams the model output and yields the
+    available aliases of each generated batch. The LLM slot is only held while
+    a batch is generated, not while the caller sends the aliases on.
+    """
+    client = await get_genai_client()
+    seen = set(exclude or ())
+    emitted = 0
+    while emitted < count:
+        need = count - emitted
+        async with llm_limiter.slot():
+            attempt = 0
+            while True:
+                parser = _NameStreamParser()
+                batch: list[str] = []
+                try:
+                    # only until the model starts answering
+                    with span("llm_stream"), metrics.time_block(
+                        "outbound_request_duration_seconds", target="llm_stream"
+                    ):
+                        stream = await client.aio.models.generate_content_stream(
+                            model="gemini-2.5-flash",
+                            contents=[
+                                PROMPT.format(url=long_url, text=text[:5000], needed=int(need * 2))
+                            ],
+                            config={
+                                "response_mime_type": "application/json",
+                                "response_schema": LinkShortUrlSuggestionsResponse,
+                            },
+                        )
+                    async for chunk in stream:
+                        for name in parser.feed(chunk.text or ""):
+                            if name not in seen and name not in batch:
+                                batch.append(name)
+                    break
+                except Exception as e:
+                    # nothing went out yet, so the whole batch can be retried
+                    if not llm_limiter.should_retry(e, attempt):
+                        raise
+                    await llm_limiter.backoff(attempt)
+                    attempt += 1
+        if not batch:
+            raise LLMEmptyError()
+        seen.update(batch)
+        for name in await available_aliases(store, batch):
+            yield name
+            emitted += 1
+            if emitted >= count:
+                return
 
 
 
 # ===== From main.py =====
-app = fastapi.FastAPI(root_path="/api")
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    filter_refresh = None
+    if ALIAS_FILTER_ENABLED:
+        # built in the background; until it is ready every alias is a "maybe"
+        filter_refresh = asyncio.create_task(
+            link_id_filter.keep_fresh(ALIAS_FILTER_REFRESH)
+        )
+    trace_export = None
+    if trace_exporter.enabled:
+        trace_export = asyncio.create_task(trace_exporter.run())
+    loop_monitoring = None
+    if LOOP_MONITOR_ENABLED:
+        loop_monitoring = asyncio.create_task(loop_monitor.run())
+    snapshot_refresh = None
+    if link_snapshot_store is not None:
+        snapshot_refresh = asyncio.create_task(
+            link_snapshot_store.keep_fresh(LINK_SNAPSHOT_REFRESH)
+        )
+    expiry_sweep = None
+    if EXPIRY_SWEEP_ENABLED:
+        expiry_sweep = asyncio.create_task(keep_sweeping(link_store))
+    shard_compaction = None
+    if STORAGE_BACKEND == "sqlalchemy" and async_engine is not None:
+        # also folds what is left after CLICK_COUNTER_SHARDS is turned off
+        shard_compaction = asyncio.create_task(keep_compacting(async_engine))
+    click_flush = None
+    if click_buffer is not None:
+        click_flush = asyncio.create_task(click_buffer.run())
+    spool_sync = spool_replay = None
+    if click_spool is not None:
+        spool_sync = asyncio.create_task(click_spool.run())
+        spool_replay = asyncio.create_task(keep_replaying(click_spool, async_engine))
+    yield
+    if shard_compaction:
+        shard_compaction.cancel()
+    if spool_replay:
+        # what is left stays on disk for the next start
+        spool_replay.cancel()
+        spool_sync.cancel()
+        await asyncio.gather(spool_replay, spool_sync, return_exceptions=True)
+        click_spool.close()
+    if click_flush:
+        click_flush.cancel()  # flushes what is left
+        await asyncio.gather(click_flush, return_exceptions=True)
+    if expiry_sweep:
+        expiry_sweep.cancel()
+    if snapshot_refresh:
+        snapshot_refresh.cancel()
+    if loop_monitoring:
+        loop_monitoring.cancel()
+    if filter_refresh:
+        filter_refresh.cancel()
+    if trace_export:
+        trace_export.cancel()  # flushes what is left
+        await asyncio.gather(trace_export, return_exceptions=True)
+    await close_genai_client()
+    await link_store.close()
+
+
+app = fastapi.FastAPI(root_path="/api", lifespan=lifespan)
 
 
 app.add_middleware(
@@ -178,6 +3787,31 @@ app.add_middleware(
 )
 
 
+if TRACING_ENABLED:
+    app.add_middleware(TracingMiddleware)
+
+
+if METRICS_ENABLED:
+    # added last so it wraps everything, CORS included
+    app.add_middleware(MetricsMiddleware)
+    if async_engine is not None:
+        install_engine_hooks(async_engine)
+
+
+if QUERY_LOG_ENABLED and async_engine is not None:
+    install_query_log(async_engine)
+
+
+@app.exception_handler(DatabaseUnavailableError)
+async def database_unavailable(request: fastapi.Request, e: DatabaseUnavailableError):
+    # raised right away while the circuit breaker is open, see src/breaker.py
+    return JSONResponse(
+        status_code=503,
+        content={"error": "DB_UNAVAILABLE", "message": str(e)},
+        headers={"Retry-After": str(int(db_breaker.reset_timeout)) if db_breaker else "10"},
+    )
+
+
 def get_hash(str: str):
     return hashlib.md5(str.encode()).hexdigest()
 
@@ -193,92 +3827,79 @@ def random_phrase(n_chars):
 @app.post("/url/create", response_model=LinkResponse | ErrorResponse)
 async def create_url(
     link: LinkCreate,
-    sql_db: AsyncSession = fastapi.Depends(get_async_session),
+    store: LinkStore = fastapi.Depends(get_link_store),
 ):
     long_url = link.long_url
     custom_name = link.name.strip() if link.name else None
+    expires_at = link.expires_at
+    if expires_at is not None:
+        # stored as naive UTC
+        if expires_at.tzinfo is not None:
+            expires_at = expires_at.astimezone(timezone.utc).replace(tzinfo=None)
+        if expires_at <= utc_now():
+            return {"error": "BAD_REQUEST", "message": "expires_at must be in the future"}
 
     hashed_long_url = get_hash(
         str(time.time()) + long_url.encoded_string() + random_phrase(20)
     )
     hashed_string = hashed_long_url[:8]
 
-    sql_db_link = await sql_db.execute(
-        select(Link).where(Link.id == (custom_name if custom_name else hashed_string))
-    )
-    existing_link = sql_db_link.scalars().one_or_none()
-
-    if custom_name and existing_link:
-        return {
-            "error": "BAD_REQUEST",
-            "reason": "Name already occupied, try a different name",
-        }
-    elif existing_link:  # this is quite rare, but still can happen.. so instead of generating a new hash, we just extend the hash.
-        hashed_string = hashed_long_url[: random.randint(9, 12)]
-
     url_id = custom_name if custom_name else hashed_string
-
-    new_link = Link(id=url_id, long_url=str(long_url))
-
-    new_metadata = LinkMetadata(
-        link_id=url_id,
-        name=custom_name if custom_name else "",
-        long_url=str(long_url),
-        clicks=0,
-        last_ip=None,
-    )
-
-    sql_db.add(new_link)
-    sql_db.add(new_metadata)
-    await sql_db.commit()
-    await sql_db.refresh(new_link)
-    await sql_db.refresh(new_metadata)
+    try:
+        new_link = await store.create_link(
+            url_id, str(long_url), custom_name or "", expires_at, link.max_clicks
+        )
+    except LinkExistsError:
+        if custom_name:
+            return {
+                "error": "BAD_REQUEST",
+                "message": "Name already occupied, try a different name",
+            }
+        # this is quite rare, but still can happen.. so instead of generating a new hash, we just extend the hash.
+        url_id = hashed_long_url[: random.randint(9, 12)]
+        new_link = await store.create_link(
+            url_id, str(long_url), expires_at=expires_at, max_clicks=link.max_clicks
+        )
+    link_id_filter.add(url_id)
+    missing_link_ids.discard(url_id)
 
     # return the Link
     return LinkResponse(
         shortened_url=new_link.id,
         long_url=AnyHttpUrl(new_link.long_url),
         metadata=LinkMetadataResponse(
-            custom_name=new_metadata.name if new_metadata.name != "" else None,
-            clicks=new_metadata.clicks,
-            last_ip=new_metadata.last_ip,
+            custom_name=new_link.name if new_link.name != "" else None,
+            clicks=new_link.clicks,
+            last_ip=new_link.last_ip,
+            expires_at=new_link.expires_at,
+            max_clicks=new_link.max_clicks,
         ),
     )
 
 
-@app.get("/url/{short_url_id}/metadata", response_model=LinkResponse)
+@app.get("/url/{short_url_id}/metadata", response_model=LinkResponse | ErrorResponse)
 async def get_shortened_url_metadata(
-    short_url_id: str, sql_db: AsyncSession = fastapi.Depends(get_async_session)
+    short_url_id: str, store: LinkStore = fastapi.Depends(get_link_store)
 ):
-    link = (
-        (await sql_db.execute(select(Link).where(Link.id == short_url_id)))
-        .scalars()
-        .one_or_none()
-    )
-
-    if not link:
+    if short_url_id in missing_link_ids:
         return {"error": "NOT_FOUND", "message": "The requested URL was not found"}
 
-    metadata = (
-        (
-            await sql_db.execute(
-                select(LinkMetadata).where(LinkMetadata.link_id == short_url_id)
-            )
-        )
-        .scalars()
-        .one_or_none()
-    )
+    token = missing_link_ids.token()
+    link = await store.get_link(short_url_id)
 
-    if not metadata:
-        raise AttributeError("Metadata entry not found for the given link ID")
+    if not link:
+        missing_link_ids.add(short_url_id, token)
+        return {"error": "NOT_FOUND", "message": "The requested URL was not found"}
 
     return LinkResponse(
         shortened_url=link.id,
         long_url=AnyHttpUrl(link.long_url),
         metadata=LinkMetadataResponse(
-            custom_name=metadata.name if metadata.name != "" else None,
-            clicks=metadata.clicks,
-            last_ip=metadata.last_ip,
+            custom_name=link.name if link.name != "" else None,
+            clicks=link.clicks,
+            last_ip=link.last_ip,
+            expires_at=link.expires_at,
+            max_clicks=link.max_clicks,
         ),
     )
 
@@ -287,46 +3908,37 @@ async def get_shortened_url_metadata(
 async def redirect_url(
     url: str,
     req: fastapi.Request,
-    sql_db: AsyncSession = fastapi.Depends(get_async_session),
+    store: LinkStore = fastapi.Depends(get_link_store),
 ):
     req_client = req.client
     ipaddr = None
     if req_client:
         ipaddr = req_client.host
 
-    link = (
-        (await sql_db.execute(select(Link).where(Link.id == url)))
-        .scalars()
-        .one_or_none()
-    )
-
-    if not link:
+    if url in missing_link_ids:
         return {
             "error": "NOT_FOUND",
             "message": "The requested URL was not found",
             "redirect_to": "/404",
         }
 
-    # update click log
-    new_log = LinkClickLog(
-        link_id=url,
-        click_ip=ipaddr,
-        timestamp=datetime.now(),
-        user_agent=req.headers.get("user-agent", "unknown"),
-    )
-
-    # update the metadata clicks count
-    metadata = await sql_db.execute(
-        update(LinkMetadata)
-        .values(clicks=LinkMetadata.clicks + 1, last_ip=ipaddr)
-        .where(LinkMetadata.link_id == url)
+    token = missing_link_ids.token()
+    link = await store.follow_link(
+        Click(
+            link_id=url,
+            ip=ipaddr,
+            user_agent=req.headers.get("user-agent", "unknown"),
+            timestamp=datetime.now(),
+        )
     )
-    if not metadata:
-        raise AttributeError("Metadata entry not found for the given link ID")
 
-    sql_db.add(new_log)
-    await sql_db.commit()
-    await sql_db.refresh(new_log)
+    if not link:
+        missing_link_ids.add(url, token)
+        return {
+            "error": "NOT_FOUND",
+            "message": "The requested URL was not found",
+            "redirect_to": "/404",
+        }
 
     return {"message": "Redirecting...", "long_url": link.long_url}
 
@@ -335,113 +3947,227 @@ async def redirect_url(
 async def suggest_alias(
     long_url: str,
     count: int = 3,
-    sql_db: AsyncSession = fastapi.Depends(get_async_session),
+    mode: str | None = None,
+    store: LinkStore = fastapi.Depends(get_link_store),
 ):
+    from google.genai import errors as genai_errors
+    import httpx
     if count > 10:
         return {
             "error": "BAD_REQUEST",
-            "reason": "Count must be less than or equal to 10",
+            "message": "Count must be less than or equal to 10",
+        }
+    mode = mode or ALIAS_SUGGEST_MODE
+    if mode not in ("local", "llm", "hybrid"):
+        return {
+            "error": "BAD_REQUEST",
+            "message": "Mode must be one of local, llm or hybrid",
         }
 
-    # fetch metadata from the URL (title, description, etc.)
-    import httpx
+    time_taken = time.time()
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/143.0.0.0 Safari/537.36 Edg/143.0.0.0"
-    }
+    if mode == "local":
+        aliases = await suggest_local_aliases(store, long_url, count)
+        return {
+            "suggested_aliases": aliases,
+            "time_taken": time.time() - time_taken,
+            "source": "local",
+        }
 
+    # fetch metadata from the URL (title, description, etc.)
     try:
-        resp = httpx.get(long_url, timeout=5.0, follow_redirects=True, headers=headers)
+        resp = await fetch_page(long_url)
         if resp.status_code >= 400:
+            raise httpx.HTTPStatusError(
+                f"status {resp.status_code}", request=resp.request, response=resp
+            )
+    except httpx.HTTPError as e:
+        if mode == "hybrid":
+            aliases = await suggest_local_aliases(store, long_url, count)
             return {
-                "error": "NOT_FOUND",
-                "message": "The provided URL does not exist." + resp.text,
+                "suggested_aliases": aliases,
+                "time_taken": time.time() - time_taken,
+                "source": "local",
             }
-    except httpx.RequestError as e:
         return {
             "error": "NOT_FOUND",
             "message": "The provided URL does not exist or is unreachable. " + str(e),
         }
-    
-    
-
-    client = await get_genai_client()
-    parsed_text = BeautifulSoup(resp.text, "html.parser").get_text(strip=True)
-    print(parsed_text[:500], "Parsed text preview")
 
-    time_taken = time.time()
-    # TODO: Integrate with AI as soon as possible
-    aliases = set()
+    title, parsed_text = parse_page(resp.text)
 
-    while len(aliases) < count:
-        need = count - len(aliases)
-        print("parsed_text length:", len(parsed_text), parsed_text[:100])
-        ai_resp = await client.aio.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                PROMPT.format(
-                    url=long_url, text=parsed_text[:5000], needed=int(need * 2)
-                )  # take first 5000 chars only from the page, double the needed count to avoid duplicates
-            ],
-            config={
-                "response_mime_type": "application/json",
-                "response_schema": LinkShortUrlSuggestionsResponse,
-            },
+    if mode == "hybrid":
+        # the local answer is ready in milliseconds; give the LLM whatever is
+        # left of the budget to come up with something better
+        local_aliases = await suggest_local_aliases(
+            store, long_url, count, title, parsed_text
         )
+        remaining = ALIAS_SUGGEST_LLM_BUDGET - (time.time() - time_taken)
+        try:
+            aliases = await asyncio.wait_for(
+                collect_llm_aliases(store, long_url, parsed_text, count),
+                max(remaining, 0),
+            )
+            source = "llm"
+        except (asyncio.TimeoutError, LLMBusyError, LLMEmptyError):
+            aliases, source = local_aliases, "local"
+        except (genai_errors.APIError, httpx.HTTPError, EnvironmentError) as e:
+            # a model error, an unreachable model or a missing API key (see
+            # get_genai_client): still a case for the local answer
+            logger.warning("LLM alias suggestions failed, answering with local ones: %r", e)
+            aliases, source = local_aliases, "local"
+        return {
+            "suggested_aliases": aliases,
+            "time_taken": time.time() - time_taken,
+            "source": source,
+        }
 
-        parsed = LinkShortUrlSuggestionsResponse.model_validate(ai_resp.parsed)
-        if not parsed.suggested_names:
-            return {
-                "error": "AI_ERROR",
-                "message": "Failed to generate alias suggestions from AI",
-            }
-        batch = set(parsed.suggested_names)
-
-        existing = (
-            await sql_db.execute(select(Link.id).where(Link.id.in_(batch)))
-        ).scalars()
-        batch -= set(existing)  # remove conflicts already in DB
-        aliases.update(batch)
-
-    time_taken = time.time() - time_taken
+    try:
+        aliases = await collect_llm_aliases(store, long_url, parsed_text, count)
+    except LLMBusyError as e:
+        return {"error": "AI_BUSY", "message": str(e)}
+    except LLMEmptyError:
+        return {
+            "error": "AI_ERROR",
+            "message": "Failed to generate alias suggestions from AI",
+        }
 
     return {
-        "suggested_aliases": list(aliases)[:count],  # return only the requested count
-        "time_taken": time_taken,
+        "suggested_aliases": aliases,
+        "time_taken": time.time() - time_taken,
+        "source": "llm",
     }
 
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/alias/suggest/stream", response_model=None)
+async def suggest_alias_stream(
+    long_url: str,
+    count: int = 3,
+    mode: str | None = None,
+    store: LinkStore = fastapi.Depends(get_link_store),
+):
+    """
+    Server-Sent Events variant of /alias/suggest. Every alias is sent as an
+    `alias` event as soon as it is known to be available, followed by a
+    single `done` (or `error`) event.
+    """
+    import httpx
+    if count > 10:
+        return {
+            "error": "BAD_REQUEST",
+            "message": "Count must be less than or equal to 10",
+        }
+    mode = mode or ALIAS_SUGGEST_MODE
+    if mode not in ("local", "llm", "hybrid"):
+        return {
+            "error": "BAD_REQUEST",
+            "message": "Mode must be one of local, llm or hybrid",
+        }
+
+    async def events():
+        time_taken = time.time()
+        sent: set[str] = set()
+
+        try:
+            if mode in ("local", "hybrid"):
+                for alias in await suggest_local_aliases(store, long_url, count):
+                    sent.add(alias)
+                    yield sse_event("alias", {"alias": alias, "source": "local"})
+
+            # hybrid: the LLM only tops the local aliases up to `count`
+            if mode in ("llm", "hybrid") and len(sent) < count:
+                resp = await fetch_page(long_url)
+                resp.raise_for_status()
+                _, parsed_text = parse_page(resp.text)
+                async for alias in stream_llm_aliases(
+                    store, long_url, parsed_text, count - len(sent), exclude=sent
+                ):
+                    sent.add(alias)
+                    yield sse_event("alias", {"alias": alias, "source": "llm"})
+        except httpx.HTTPError as e:
+            yield sse_event(
+                "error",
+                {
+                    "error": "NOT_FOUND",
+                    "message": "The provided URL does not exist or is unreachable. " + str(e),
+                },
+            )
+            return
+        except LLMBusyError as e:
+            yield sse_event("error", {"error": "AI_BUSY", "message": str(e)})
+            return
+        except LLMEmptyError:
+            yield sse_event(
+                "error",
+                {
+                    "error": "AI_ERROR",
+                    "message": "Failed to generate alias suggestions from AI",
+                },
+            )
+            return
+        except DatabaseUnavailableError as e:
+            yield sse_event("error", {"error": "DB_UNAVAILABLE", "message": str(e)})
+            return
+        except Exception as e:
+            # the status line is long gone, so report failures in-band
+            yield sse_event("error", {"error": "AI_ERROR", "message": str(e)})
+            return
+
+        yield sse_event("done", {"count": len(sent), "time_taken": time.time() - time_taken})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/alias/check", response_model=LinkAliasAvailabilityResponse | ErrorResponse)
 async def check_alias_availability(
-    alias: str, sql_db: AsyncSession = fastapi.Depends(get_async_session)
+    alias: str, store: LinkStore = fastapi.Depends(get_link_store)
 ):
     if len(alias) < 5 or len(alias) > 32:
         return {
             "error": "BAD_REQUEST",
-            "reason": "Alias length must be between 3 and 32 characters",
+            "message": "Alias length must be between 3 and 32 characters",
             "is_available": False,
             "alias": alias,
         }
-    existing = (
-        (await sql_db.execute(select(Link.id).where(Link.id == alias)))
-        .scalars()
-        .one_or_none()
-    )
-
-    if existing:
+    if await available_aliases(store, [alias]):
         return {
-            "is_available": False,
+            "is_available": True,
             "alias": alias,
-            "message": "Alias is already taken",
+            "message": "Alias is available",
         }
     else:
         return {
-            "is_available": True,
+            "is_available": False,
             "alias": alias,
-            "message": "Alias is available",
+            "message": "Alias is already taken",
         }
 
 
+@app.post(
+    "/alias/check",
+    response_model=LinkAliasBatchAvailabilityResponse | ErrorResponse,
+)
+async def check_alias_availability_batch(
+    body: LinkAliasBatchCheck, store: LinkStore = fastapi.Depends(get_link_store)
+):
+    valid = [alias for alias in body.aliases if 5 <= len(alias) <= 32]
+    available = set(await available_aliases(store, valid))
+    return {
+        "results": [
+            {"alias": alias, "is_available": alias in available}
+            for alias in body.aliases
+        ]
+    }
+
+
 @app.get("/url/check", response_model=LinkURLExistenceResponse | ErrorResponse)
 async def check_url_existence(
     url: str,
@@ -476,6 +4202,95 @@ async def not_found():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "ok", "message": "The server is running fine"}
+    if db_breaker is not None and db_breaker.state != "closed":
+        return {
+            "status": "degraded",
+            "message": "The database is unavailable, redirects are served from cache",
+            "database": db_breaker.state,
+        }
+    return {
+        "status": "ok",
+        "message": "The server is running fine",
+        "database": db_breaker.state if db_breaker is not None else None,
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus text format. Counts are per process (and per function instance)."""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.post("/admin/profile", response_model=None)
+async def admin_profile(
+    req: fastapi.Request,
+    seconds: float = 10,
+    interval_ms: float = 5,
+    all_threads: bool = False,
+):
+    """
+    Sample stacks for `seconds` and return them in collapsed-stack format,
+    e.g. `curl -X POST -H "X-Admin-Token: ..." ".../admin/profile?seconds=20" > out.folded`
+    then `flamegraph.pl out.folded > out.svg` or open it in speedscope.
+    """
+    error = check_admin_token(req)
+    if error:
+        return error
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or interval_ms < 1:
+        return {
+            "error": "BAD_REQUEST",
+            "message": f"seconds must be in (0, {PROFILE_MAX_SECONDS}] and interval_ms at least 1",
+        }
+    try:
+        stacks = await profiler.profile(seconds, interval_ms, all_threads)
+    except ProfilerBusyError as e:
+        return {"error": "BUSY", "message": str(e)}
+    return PlainTextResponse(stacks)
+
+
+@app.get("/admin/loop", response_model=None)
+async def admin_loop_stats(req: fastapi.Request):
+    error = check_admin_token(req)
+    if error:
+        return error
+    return {"enabled": LOOP_MONITOR_ENABLED, **loop_monitor.stats()}
+
+
+@app.post("/admin/tracemalloc/start", response_model=None)
+async def admin_tracemalloc_start(req: fastapi.Request, frames: int = 10):
+    error = check_admin_token(req)
+    if error:
+        return error
+    return memory_tracker.start(frames)
+
+
+@app.get("/admin/tracemalloc/snapshot", response_model=None)
+async def admin_tracemalloc_snapshot(
+    req: fastapi.Request, top: int = 25, group_by: str = "lineno"
+):
+    """Top allocations, plus the growth since the previous snapshot."""
+    error = check_admin_token(req)
+    if error:
+        return error
+    if group_by not in ("lineno", "filename", "traceback"):
+        return {
+            "error": "BAD_REQUEST",
+            "message": "group_by must be one of lineno, filename or traceback",
+        }
+    status = memory_tracker.status()
+    if not status["tracing"]:
+        return {"error": "BAD_REQUEST", "message": "Start tracemalloc first"}
+    # comparing snapshots walks every traced block, keep it off the loop
+    return await asyncio.to_thread(memory_tracker.snapshot, top, group_by)
+
+
+@app.post("/admin/tracemalloc/stop", response_model=None)
+async def admin_tracemalloc_stop(req: fastapi.Request):
+    error = check_admin_token(req)
+    if error:
+        return error
+    return memory_tracker.stop()
 
 
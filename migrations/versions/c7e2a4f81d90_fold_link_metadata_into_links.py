@@ -0,0 +1,59 @@
+"""Fold link_metadata into links
+
+Revision ID: c7e2a4f81d90
+Revises: 9b4f0c3e7a15
+Create Date: 2026-10-19 15:02:44.170935
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7e2a4f81d90'
+down_revision: Union[str, Sequence[str], None] = '9b4f0c3e7a15'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('links', sa.Column('name', sa.String(), server_default='', nullable=False))
+    op.add_column('links', sa.Column('clicks', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('links', sa.Column('last_ip', sa.String(), nullable=True))
+    # link_metadata.long_url was a copy of links.long_url and is dropped with the table
+    op.execute(
+        "UPDATE links SET name = link_metadata.name, clicks = link_metadata.clicks,"
+        " last_ip = link_metadata.last_ip"
+        " FROM link_metadata WHERE link_metadata.link_id = links.id"
+    )
+    # nothing looks links up by name, so it isn't indexed on links
+    op.drop_index(op.f('ix_link_metadata_name'), table_name='link_metadata')
+    op.drop_index(op.f('ix_link_metadata_link_id'), table_name='link_metadata')
+    op.drop_table('link_metadata')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_table('link_metadata',
+    sa.Column('link_id', sa.String(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('long_url', sa.String(), nullable=False),
+    sa.Column('clicks', sa.Integer(), nullable=False),
+    sa.Column('last_ip', sa.String(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+    sa.ForeignKeyConstraint(['link_id'], ['links.id'], ),
+    sa.PrimaryKeyConstraint('link_id')
+    )
+    op.create_index(op.f('ix_link_metadata_link_id'), 'link_metadata', ['link_id'], unique=False)
+    op.create_index(op.f('ix_link_metadata_name'), 'link_metadata', ['name'], unique=False)
+    op.execute(
+        "INSERT INTO link_metadata (link_id, name, long_url, clicks, last_ip, created_at, updated_at)"
+        " SELECT id, name, long_url, clicks, last_ip, created_at, updated_at FROM links"
+    )
+    op.drop_column('links', 'last_ip')
+    op.drop_column('links', 'clicks')
+    op.drop_column('links', 'name')
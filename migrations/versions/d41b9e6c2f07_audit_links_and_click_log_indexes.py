@@ -0,0 +1,39 @@
+"""Audit links and click log indexes
+
+Revision ID: d41b9e6c2f07
+Revises: c7e2a4f81d90
+Create Date: 2026-10-19 16:21:09.532118
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd41b9e6c2f07'
+down_revision: Union[str, Sequence[str], None] = 'c7e2a4f81d90'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # serves the deletes by link_id (expiry sweeper) and a link's clicks in time order
+    op.create_index('ix_link_click_log_link_id_timestamp', 'link_click_log', ['link_id', 'timestamp'], unique=False)
+    op.drop_index(op.f('ix_link_click_log_link_id'), table_name='link_click_log')
+    # the primary keys are indexed already
+    op.drop_index(op.f('ix_link_click_log_id'), table_name='link_click_log')
+    op.drop_index(op.f('ix_links_id'), table_name='links')
+    # nothing looks links up by long_url
+    op.drop_index(op.f('ix_links_long_url'), table_name='links')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.create_index(op.f('ix_links_long_url'), 'links', ['long_url'], unique=False)
+    op.create_index(op.f('ix_links_id'), 'links', ['id'], unique=False)
+    op.create_index(op.f('ix_link_click_log_id'), 'link_click_log', ['id'], unique=False)
+    op.create_index(op.f('ix_link_click_log_link_id'), 'link_click_log', ['link_id'], unique=False)
+    op.drop_index('ix_link_click_log_link_id_timestamp', table_name='link_click_log')
@@ -0,0 +1,112 @@
+"""
+Local stand-in for the Gemini API, for exercising alias suggestions without
+a real key or quota.
+
+    uv run python scripts/fake_genai_server.py --port 8090 --latency 0.5 --fail-rate 0.2
+
+then run the API with:
+
+    GOOGLE_API_KEY=fake GOOGLE_GENAI_BASE_URL=http://localhost:8090 uvicorn src.main:app
+
+`--fail-rate` makes a fraction of calls answer 429/503 so the retry and
+backoff path in `LLMLimiter` gets exercised.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+
+import fastapi
+import uvicorn
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = fastapi.FastAPI()
+settings = {"latency": 0.0, "fail_rate": 0.0}
+stats = {"calls": 0, "in_flight": 0, "max_in_flight": 0}
+
+WORDS = [
+    "learn", "guide", "docs", "intro", "basics", "howto", "tips", "notes",
+    "read", "start", "quick", "deep", "dive", "ref", "tour", "play",
+]
+
+
+def fake_names(prompt: str) -> list[str]:
+    match = re.search(r"Provide (\d+) suggestive names", prompt)
+    needed = int(match.group(1)) if match else 3
+    return [
+        f"{random.choice(WORDS)}-{random.choice(WORDS)}{random.randint(0, 999)}"
+        for _ in range(needed)
+    ]
+
+
+def candidate(text: str) -> dict:
+    return {
+        "content": {"role": "model", "parts": [{"text": text}]},
+        "finishReason": "STOP",
+    }
+
+
+async def simulate(body: dict):
+    stats["calls"] += 1
+    stats["in_flight"] += 1
+    stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+    try:
+        await asyncio.sleep(settings["latency"])
+    finally:
+        stats["in_flight"] -= 1
+    if random.random() < settings["fail_rate"]:
+        code = random.choice([429, 503])
+        return JSONResponse(
+            {"error": {"code": code, "message": "fake failure", "status": "UNAVAILABLE"}},
+            status_code=code,
+        )
+    prompt = "".join(
+        part.get("text", "")
+        for content in body.get("contents", [])
+        for part in content.get("parts", [])
+    )
+    return fake_names(prompt)
+
+
+@app.post("/{version}/models/{model_action}")
+async def models(version: str, model_action: str, request: fastapi.Request):
+    body = await request.json()
+    result = await simulate(body)
+    if isinstance(result, JSONResponse):
+        return result
+
+    payload = json.dumps({"suggested_names": result})
+    if model_action.endswith(":streamGenerateContent"):
+        # emit the JSON in small pieces, like the real streaming endpoint
+        async def events():
+            for i in range(0, len(payload), 12):
+                chunk = {"candidates": [candidate(payload[i : i + 12])]}
+                yield f"data: {json.dumps(chunk)}\r\n\r\n"
+                await asyncio.sleep(settings["latency"] / 10)
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return {"candidates": [candidate(payload)]}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    settings["latency"] = args.latency
+    settings["fail_rate"] = args.fail_rate
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import os
+import time
+
+from sqlalchemy.exc import InterfaceError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from src.metrics import metrics
+
+DB_BREAKER_ENABLED = os.getenv("DB_BREAKER_ENABLED", "1") == "1"
+# consecutive database failures that open the breaker
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "5"))
+# seconds the breaker stays open before one request may try the database again
+DB_BREAKER_RESET_TIMEOUT = float(os.getenv("DB_BREAKER_RESET_TIMEOUT", "10"))
+# a database call taking longer than this counts as a failure
+DB_CALL_TIMEOUT = float(os.getenv("DB_CALL_TIMEOUT", "5"))
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+metrics.counter(
+    "db_breaker_transitions_total", "Database circuit breaker state changes, by new state."
+)
+
+
+class DatabaseUnavailableError(Exception):
+    """Raised instead of calling the database while the breaker is open, or when a call failed."""
+
+
+def is_database_error(e: BaseException) -> bool:
+    """Errors that say the database is unreachable or too slow, as opposed to a bad request."""
+    return isinstance(
+        e, (OperationalError, InterfaceError, PoolTimeoutError, TimeoutError, OSError)
+    )
+
+
+class CircuitBreaker:
+    """
+    closed: calls go through, and `failures` consecutive database errors open it.
+    open: calls are refused for `reset_timeout` seconds.
+    half_open: one call goes through as a probe; success closes the
+    breaker, failure opens it again.
+    """
+
+    def __init__(self, failures: int, reset_timeout: float):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failed = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.state = state
+            metrics.inc("db_breaker_transitions_total", state=state)
+            print(f"Database circuit breaker {state}")
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._set_state("half_open")
+        if self._probing:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self):
+        self._failed = 0
+        self._probing = False
+        self._set_state("closed")
+
+    def abandon(self):
+        """The call was cancelled before it told us anything."""
+        self._probing = False
+
+    def record_failure(self):
+        self._failed += 1
+        self._probing = False
+        if self.state == "half_open" or self._failed >= self.failures:
+            self._opened_at = time.monotonic()
+            self._set_state("open")
@@ -0,0 +1,175 @@
+import math
+import os
+import time
+from collections import OrderedDict
+
+from src.metrics import metrics
+
+# seconds a missing short id is answered from memory. Only create_url in the
+# same process clears an entry, so with several workers or instances a new
+# link would 404 elsewhere until it expires: off (0) unless single-process
+NEGATIVE_CACHE_TTL = float(os.getenv("NEGATIVE_CACHE_TTL", "0"))
+NEGATIVE_CACHE_SIZE = int(os.getenv("NEGATIVE_CACHE_SIZE", "10000"))
+# recently followed links, served while the database is unavailable
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", "100000"))
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel: keys are filed under the tick they expire in, in
+    `slots` buckets (tick % slots), so scheduling, cancelling and expiring a
+    key are O(1) and `advance` only visits the buckets of the ticks that
+    passed. Keys due more than a full turn ahead stay in their bucket until
+    their turn comes round. Times are in whatever clock the caller uses.
+    """
+
+    def __init__(self, tick: float, slots: int, now: float):
+        self.tick = tick
+        self._buckets: list[set] = [set() for _ in range(slots)]
+        self._due: dict = {}
+        self._current = int(now / tick)
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def schedule(self, key, at: float):
+        self.cancel(key)
+        # rounded up, so a key never comes out before its time
+        due = max(math.ceil(at / self.tick), self._current + 1)
+        self._due[key] = due
+        self._buckets[due % len(self._buckets)].add(key)
+
+    def cancel(self, key):
+        due = self._due.pop(key, None)
+        if due is not None:
+            self._buckets[due % len(self._buckets)].discard(key)
+
+    def advance(self, now: float) -> list:
+        """Remove and return the keys due by `now`."""
+        target = int(now / self.tick)
+        if target <= self._current:
+            return []
+        expired = []
+        slots = len(self._buckets)
+        ticks = range(self._current + 1, target + 1)
+        if len(ticks) > slots:
+            ticks = range(target - slots + 1, target + 1)  # every bucket once
+        for tick in ticks:
+            bucket = self._buckets[tick % slots]
+            for key in [key for key in bucket if self._due[key] <= target]:
+                bucket.discard(key)
+                del self._due[key]
+                expired.append(key)
+        self._current = target
+        return expired
+
+
+class NegativeCache:
+    """
+    Bounded TTL set of short ids that were recently looked up and not found,
+    so repeated misses (scanners, typos) can be answered without a query.
+
+    Usage:
+
+        token = cache.token()
+        ... look the id up ...
+        if not found:
+            cache.add(short_id, token)
+
+    `discard` is called when an id gets taken. The token makes sure a lookup
+    that started before the discard cannot put the id back afterwards.
+    Entries are evicted when they expire by a timing wheel, instead of
+    lingering until they are looked up again or pushed out by newer ones.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expires: OrderedDict[str, float] = OrderedDict()
+        self._wheel = TimingWheel(max(ttl / 32, 0.05), 64, time.monotonic())
+        self._seq = 0
+        self._discarded: OrderedDict[str, int] = OrderedDict()
+
+    def _evict_expired(self, now: float):
+        for key in self._wheel.advance(now):
+            self._expires.pop(key, None)
+
+    def __contains__(self, key: str) -> bool:
+        now = time.monotonic()
+        self._evict_expired(now)
+        expires = self._expires.get(key)
+        # the wheel works in ticks, so check the exact time too
+        return expires is not None and expires >= now
+
+    def __len__(self) -> int:
+        return len(self._expires)
+
+    def token(self) -> int:
+        return self._seq
+
+    def add(self, key: str, token: int):
+        if self.ttl <= 0:
+            return  # disabled
+        if self._discarded.get(key, -1) >= token:
+            return  # taken while we were looking it up
+        now = time.monotonic()
+        self._evict_expired(now)
+        self._expires[key] = now + self.ttl
+        self._expires.move_to_end(key)
+        self._wheel.schedule(key, now + self.ttl)
+        while len(self._expires) > self.max_size:
+            self._wheel.cancel(self._expires.popitem(last=False)[0])
+
+    def discard(self, key: str):
+        self._expires.pop(key, None)
+        self._wheel.cancel(key)
+        self._discarded[key] = self._seq
+        self._discarded.move_to_end(key)
+        self._seq += 1
+        while len(self._discarded) > self.max_size:
+            self._discarded.popitem(last=False)
+
+
+class LinkCache:
+    """
+    Bounded LRU of link id -> long URL for links that were recently
+    followed. Links don't change, so an entry stays right until the link
+    expires; `expires_at` (unix seconds) entries are evicted then by a
+    timing wheel. Links limited by max_clicks must not be put here.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._links: OrderedDict[str, tuple[str, float | None]] = OrderedDict()
+        self._wheel = TimingWheel(1.0, 3600, time.time())
+
+    def __len__(self) -> int:
+        return len(self._links)
+
+    def get(self, link_id: str) -> str | None:
+        now = time.time()
+        for key in self._wheel.advance(now):
+            self._links.pop(key, None)
+        entry = self._links.get(link_id)
+        if entry is None or (entry[1] is not None and entry[1] <= now):
+            return None
+        self._links.move_to_end(link_id)
+        return entry[0]
+
+    def put(self, link_id: str, long_url: str, expires_at: float | None = None):
+        self._links[link_id] = (long_url, expires_at)
+        self._links.move_to_end(link_id)
+        if expires_at is not None:
+            self._wheel.schedule(link_id, expires_at)
+        else:
+            self._wheel.cancel(link_id)
+        while len(self._links) > self.max_size:
+            self._wheel.cancel(self._links.popitem(last=False)[0])
+
+
+missing_link_ids = NegativeCache(NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_SIZE)
+metrics.gauge(
+    "negative_cache_entries",
+    "Short ids currently cached as not found.",
+    lambda: len(missing_link_ids),
+)
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import time
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from src.metrics import metrics
+from src.models import Link, LinkClickLog
+
+# log clicks in batches instead of one INSERT per redirect; the click
+# counter itself is still updated by the redirect
+CLICK_BUFFER_ENABLED = os.getenv("CLICK_BUFFER_ENABLED", "0") == "1"
+# flush when this many clicks are waiting, or every CLICK_BUFFER_INTERVAL seconds
+CLICK_BUFFER_SIZE = int(os.getenv("CLICK_BUFFER_SIZE", "1000"))
+CLICK_BUFFER_INTERVAL = float(os.getenv("CLICK_BUFFER_INTERVAL", "1"))
+# while flushes fail, the oldest clicks beyond this are dropped
+CLICK_BUFFER_MAX = int(os.getenv("CLICK_BUFFER_MAX", "100000"))
+
+# link_click_log columns written per click, in record order
+CLICK_COLUMNS = ("link_id", "click_ip", "timestamp", "user_agent")
+
+
+metrics.counter("click_rows_written_total", "Click log rows written in bulk, by method.")
+metrics.counter("click_rows_dropped_total", "Buffered clicks dropped, by reason.")
+metrics.histogram("click_flush_seconds", "Time to write one batch of click log rows.")
+
+
+async def insert_click_rows(conn: AsyncConnection, rows: list[tuple]) -> str:
+    """
+    Write (link_id, click_ip, timestamp, user_agent) records to
+    link_click_log on `conn` and return the method used. On asyncpg that is
+    a binary COPY (copy_records_to_table), which skips statement parsing and
+    per-row parameters; everything else gets one executemany INSERT. The
+    caller commits.
+    """
+    if conn.dialect.driver == "asyncpg":
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            LinkClickLog.__tablename__, records=rows, columns=CLICK_COLUMNS
+        )
+        method = "copy"
+    else:
+        await conn.execute(insert(LinkClickLog), [dict(zip(CLICK_COLUMNS, row)) for row in rows])
+        method = "executemany"
+    metrics.inc("click_rows_written_total", len(rows), method=method)
+    return method
+
+
+class ClickBuffer:
+    """
+    Click log rows waiting to be written. `add` only appends to a list; `run`
+    writes them with insert_click_rows in one transaction per batch, every
+    `interval` seconds or as soon as `size` are waiting. A failed batch is
+    kept for the next flush (up to `max_pending` clicks in total), and a
+    final flush happens when `run` is cancelled.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        size: int = CLICK_BUFFER_SIZE,
+        interval: float = CLICK_BUFFER_INTERVAL,
+        max_pending: int = CLICK_BUFFER_MAX,
+    ):
+        self.engine = engine
+        self.size = size
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: list[tuple] = []
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, link_id: str, ip: str | None, timestamp, user_agent: str | None):
+        self._pending.append((link_id, ip, timestamp, user_agent))
+        if len(self._pending) >= self.size:
+            self._full.set()
+
+    def _keep(self, rows: list[tuple]):
+        self._pending[:0] = rows
+        overflow = len(self._pending) - self.max_pending
+        if overflow > 0:
+            del self._pending[:overflow]
+            metrics.inc("click_rows_dropped_total", overflow, reason="overflow")
+
+    async def _write(self, rows: list[tuple]) -> int:
+        async with self.engine.connect() as conn:
+            await insert_click_rows(conn, rows)
+            await conn.commit()
+        return len(rows)
+
+    async def _write_existing(self, rows: list[tuple]) -> int:
+        """Write the rows whose link still exists; returns how many that was."""
+        # a link can be reaped (see src/expiry.py) while its clicks wait here
+        link_ids = list({row[0] for row in rows})
+        async with self.engine.connect() as conn:
+            existing = set(
+                (await conn.execute(select(Link.id).where(Link.id.in_(link_ids)))).scalars()
+            )
+        kept = [row for row in rows if row[0] in existing]
+        if len(kept) < len(rows):
+            metrics.inc("click_rows_dropped_total", len(rows) - len(kept), reason="deleted_link")
+        if not kept:
+            return 0
+        return await self._write(kept)
+
+    async def flush(self) -> int:
+        """Write everything pending; returns the number of rows written."""
+        async with self._flush_lock:
+            written = 0
+            while self._pending:
+                rows, self._pending = self._pending[: self.size], self._pending[self.size :]
+                if len(self._pending) < self.size:
+                    self._full.clear()
+                start = time.perf_counter()
+                try:
+                    try:
+                        written += await self._write(rows)
+                    except Exception:
+                        written += await self._write_existing(rows)
+                except Exception:
+                    self._keep(rows)
+                    raise
+                finally:
+                    metrics.observe("click_flush_seconds", time.perf_counter() - start)
+            return written
+
+    async def run(self):
+        self._full = asyncio.Event()  # bound to the running loop
+        if len(self._pending) >= self.size:
+            self._full.set()
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                try:
+                    await self.flush()
+                except Exception as e:
+                    print(f"Failed to flush {len(self._pending)} buffered clicks: {e}")
+                    await asyncio.sleep(self.interval)
+        finally:
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Failed to flush {len(self._pending)} buffered clicks on shutdown: {e}")
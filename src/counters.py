@@ -0,0 +1,127 @@
+import asyncio
+import os
+
+from sqlalchemy import String, bindparam, func, literal_column, select, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.metrics import metrics
+from src.models import Link, LinkClickShard
+
+# spread each link's click counter over this many link_click_shards rows
+# (1 = off). Links with max_clicks always use the single row, since the
+# limit is checked by the statement that counts
+CLICK_COUNTER_SHARDS = int(os.getenv("CLICK_COUNTER_SHARDS", "1"))
+# fold the shards back into links.clicks this often, this many rows at a time
+CLICK_SHARD_COMPACT_INTERVAL = float(os.getenv("CLICK_SHARD_COMPACT_INTERVAL", "30"))
+CLICK_SHARD_COMPACT_BATCH = int(os.getenv("CLICK_SHARD_COMPACT_BATCH", "5000"))
+
+
+metrics.counter("click_shards_compacted_total", "Counter shard rows folded into links.clicks.")
+
+
+def shard_increment(dialect: str):
+    """
+    Upsert adding one click to shard `b_shard` of link `b_link_id`, with
+    `b_ip` as its last_ip. Callers pick a random shard per click, so two
+    clicks only wait on each other when they pick the same one.
+    """
+    insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    statement = insert(LinkClickShard).values(
+        link_id=bindparam("b_link_id"),
+        shard=bindparam("b_shard"),
+        clicks=1,
+        last_ip=bindparam("b_ip", type_=String),
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[LinkClickShard.link_id, LinkClickShard.shard],
+        set_={
+            # inline, not a bind parameter: the conflict clause doesn't render
+            # literal binds, which benchmarks.scenarios needs to EXPLAIN it
+            "clicks": LinkClickShard.clicks + literal_column("1"),
+            "last_ip": statement.excluded.last_ip,
+            "updated_at": func.now(),
+        },
+    )
+
+
+def sharded_clicks(link_id_column):
+    """Scalar subqueries for the unfolded clicks and the latest last_ip of a link."""
+    clicks = (
+        select(func.coalesce(func.sum(LinkClickShard.clicks), 0))
+        .where(LinkClickShard.link_id == link_id_column)
+        .scalar_subquery()
+    )
+    last_ip = (
+        select(LinkClickShard.last_ip)
+        .where(LinkClickShard.link_id == link_id_column)
+        .order_by(LinkClickShard.updated_at.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    return clicks, last_ip
+
+
+async def compact_click_shards(engine: AsyncEngine, batch: int = CLICK_SHARD_COMPACT_BATCH) -> int:
+    """
+    Move up to `batch` shard rows into links.clicks (and last_ip)
+    and return how many. The shards are deleted and read back by the same
+    statement, so a click racing with it lands either in the fold or in a
+    new shard row, never in neither.
+    """
+    async with engine.connect() as conn:
+        # SKIP LOCKED: shards a redirect is incrementing right now wait for the next run
+        keys = (
+            select(LinkClickShard.link_id, LinkClickShard.shard)
+            .limit(batch)
+            .with_for_update(skip_locked=True)
+        )
+        rows = (
+            await conn.execute(
+                LinkClickShard.__table__.delete()
+                .where(tuple_(LinkClickShard.link_id, LinkClickShard.shard).in_(keys))
+                .returning(
+                    LinkClickShard.link_id,
+                    LinkClickShard.clicks,
+                    LinkClickShard.last_ip,
+                    LinkClickShard.updated_at,
+                )
+            )
+        ).all()
+        if not rows:
+            return 0
+        folded: dict[str, list] = {}
+        for link_id, clicks, last_ip, updated_at in rows:
+            entry = folded.setdefault(link_id, [0, last_ip, updated_at])
+            entry[0] += clicks
+            if updated_at >= entry[2]:
+                entry[1], entry[2] = last_ip, updated_at
+        await conn.execute(
+            update(Link)
+            .where(Link.id == bindparam("b_link_id"))
+            .values(
+                clicks=Link.clicks + bindparam("b_clicks"),
+                last_ip=func.coalesce(bindparam("b_last_ip", type_=String), Link.last_ip),
+            ),
+            [
+                {"b_link_id": link_id, "b_clicks": clicks, "b_last_ip": last_ip}
+                for link_id, (clicks, last_ip, _) in folded.items()
+            ],
+        )
+        await conn.commit()
+    metrics.inc("click_shards_compacted_total", len(rows))
+    return len(rows)
+
+
+async def keep_compacting(
+    engine: AsyncEngine,
+    interval: float = CLICK_SHARD_COMPACT_INTERVAL,
+    batch: int = CLICK_SHARD_COMPACT_BATCH,
+):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            while await compact_click_shards(engine, batch) >= batch:
+                await asyncio.sleep(0)  # let requests in between batches
+        except Exception as e:
+            print(f"Failed to compact click counter shards: {e}")
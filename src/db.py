@@ -9,16 +9,46 @@ from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, Asyn
 dotenv.load_dotenv()
 
 db_url = os.getenv("DATABASE_URL")
-if db_url is None:
-    raise EnvironmentError("DATABASE_URL not set in environment variables")
+
+# echo logs every statement synchronously; src/querylog.py logs the slow ones
+db_echo = os.getenv("DB_ECHO", "0") == "1"
+# connections kept open per process. asyncpg keeps its prepared statements
+# per connection, so the pool keeps those too. 0 opens a new connection for
+# every checkout (NullPool), e.g. for a transaction-mode PgBouncer
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "10"))
+# seconds before a pooled connection is replaced, ahead of server and proxy idle timeouts
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# test each connection on checkout; catches the ones a frozen or idle process
+# held while the server or a proxy closed them
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") == "1"
 
 Base = declarative_base()
-async_engine = create_async_engine(db_url, echo=True, future=True, poolclass=NullPool)
+pool_options = (
+    {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_POOL_MAX_OVERFLOW,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if DB_POOL_SIZE > 0
+    else {"poolclass": NullPool}
+)
+# None without DATABASE_URL, e.g. with STORAGE_BACKEND=sqlite or memory (see src/storage.py)
+async_engine = (
+    create_async_engine(db_url, echo=db_echo, future=True, **pool_options)
+    if db_url
+    else None
+)
+async_session_factory = (
+    async_sessionmaker(bind=async_engine, expire_on_commit=False)
+    if async_engine is not None
+    else None
+)
 
 
 async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
-    async with async_sessionmaker(
-        bind=async_engine,
-        expire_on_commit=False,
-    )() as session:
+    if async_session_factory is None:
+        raise EnvironmentError("DATABASE_URL not set in environment variables")
+    async with async_session_factory() as session:
         yield session
@@ -0,0 +1,46 @@
+import asyncio
+import os
+
+from src.metrics import metrics
+from src.storage import LinkStore, utc_now
+
+# reap links past their expires_at (or their last allowed click) in the
+# background, EXPIRY_SWEEP_BATCH per transaction every EXPIRY_SWEEP_INTERVAL seconds
+EXPIRY_SWEEP_ENABLED = os.getenv("EXPIRY_SWEEP_ENABLED", "1") == "1"
+EXPIRY_SWEEP_INTERVAL = float(os.getenv("EXPIRY_SWEEP_INTERVAL", "60"))
+EXPIRY_SWEEP_BATCH = int(os.getenv("EXPIRY_SWEEP_BATCH", "500"))
+
+
+metrics.counter("expired_links_reaped_total", "Expired links deleted by the sweeper.")
+
+
+async def sweep_expired_links(store: LinkStore, batch: int = EXPIRY_SWEEP_BATCH) -> int:
+    """
+    Delete every link that has expired so far, `batch` at a time, and return
+    how many went. Each batch is its own short transaction, walking the
+    partial index on expires_at, so the sweep never holds many rows locked.
+    """
+    now = utc_now()
+    reaped = 0
+    while True:
+        link_ids = await store.delete_expired(now, batch)
+        reaped += len(link_ids)
+        metrics.inc("expired_links_reaped_total", len(link_ids))
+        if len(link_ids) < batch:
+            return reaped
+        await asyncio.sleep(0)  # let requests in between batches
+
+
+async def keep_sweeping(
+    store: LinkStore,
+    interval: float = EXPIRY_SWEEP_INTERVAL,
+    batch: int = EXPIRY_SWEEP_BATCH,
+):
+    while True:
+        try:
+            reaped = await sweep_expired_links(store, batch)
+            if reaped:
+                print(f"Reaped {reaped} expired links")
+        except Exception as e:
+            print(f"Failed to sweep expired links: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import math
+import os
+import time
+
+from src.storage import link_store
+
+ALIAS_FILTER_ENABLED = os.getenv("ALIAS_FILTER_ENABLED", "1") == "1"
+ALIAS_FILTER_FP_RATE = float(os.getenv("ALIAS_FILTER_FP_RATE", "0.01"))
+# other instances create links too, so the filter is rebuilt periodically
+ALIAS_FILTER_REFRESH = float(os.getenv("ALIAS_FILTER_REFRESH", "60"))
+# past this age (e.g. when rebuilds keep failing) misses are no longer trusted
+ALIAS_FILTER_MAX_AGE = float(os.getenv("ALIAS_FILTER_MAX_AGE", "90"))
+
+
+class BloomFilter:
+    """Plain bit-array Bloom filter using double hashing of a blake2b digest."""
+
+    def __init__(self, capacity: int, fp_rate: float):
+        capacity = max(capacity, 1024)
+        self.size = max(8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class LinkIdFilter:
+    """
+    In-memory membership filter over every link id in the link store.
+
+    A miss means the id is definitely not taken (as of the last rebuild plus
+    the links created by this process), so availability checks can skip the
+    store. A hit only means "maybe", and has to be confirmed by the store.
+    Until the first rebuild finishes every id is a "maybe".
+
+    Links created by other instances only show up after the next rebuild,
+    so a filter older than `max_age` seconds (counted from the start of its
+    rebuild) answers "maybe" for everything, like one that is not built yet.
+    That bounds how long such a link can look available; create_url still
+    checks the store, so a taken one is never handed out.
+    """
+
+    def __init__(self, fp_rate: float, max_age: float):
+        self.fp_rate = fp_rate
+        self.max_age = max_age
+        self._bloom: BloomFilter | None = None
+        self._built_at = 0.0
+        self._added_during_rebuild: list[str] | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self._bloom is not None and time.monotonic() - self._built_at <= self.max_age
+
+    def might_exist(self, link_id: str) -> bool:
+        return not self.ready or link_id in self._bloom
+
+    def add(self, link_id: str):
+        if self._added_during_rebuild is not None:
+            self._added_during_rebuild.append(link_id)
+        if self._bloom is not None:
+            if self._bloom.count >= self._bloom.capacity:
+                # past capacity the false positive rate climbs quickly
+                self._bloom = None
+                return
+            self._bloom.add(link_id)
+
+    async def rebuild(self):
+        self._added_during_rebuild = []
+        started = time.monotonic()
+        try:
+            total = await link_store.count_links()
+            # leave room to grow until the next rebuild
+            bloom = BloomFilter(total * 2, self.fp_rate)
+            async for link_id in link_store.iter_link_ids():
+                bloom.add(link_id)
+            for link_id in self._added_during_rebuild:
+                bloom.add(link_id)
+            self._bloom = bloom
+            self._built_at = started
+        finally:
+            self._added_during_rebuild = None
+
+    async def keep_fresh(self, interval: float):
+        while True:
+            try:
+                await self.rebuild()
+            except Exception as e:
+                print(f"Failed to rebuild link id filter: {e}")
+            await asyncio.sleep(interval)
+
+
+link_id_filter = LinkIdFilter(ALIAS_FILTER_FP_RATE, ALIAS_FILTER_MAX_AGE)
@@ -1,30 +1,140 @@
-from datetime import datetime
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 import fastapi
+import httpx
+import json
+import logging
+from google.genai import errors as genai_errors
 from pydantic import AnyHttpUrl
-from sqlalchemy import select, update
 import time
 import hashlib
 import random
 from fastapi.middleware.cors import CORSMiddleware
-from bs4 import BeautifulSoup
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
 from src.schemas import (
     ErrorResponse,
     LinkAliasAvailabilityResponse,
+    LinkAliasBatchAvailabilityResponse,
+    LinkAliasBatchCheck,
     LinkAliasSuggestionResponse,
     LinkCreate,
     LinkMetadataResponse,
     LinkResponse,
     LinkRedirectResponse,
-    LinkShortUrlSuggestionsResponse,
     LinkURLExistenceResponse,
 )
-from src.db import get_async_session, AsyncSession
-from src.models import Link, LinkClickLog, LinkMetadata
+from src.breaker import DatabaseUnavailableError
+from src.cache import missing_link_ids
+from src.counters import keep_compacting
+from src.db import async_engine
+from src.expiry import EXPIRY_SWEEP_ENABLED, keep_sweeping
+from src.filters import ALIAS_FILTER_ENABLED, ALIAS_FILTER_REFRESH, link_id_filter
+from src.metrics import METRICS_ENABLED, MetricsMiddleware, install_engine_hooks, metrics
+from src.profiler import (
+    LOOP_MONITOR_ENABLED,
+    PROFILE_MAX_SECONDS,
+    ProfilerBusyError,
+    check_admin_token,
+    loop_monitor,
+    memory_tracker,
+    profiler,
+)
+from src.querylog import QUERY_LOG_ENABLED, install_query_log
+from src.spool import keep_replaying
+from src.storage import (
+    LINK_SNAPSHOT_REFRESH,
+    STORAGE_BACKEND,
+    Click,
+    LinkExistsError,
+    LinkStore,
+    click_buffer,
+    click_spool,
+    db_breaker,
+    get_link_store,
+    link_snapshot_store,
+    link_store,
+    utc_now,
+)
+from src.suggest import (
+    ALIAS_SUGGEST_LLM_BUDGET,
+    ALIAS_SUGGEST_MODE,
+    LLMEmptyError,
+    available_aliases,
+    collect_llm_aliases,
+    fetch_page,
+    parse_page,
+    stream_llm_aliases,
+    suggest_local_aliases,
+)
+from src.tracing import TRACING_ENABLED, TracingMiddleware, trace_exporter
+from src.utils import LLMBusyError, close_genai_client
 
-from src.utils import PROMPT, get_genai_client
+logger = logging.getLogger(__name__)
 
-app = fastapi.FastAPI(root_path="/api")
+
+@asynccontextmanager
+async def lifespan(app: fastapi.FastAPI):
+    filter_refresh = None
+    if ALIAS_FILTER_ENABLED:
+        # built in the background; until it is ready every alias is a "maybe"
+        filter_refresh = asyncio.create_task(
+            link_id_filter.keep_fresh(ALIAS_FILTER_REFRESH)
+        )
+    trace_export = None
+    if trace_exporter.enabled:
+        trace_export = asyncio.create_task(trace_exporter.run())
+    loop_monitoring = None
+    if LOOP_MONITOR_ENABLED:
+        loop_monitoring = asyncio.create_task(loop_monitor.run())
+    snapshot_refresh = None
+    if link_snapshot_store is not None:
+        snapshot_refresh = asyncio.create_task(
+            link_snapshot_store.keep_fresh(LINK_SNAPSHOT_REFRESH)
+        )
+    expiry_sweep = None
+    if EXPIRY_SWEEP_ENABLED:
+        expiry_sweep = asyncio.create_task(keep_sweeping(link_store))
+    shard_compaction = None
+    if STORAGE_BACKEND == "sqlalchemy" and async_engine is not None:
+        # also folds what is left after CLICK_COUNTER_SHARDS is turned off
+        shard_compaction = asyncio.create_task(keep_compacting(async_engine))
+    click_flush = None
+    if click_buffer is not None:
+        click_flush = asyncio.create_task(click_buffer.run())
+    spool_sync = spool_replay = None
+    if click_spool is not None:
+        spool_sync = asyncio.create_task(click_spool.run())
+        spool_replay = asyncio.create_task(keep_replaying(click_spool, async_engine))
+    yield
+    if shard_compaction:
+        shard_compaction.cancel()
+    if spool_replay:
+        # what is left stays on disk for the next start
+        spool_replay.cancel()
+        spool_sync.cancel()
+        await asyncio.gather(spool_replay, spool_sync, return_exceptions=True)
+        click_spool.close()
+    if click_flush:
+        click_flush.cancel()  # flushes what is left
+        await asyncio.gather(click_flush, return_exceptions=True)
+    if expiry_sweep:
+        expiry_sweep.cancel()
+    if snapshot_refresh:
+        snapshot_refresh.cancel()
+    if loop_monitoring:
+        loop_monitoring.cancel()
+    if filter_refresh:
+        filter_refresh.cancel()
+    if trace_export:
+        trace_export.cancel()  # flushes what is left
+        await asyncio.gather(trace_export, return_exceptions=True)
+    await close_genai_client()
+    await link_store.close()
+
+
+app = fastapi.FastAPI(root_path="/api", lifespan=lifespan)
 
 # Handle CORS
 app.add_middleware(
@@ -35,6 +145,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if TRACING_ENABLED:
+    app.add_middleware(TracingMiddleware)
+
+if METRICS_ENABLED:
+    # added last so it wraps everything, CORS included
+    app.add_middleware(MetricsMiddleware)
+    if async_engine is not None:
+        install_engine_hooks(async_engine)
+
+if QUERY_LOG_ENABLED and async_engine is not None:
+    install_query_log(async_engine)
+
+
+@app.exception_handler(DatabaseUnavailableError)
+async def database_unavailable(request: fastapi.Request, e: DatabaseUnavailableError):
+    # raised right away while the circuit breaker is open, see src/breaker.py
+    return JSONResponse(
+        status_code=503,
+        content={"error": "DB_UNAVAILABLE", "message": str(e)},
+        headers={"Retry-After": str(int(db_breaker.reset_timeout)) if db_breaker else "10"},
+    )
+
 
 def get_hash(str: str):
     return hashlib.md5(str.encode()).hexdigest()
@@ -51,92 +183,79 @@ def random_phrase(n_chars):
 @app.post("/url/create", response_model=LinkResponse | ErrorResponse)
 async def create_url(
     link: LinkCreate,
-    sql_db: AsyncSession = fastapi.Depends(get_async_session),
+    store: LinkStore = fastapi.Depends(get_link_store),
 ):
     long_url = link.long_url
     custom_name = link.name.strip() if link.name else None
+    expires_at = link.expires_at
+    if expires_at is not None:
+        # stored as naive UTC
+        if expires_at.tzinfo is not None:
+            expires_at = expires_at.astimezone(timezone.utc).replace(tzinfo=None)
+        if expires_at <= utc_now():
+            return {"error": "BAD_REQUEST", "message": "expires_at must be in the future"}
 
     hashed_long_url = get_hash(
         str(time.time()) + long_url.encoded_string() + random_phrase(20)
     )
     hashed_string = hashed_long_url[:8]
 
-    sql_db_link = await sql_db.execute(
-        select(Link).where(Link.id == (custom_name if custom_name else hashed_string))
-    )
-    existing_link = sql_db_link.scalars().one_or_none()
-
-    if custom_name and existing_link:
-        return {
-            "error": "BAD_REQUEST",
-            "reason": "Name already occupied, try a different name",
-        }
-    elif existing_link:  # this is quite rare, but still can happen.. so instead of generating a new hash, we just extend the hash.
-        hashed_string = hashed_long_url[: random.randint(9, 12)]
-
     url_id = custom_name if custom_name else hashed_string
-
-    new_link = Link(id=url_id, long_url=str(long_url))
-
-    new_metadata = LinkMetadata(
-        link_id=url_id,
-        name=custom_name if custom_name else "",
-        long_url=str(long_url),
-        clicks=0,
-        last_ip=None,
-    )
-
-    sql_db.add(new_link)
-    sql_db.add(new_metadata)
-    await sql_db.commit()
-    await sql_db.refresh(new_link)
-    await sql_db.refresh(new_metadata)
+    try:
+        new_link = await store.create_link(
+            url_id, str(long_url), custom_name or "", expires_at, link.max_clicks
+        )
+    except LinkExistsError:
+        if custom_name:
+            return {
+                "error": "BAD_REQUEST",
+                "message": "Name already occupied, try a different name",
+            }
+        # this is quite rare, but still can happen.. so instead of generating a new hash, we just extend the hash.
+        url_id = hashed_long_url[: random.randint(9, 12)]
+        new_link = await store.create_link(
+            url_id, str(long_url), expires_at=expires_at, max_clicks=link.max_clicks
+        )
+    link_id_filter.add(url_id)
+    missing_link_ids.discard(url_id)
 
     # return the Link
     return LinkResponse(
         shortened_url=new_link.id,
         long_url=AnyHttpUrl(new_link.long_url),
         metadata=LinkMetadataResponse(
-            custom_name=new_metadata.name if new_metadata.name != "" else None,
-            clicks=new_metadata.clicks,
-            last_ip=new_metadata.last_ip,
+            custom_name=new_link.name if new_link.name != "" else None,
+            clicks=new_link.clicks,
+            last_ip=new_link.last_ip,
+            expires_at=new_link.expires_at,
+            max_clicks=new_link.max_clicks,
         ),
     )
 
 
-@app.get("/url/{short_url_id}/metadata", response_model=LinkResponse)
+@app.get("/url/{short_url_id}/metadata", response_model=LinkResponse | ErrorResponse)
 async def get_shortened_url_metadata(
-    short_url_id: str, sql_db: AsyncSession = fastapi.Depends(get_async_session)
+    short_url_id: str, store: LinkStore = fastapi.Depends(get_link_store)
 ):
-    link = (
-        (await sql_db.execute(select(Link).where(Link.id == short_url_id)))
-        .scalars()
-        .one_or_none()
-    )
-
-    if not link:
+    if short_url_id in missing_link_ids:
         return {"error": "NOT_FOUND", "message": "The requested URL was not found"}
 
-    metadata = (
-        (
-            await sql_db.execute(
-                select(LinkMetadata).where(LinkMetadata.link_id == short_url_id)
-            )
-        )
-        .scalars()
-        .one_or_none()
-    )
+    token = missing_link_ids.token()
+    link = await store.get_link(short_url_id)
 
-    if not metadata:
-        raise AttributeError("Metadata entry not found for the given link ID")
+    if not link:
+        missing_link_ids.add(short_url_id, token)
+        return {"error": "NOT_FOUND", "message": "The requested URL was not found"}
 
     return LinkResponse(
         shortened_url=link.id,
         long_url=AnyHttpUrl(link.long_url),
         metadata=LinkMetadataResponse(
-            custom_name=metadata.name if metadata.name != "" else None,
-            clicks=metadata.clicks,
-            last_ip=metadata.last_ip,
+            custom_name=link.name if link.name != "" else None,
+            clicks=link.clicks,
+            last_ip=link.last_ip,
+            expires_at=link.expires_at,
+            max_clicks=link.max_clicks,
         ),
     )
 
@@ -145,46 +264,37 @@ async def get_shortened_url_metadata(
 async def redirect_url(
     url: str,
     req: fastapi.Request,
-    sql_db: AsyncSession = fastapi.Depends(get_async_session),
+    store: LinkStore = fastapi.Depends(get_link_store),
 ):
     req_client = req.client
     ipaddr = None
     if req_client:
         ipaddr = req_client.host
 
-    link = (
-        (await sql_db.execute(select(Link).where(Link.id == url)))
-        .scalars()
-        .one_or_none()
-    )
-
-    if not link:
+    if url in missing_link_ids:
         return {
             "error": "NOT_FOUND",
             "message": "The requested URL was not found",
             "redirect_to": "/404",
         }
 
-    # update click log
-    new_log = LinkClickLog(
-        link_id=url,
-        click_ip=ipaddr,
-        timestamp=datetime.now(),
-        user_agent=req.headers.get("user-agent", "unknown"),
-    )
-
-    # update the metadata clicks count
-    metadata = await sql_db.execute(
-        update(LinkMetadata)
-        .values(clicks=LinkMetadata.clicks + 1, last_ip=ipaddr)
-        .where(LinkMetadata.link_id == url)
+    token = missing_link_ids.token()
+    link = await store.follow_link(
+        Click(
+            link_id=url,
+            ip=ipaddr,
+            user_agent=req.headers.get("user-agent", "unknown"),
+            timestamp=datetime.now(),
+        )
     )
-    if not metadata:
-        raise AttributeError("Metadata entry not found for the given link ID")
 
-    sql_db.add(new_log)
-    await sql_db.commit()
-    await sql_db.refresh(new_log)
+    if not link:
+        missing_link_ids.add(url, token)
+        return {
+            "error": "NOT_FOUND",
+            "message": "The requested URL was not found",
+            "redirect_to": "/404",
+        }
 
     return {"message": "Redirecting...", "long_url": link.long_url}
 
@@ -193,113 +303,224 @@ async def redirect_url(
 async def suggest_alias(
     long_url: str,
     count: int = 3,
-    sql_db: AsyncSession = fastapi.Depends(get_async_session),
+    mode: str | None = None,
+    store: LinkStore = fastapi.Depends(get_link_store),
 ):
     if count > 10:
         return {
             "error": "BAD_REQUEST",
-            "reason": "Count must be less than or equal to 10",
+            "message": "Count must be less than or equal to 10",
+        }
+    mode = mode or ALIAS_SUGGEST_MODE
+    if mode not in ("local", "llm", "hybrid"):
+        return {
+            "error": "BAD_REQUEST",
+            "message": "Mode must be one of local, llm or hybrid",
         }
 
-    # fetch metadata from the URL (title, description, etc.)
-    import httpx
+    time_taken = time.time()
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/143.0.0.0 Safari/537.36 Edg/143.0.0.0"
-    }
+    if mode == "local":
+        aliases = await suggest_local_aliases(store, long_url, count)
+        return {
+            "suggested_aliases": aliases,
+            "time_taken": time.time() - time_taken,
+            "source": "local",
+        }
 
+    # fetch metadata from the URL (title, description, etc.)
     try:
-        resp = httpx.get(long_url, timeout=5.0, follow_redirects=True, headers=headers)
+        resp = await fetch_page(long_url)
         if resp.status_code >= 400:
+            raise httpx.HTTPStatusError(
+                f"status {resp.status_code}", request=resp.request, response=resp
+            )
+    except httpx.HTTPError as e:
+        if mode == "hybrid":
+            aliases = await suggest_local_aliases(store, long_url, count)
             return {
-                "error": "NOT_FOUND",
-                "message": "The provided URL does not exist." + resp.text,
+                "suggested_aliases": aliases,
+                "time_taken": time.time() - time_taken,
+                "source": "local",
             }
-    except httpx.RequestError as e:
         return {
             "error": "NOT_FOUND",
             "message": "The provided URL does not exist or is unreachable. " + str(e),
         }
-    
-    
 
-    client = await get_genai_client()
-    parsed_text = BeautifulSoup(resp.text, "html.parser").get_text(strip=True)
-    print(parsed_text[:500], "Parsed text preview")
+    title, parsed_text = parse_page(resp.text)
 
-    time_taken = time.time()
-    # TODO: Integrate with AI as soon as possible
-    aliases = set()
-
-    while len(aliases) < count:
-        need = count - len(aliases)
-        print("parsed_text length:", len(parsed_text), parsed_text[:100])
-        ai_resp = await client.aio.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=[
-                PROMPT.format(
-                    url=long_url, text=parsed_text[:5000], needed=int(need * 2)
-                )  # take first 5000 chars only from the page, double the needed count to avoid duplicates
-            ],
-            config={
-                "response_mime_type": "application/json",
-                "response_schema": LinkShortUrlSuggestionsResponse,
-            },
+    if mode == "hybrid":
+        # the local answer is ready in milliseconds; give the LLM whatever is
+        # left of the budget to come up with something better
+        local_aliases = await suggest_local_aliases(
+            store, long_url, count, title, parsed_text
         )
+        remaining = ALIAS_SUGGEST_LLM_BUDGET - (time.time() - time_taken)
+        try:
+            aliases = await asyncio.wait_for(
+                collect_llm_aliases(store, long_url, parsed_text, count),
+                max(remaining, 0),
+            )
+            source = "llm"
+        except (asyncio.TimeoutError, LLMBusyError, LLMEmptyError):
+            aliases, source = local_aliases, "local"
+        except (genai_errors.APIError, httpx.HTTPError, EnvironmentError) as e:
+            # a model error, an unreachable model or a missing API key (see
+            # get_genai_client): still a case for the local answer
+            logger.warning("LLM alias suggestions failed, answering with local ones: %r", e)
+            aliases, source = local_aliases, "local"
+        return {
+            "suggested_aliases": aliases,
+            "time_taken": time.time() - time_taken,
+            "source": source,
+        }
 
-        parsed = LinkShortUrlSuggestionsResponse.model_validate(ai_resp.parsed)
-        if not parsed.suggested_names:
-            return {
-                "error": "AI_ERROR",
-                "message": "Failed to generate alias suggestions from AI",
-            }
-        batch = set(parsed.suggested_names)
-
-        existing = (
-            await sql_db.execute(select(Link.id).where(Link.id.in_(batch)))
-        ).scalars()
-        batch -= set(existing)  # remove conflicts already in DB
-        aliases.update(batch)
-
-    time_taken = time.time() - time_taken
+    try:
+        aliases = await collect_llm_aliases(store, long_url, parsed_text, count)
+    except LLMBusyError as e:
+        return {"error": "AI_BUSY", "message": str(e)}
+    except LLMEmptyError:
+        return {
+            "error": "AI_ERROR",
+            "message": "Failed to generate alias suggestions from AI",
+        }
 
     return {
-        "suggested_aliases": list(aliases)[:count],  # return only the requested count
-        "time_taken": time_taken,
+        "suggested_aliases": aliases,
+        "time_taken": time.time() - time_taken,
+        "source": "llm",
     }
 
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/alias/suggest/stream", response_model=None)
+async def suggest_alias_stream(
+    long_url: str,
+    count: int = 3,
+    mode: str | None = None,
+    store: LinkStore = fastapi.Depends(get_link_store),
+):
+    """
+    Server-Sent Events variant of /alias/suggest. Every alias is sent as an
+    `alias` event as soon as it is known to be available, followed by a
+    single `done` (or `error`) event.
+    """
+    if count > 10:
+        return {
+            "error": "BAD_REQUEST",
+            "message": "Count must be less than or equal to 10",
+        }
+    mode = mode or ALIAS_SUGGEST_MODE
+    if mode not in ("local", "llm", "hybrid"):
+        return {
+            "error": "BAD_REQUEST",
+            "message": "Mode must be one of local, llm or hybrid",
+        }
+
+    async def events():
+        time_taken = time.time()
+        sent: set[str] = set()
+
+        try:
+            if mode in ("local", "hybrid"):
+                for alias in await suggest_local_aliases(store, long_url, count):
+                    sent.add(alias)
+                    yield sse_event("alias", {"alias": alias, "source": "local"})
+
+            # hybrid: the LLM only tops the local aliases up to `count`
+            if mode in ("llm", "hybrid") and len(sent) < count:
+                resp = await fetch_page(long_url)
+                resp.raise_for_status()
+                _, parsed_text = parse_page(resp.text)
+                async for alias in stream_llm_aliases(
+                    store, long_url, parsed_text, count - len(sent), exclude=sent
+                ):
+                    sent.add(alias)
+                    yield sse_event("alias", {"alias": alias, "source": "llm"})
+        except httpx.HTTPError as e:
+            yield sse_event(
+                "error",
+                {
+                    "error": "NOT_FOUND",
+                    "message": "The provided URL does not exist or is unreachable. " + str(e),
+                },
+            )
+            return
+        except LLMBusyError as e:
+            yield sse_event("error", {"error": "AI_BUSY", "message": str(e)})
+            return
+        except LLMEmptyError:
+            yield sse_event(
+                "error",
+                {
+                    "error": "AI_ERROR",
+                    "message": "Failed to generate alias suggestions from AI",
+                },
+            )
+            return
+        except DatabaseUnavailableError as e:
+            yield sse_event("error", {"error": "DB_UNAVAILABLE", "message": str(e)})
+            return
+        except Exception as e:
+            # the status line is long gone, so report failures in-band
+            yield sse_event("error", {"error": "AI_ERROR", "message": str(e)})
+            return
+
+        yield sse_event("done", {"count": len(sent), "time_taken": time.time() - time_taken})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/alias/check", response_model=LinkAliasAvailabilityResponse | ErrorResponse)
 async def check_alias_availability(
-    alias: str, sql_db: AsyncSession = fastapi.Depends(get_async_session)
+    alias: str, store: LinkStore = fastapi.Depends(get_link_store)
 ):
     if len(alias) < 5 or len(alias) > 32:
         return {
             "error": "BAD_REQUEST",
-            "reason": "Alias length must be between 3 and 32 characters",
+            "message": "Alias length must be between 3 and 32 characters",
             "is_available": False,
             "alias": alias,
         }
-    existing = (
-        (await sql_db.execute(select(Link.id).where(Link.id == alias)))
-        .scalars()
-        .one_or_none()
-    )
-
-    if existing:
+    if await available_aliases(store, [alias]):
         return {
-            "is_available": False,
+            "is_available": True,
             "alias": alias,
-            "message": "Alias is already taken",
+            "message": "Alias is available",
         }
     else:
         return {
-            "is_available": True,
+            "is_available": False,
             "alias": alias,
-            "message": "Alias is available",
+            "message": "Alias is already taken",
         }
 
 
+@app.post(
+    "/alias/check",
+    response_model=LinkAliasBatchAvailabilityResponse | ErrorResponse,
+)
+async def check_alias_availability_batch(
+    body: LinkAliasBatchCheck, store: LinkStore = fastapi.Depends(get_link_store)
+):
+    valid = [alias for alias in body.aliases if 5 <= len(alias) <= 32]
+    available = set(await available_aliases(store, valid))
+    return {
+        "results": [
+            {"alias": alias, "is_available": alias in available}
+            for alias in body.aliases
+        ]
+    }
+
+
 @app.get("/url/check", response_model=LinkURLExistenceResponse | ErrorResponse)
 async def check_url_existence(
     url: str,
@@ -334,4 +555,93 @@ async def not_found():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "ok", "message": "The server is running fine"}
+    if db_breaker is not None and db_breaker.state != "closed":
+        return {
+            "status": "degraded",
+            "message": "The database is unavailable, redirects are served from cache",
+            "database": db_breaker.state,
+        }
+    return {
+        "status": "ok",
+        "message": "The server is running fine",
+        "database": db_breaker.state if db_breaker is not None else None,
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus text format. Counts are per process (and per function instance)."""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.post("/admin/profile", response_model=None)
+async def admin_profile(
+    req: fastapi.Request,
+    seconds: float = 10,
+    interval_ms: float = 5,
+    all_threads: bool = False,
+):
+    """
+    Sample stacks for `seconds` and return them in collapsed-stack format,
+    e.g. `curl -X POST -H "X-Admin-Token: ..." ".../admin/profile?seconds=20" > out.folded`
+    then `flamegraph.pl out.folded > out.svg` or open it in speedscope.
+    """
+    error = check_admin_token(req)
+    if error:
+        return error
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or interval_ms < 1:
+        return {
+            "error": "BAD_REQUEST",
+            "message": f"seconds must be in (0, {PROFILE_MAX_SECONDS}] and interval_ms at least 1",
+        }
+    try:
+        stacks = await profiler.profile(seconds, interval_ms, all_threads)
+    except ProfilerBusyError as e:
+        return {"error": "BUSY", "message": str(e)}
+    return PlainTextResponse(stacks)
+
+
+@app.get("/admin/loop", response_model=None)
+async def admin_loop_stats(req: fastapi.Request):
+    error = check_admin_token(req)
+    if error:
+        return error
+    return {"enabled": LOOP_MONITOR_ENABLED, **loop_monitor.stats()}
+
+
+@app.post("/admin/tracemalloc/start", response_model=None)
+async def admin_tracemalloc_start(req: fastapi.Request, frames: int = 10):
+    error = check_admin_token(req)
+    if error:
+        return error
+    return memory_tracker.start(frames)
+
+
+@app.get("/admin/tracemalloc/snapshot", response_model=None)
+async def admin_tracemalloc_snapshot(
+    req: fastapi.Request, top: int = 25, group_by: str = "lineno"
+):
+    """Top allocations, plus the growth since the previous snapshot."""
+    error = check_admin_token(req)
+    if error:
+        return error
+    if group_by not in ("lineno", "filename", "traceback"):
+        return {
+            "error": "BAD_REQUEST",
+            "message": "group_by must be one of lineno, filename or traceback",
+        }
+    status = memory_tracker.status()
+    if not status["tracing"]:
+        return {"error": "BAD_REQUEST", "message": "Start tracemalloc first"}
+    # comparing snapshots walks every traced block, keep it off the loop
+    return await asyncio.to_thread(memory_tracker.snapshot, top, group_by)
+
+
+@app.post("/admin/tracemalloc/stop", response_model=None)
+async def admin_tracemalloc_stop(req: fastapi.Request):
+    error = check_admin_token(req)
+    if error:
+        return error
+    return memory_tracker.stop()
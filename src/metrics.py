@@ -0,0 +1,228 @@
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+
+# seconds; the redirect path should sit in the first few buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+OUTBOUND_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21)
+
+# [queries, seconds] of the request being handled, see MetricsMiddleware
+_request_db_stats: ContextVar[list | None] = ContextVar("request_db_stats", default=None)
+
+# endpoint function -> route path, filled from the app's routes on first use
+_route_paths: dict = {}
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    Counters, histograms and callback gauges kept in process memory and
+    rendered in the Prometheus text format. Every metric is declared once
+    with its help text; series are created on first use per label set.
+    """
+
+    def __init__(self):
+        self._families: dict[str, dict] = {}
+
+    def counter(self, name: str, help: str):
+        self._families[name] = {"type": "counter", "help": help, "series": {}}
+
+    def histogram(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS):
+        self._families[name] = {
+            "type": "histogram",
+            "help": help,
+            "buckets": buckets,
+            "series": {},
+        }
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]):
+        """A value read when /metrics is scraped, e.g. a queue length."""
+        self._families[name] = {"type": "gauge", "help": help, "read": read}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._families[name]["series"]
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        family = self._families[name]
+        key = tuple(sorted(labels.items()))
+        histogram = family["series"].get(key)
+        if histogram is None:
+            histogram = family["series"][key] = Histogram(family["buckets"])
+        histogram.observe(value)
+
+    @contextmanager
+    def time_block(self, name: str, **labels):
+        """Observe the duration of the block, labelled outcome="ok" or "error"."""
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            self.observe(name, time.perf_counter() - start, outcome=outcome, **labels)
+
+    def render(self) -> str:
+        lines = []
+        for name, family in self._families.items():
+            lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            if family["type"] == "gauge":
+                try:
+                    lines.append(f"{name} {_format_value(family['read']())}")
+                except Exception as e:
+                    print(f"Failed to read gauge {name}: {e}")
+                continue
+            for labels, value in family["series"].items():
+                if family["type"] == "counter":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip((*family["buckets"], float("inf")), value.counts):
+                    cumulative += count
+                    le = (("le", _format_value(float(bound))),)
+                    lines.append(f"{name}_bucket{_format_labels(labels + le)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the last response byte.",
+)
+metrics.counter("http_requests_total", "Requests handled, by route, method and status.")
+metrics.histogram(
+    "http_request_db_queries",
+    "Database statements executed per request.",
+    QUERY_COUNT_BUCKETS,
+)
+metrics.histogram(
+    "http_request_db_seconds",
+    "Time per request spent waiting for database statements.",
+)
+metrics.histogram(
+    "db_query_duration_seconds",
+    "Duration of single database statements, by statement type.",
+)
+metrics.histogram(
+    "outbound_request_duration_seconds",
+    "Duration of calls to other services (page fetches, LLM calls).",
+    OUTBOUND_BUCKETS,
+)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_started
+    kind = statement.split(None, 1)[0].upper() if statement else ""
+    metrics.observe("db_query_duration_seconds", elapsed, statement=kind)
+    stats = _request_db_stats.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += elapsed
+
+
+def install_engine_hooks(engine: AsyncEngine):
+    """Time every statement the engine runs (and count it for the request)."""
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def route_template(scope) -> str:
+    """
+    The path template of the route that handled the request, e.g.
+    "/url/{url}/redirect". Starlette puts the matched endpoint in the scope;
+    requests that matched no route are all "unmatched", so scanners can't
+    create unbounded label values.
+    """
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    if endpoint not in _route_paths:
+        for route in scope["app"].router.routes:
+            if hasattr(route, "endpoint"):
+                _route_paths[route.endpoint] = route.path
+    return _route_paths.get(endpoint, "unmatched")
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware (no BaseHTTPMiddleware task/queue overhead) that
+    records latency, status and database usage per route template.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        db_stats = [0, 0.0]
+        token = _request_db_stats.set(db_stats)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            _request_db_stats.reset(token)
+            route = route_template(scope)
+            metrics.observe(
+                "http_request_duration_seconds", time.perf_counter() - start, route=route
+            )
+            metrics.inc(
+                "http_requests_total", route=route, method=scope["method"], status=status
+            )
+            metrics.observe("http_request_db_queries", db_stats[0], route=route)
+            metrics.observe("http_request_db_seconds", db_stats[1], route=route)
@@ -0,0 +1,225 @@
+import asyncio
+import hmac
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+from collections import Counter
+
+from src.metrics import LATENCY_BUCKETS, metrics
+
+# the /admin endpoints answer NOT_FOUND unless a token is configured
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "1") == "1"
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.25"))
+LOOP_BLOCK_THRESHOLD_MS = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "250"))
+
+PROFILE_MAX_SECONDS = 60
+
+metrics.histogram(
+    "event_loop_lag_seconds",
+    "How late the loop monitor's periodic wakeups run.",
+    LATENCY_BUCKETS,
+)
+metrics.counter(
+    "event_loop_blocked_total",
+    "Times a callback kept the event loop busy past LOOP_BLOCK_THRESHOLD_MS.",
+)
+
+
+class ProfilerBusyError(Exception):
+    """Raised when a profile is requested while another one is running."""
+
+
+def check_admin_token(request) -> dict | None:
+    """The error to answer with, or None when the request carries the admin token."""
+    if not ADMIN_TOKEN:
+        return {"error": "NOT_FOUND", "message": "The requested URL was not found"}
+    supplied = request.headers.get("x-admin-token", "")
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        supplied = authorization[7:]
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        return {"error": "UNAUTHORIZED", "message": "A valid admin token is required"}
+    return None
+
+
+class LoopMonitor:
+    """
+    Measures event loop lag by sleeping `interval` seconds in a loop and
+    checking how late it wakes up. A watchdog thread notices when the loop
+    hasn't woken up for longer than `block_threshold_ms` and prints what the
+    loop thread is running at that moment, which is the blocking callback
+    (a sync HTTP call, a big BeautifulSoup parse, ...).
+    """
+
+    def __init__(self, interval: float, block_threshold_ms: float):
+        self.interval = interval
+        self.block_threshold = block_threshold_ms / 1000
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.blocked = 0
+        self._heartbeat = time.monotonic()
+        self._loop_thread: int | None = None
+        self._stop = threading.Event()
+
+    def stats(self) -> dict:
+        return {
+            "lag_ms": round(self.last_lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "blocked": self.blocked,
+            "block_threshold_ms": self.block_threshold * 1000,
+        }
+
+    def _watch(self):
+        reported = False
+        while not self._stop.wait(self.block_threshold / 4):
+            blocked_for = time.monotonic() - self._heartbeat - self.interval
+            if blocked_for <= self.block_threshold:
+                reported = False
+                continue
+            if reported:
+                continue  # one report per stall
+            reported = True
+            self.blocked += 1
+            metrics.inc("event_loop_blocked_total")
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else "(no frame)\n"
+            print(f"Event loop blocked for over {blocked_for * 1000:.0f} ms, loop thread is at:\n{stack}")
+
+    async def run(self):
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        watchdog.start()
+        try:
+            while True:
+                expected = time.monotonic() + self.interval
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self._heartbeat = now
+                self.last_lag = max(0.0, now - expected)
+                self.max_lag = max(self.max_lag, self.last_lag)
+                metrics.observe("event_loop_lag_seconds", self.last_lag)
+        finally:
+            self._stop.set()
+
+
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_BLOCK_THRESHOLD_MS)
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """
+    Samples thread stacks from a helper thread with sys._current_frames(),
+    so the profiled code runs unmodified; the cost is one stack walk per
+    sample. Output is the collapsed-stack format flamegraph.pl and
+    speedscope read: "outer;inner;leaf count" per line.
+    """
+
+    def __init__(self):
+        self._running = False
+        self._labels: dict = {}
+
+    def _collapse(self, frame) -> str:
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = _frame_label(code).replace(";", ":")
+            labels.append(label)
+            frame = frame.f_back
+        return ";".join(reversed(labels))
+
+    def _sample(self, target: int | None, seconds: float, interval: float) -> Counter:
+        stacks: Counter = Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != me and (target is None or thread_id == target):
+                    stacks[self._collapse(frame)] += 1
+            time.sleep(interval)
+        return stacks
+
+    async def profile(self, seconds: float, interval_ms: float, all_threads: bool = False) -> str:
+        if self._running:
+            raise ProfilerBusyError("A profile is already running")
+        self._running = True
+        try:
+            target = None if all_threads else threading.get_ident()  # the loop thread
+            stacks = await asyncio.to_thread(
+                self._sample, target, min(seconds, PROFILE_MAX_SECONDS), interval_ms / 1000
+            )
+        finally:
+            self._running = False
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+profiler = SamplingProfiler()
+
+
+class MemoryTracker:
+    """tracemalloc on demand; every snapshot is compared with the previous one."""
+
+    def __init__(self):
+        self._previous: tracemalloc.Snapshot | None = None
+
+    def start(self, frames: int = 10) -> dict:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self._previous = None
+        return self.status()
+
+    def stop(self) -> dict:
+        tracemalloc.stop()
+        self._previous = None
+        return self.status()
+
+    def status(self) -> dict:
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        return {
+            "tracing": tracing,
+            "traced_kb": round(current / 1024, 1),
+            "peak_kb": round(peak / 1024, 1),
+        }
+
+    def snapshot(self, top: int = 25, group_by: str = "lineno") -> dict:
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ]
+        )
+        result = self.status()
+        result["top"] = [
+            {
+                "location": str(stat.traceback),
+                "size_kb": round(stat.size / 1024, 1),
+                "count": stat.count,
+            }
+            for stat in snapshot.statistics(group_by)[:top]
+        ]
+        if self._previous is not None:
+            result["growth"] = [
+                {
+                    "location": str(stat.traceback),
+                    "size_diff_kb": round(stat.size_diff / 1024, 1),
+                    "count_diff": stat.count_diff,
+                }
+                for stat in snapshot.compare_to(self._previous, group_by)[:top]
+            ]
+        self._previous = snapshot
+        return result
+
+
+memory_tracker = MemoryTracker()
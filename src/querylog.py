@@ -0,0 +1,115 @@
+import json
+import os
+import random
+import re
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# statements slower than this are always logged (negative disables)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+# share of all other statements logged anyway, for a baseline of normal queries
+QUERY_LOG_SAMPLE_RATE = float(os.getenv("QUERY_LOG_SAMPLE_RATE", "0"))
+# run EXPLAIN for slow statements, at most once per statement per interval
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "0") == "1"
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+
+QUERY_LOG_ENABLED = SLOW_QUERY_MS >= 0 or QUERY_LOG_SAMPLE_RATE > 0
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# statement -> when it was last explained, least recently explained first;
+# capped since statements with inlined values can all be distinct
+_EXPLAINED_MAX = 1000
+_explained_at: OrderedDict[str, float] = OrderedDict()
+
+
+def _shape(value) -> str:
+    """Type (and size) of a parameter, never the value: ids, IPs and URLs stay out of logs."""
+    if isinstance(value, (str, bytes)):
+        return f"{type(value).__name__}({len(value)})"
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def parameter_shapes(context, parameters, executemany: bool):
+    # bind names when SQLAlchemy compiled the statement, positions otherwise
+    compiled = getattr(context, "compiled_parameters", None)
+    if compiled:
+        rows = compiled
+        first = {name: _shape(value) for name, value in rows[0].items()}
+    else:
+        rows = parameters if executemany else [parameters]
+        first = [_shape(value) for value in (rows[0] if rows else ())]
+    if executemany:
+        return {"rows": len(rows), "first": first}
+    return first
+
+
+def _explain(conn, statement: str, parameters):
+    prefix = "EXPLAIN QUERY PLAN " if conn.dialect.name == "sqlite" else "EXPLAIN "
+    conn.info["query_log_explaining"] = True
+    try:
+        # in a savepoint: on Postgres a failed statement would otherwise abort
+        # the request's own transaction
+        with conn.begin_nested():
+            rows = conn.exec_driver_sql(prefix + statement, parameters).all()
+    finally:
+        conn.info["query_log_explaining"] = False
+    return [" | ".join(str(value) for value in row) for row in rows]
+
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context._query_log_started = time.perf_counter()
+
+
+def _log_query(conn, cursor, statement, parameters, context, executemany):
+    if conn.info.get("query_log_explaining"):
+        return
+    elapsed_ms = (time.perf_counter() - context._query_log_started) * 1000
+    slow = 0 <= SLOW_QUERY_MS <= elapsed_ms
+    if not slow and (QUERY_LOG_SAMPLE_RATE <= 0 or random.random() >= QUERY_LOG_SAMPLE_RATE):
+        return
+
+    text = _WHITESPACE_RE.sub(" ", statement).strip()
+    entry = {
+        "event": "slow_query" if slow else "sampled_query",
+        "duration_ms": round(elapsed_ms, 2),
+        "statement": text[:1000],
+        "parameters": parameter_shapes(context, parameters, executemany),
+    }
+    if context is not None and not getattr(context, "isddl", False) and context.rowcount >= 0:
+        entry["rowcount"] = context.rowcount
+
+    now = time.monotonic()
+    if (
+        slow
+        and SLOW_QUERY_EXPLAIN
+        and not executemany
+        and text.split(" ", 1)[0].upper() in _EXPLAINABLE
+        and now - _explained_at.get(text, -SLOW_QUERY_EXPLAIN_INTERVAL) >= SLOW_QUERY_EXPLAIN_INTERVAL
+    ):
+        _explained_at[text] = now
+        _explained_at.move_to_end(text)
+        if len(_explained_at) > _EXPLAINED_MAX:
+            _explained_at.popitem(last=False)
+        try:
+            entry["plan"] = _explain(conn, statement, parameters)
+        except Exception as e:
+            entry["plan_error"] = str(e)
+    print(json.dumps(entry))
+
+
+def install_query_log(engine: AsyncEngine):
+    """
+    Log slow statements (and a sample of the rest) as one JSON line each,
+    instead of echoing every statement. The EXPLAIN for a slow statement runs
+    on the same connection inside a savepoint, so it only adds latency to that
+    one request and a failing EXPLAIN leaves its transaction usable.
+    """
+    event.listen(engine.sync_engine, "before_cursor_execute", _start_query_timer)
+    event.listen(engine.sync_engine, "after_cursor_execute", _log_query)
@@ -1,15 +1,23 @@
+from datetime import datetime
+
 from pydantic import AnyHttpUrl, BaseModel, Field
 
 
 class LinkCreate(BaseModel):
     long_url: AnyHttpUrl
     name: str | None = None
+    # the link stops redirecting at expires_at (UTC unless an offset is
+    # given) or after max_clicks redirects, whichever comes first
+    expires_at: datetime | None = None
+    max_clicks: int | None = Field(default=None, ge=1)
 
 
 class LinkMetadataResponse(BaseModel):
     clicks: int
     last_ip: str | None
     custom_name: str | None = None
+    expires_at: datetime | None = None
+    max_clicks: int | None = None
 
 
 class LinkResponse(BaseModel):
@@ -34,9 +42,18 @@ class LinkAliasAvailabilityResponse(BaseModel):
     is_available: bool
 
 
+class LinkAliasBatchCheck(BaseModel):
+    aliases: list[str] = Field(max_length=100)
+
+
+class LinkAliasBatchAvailabilityResponse(BaseModel):
+    results: list[LinkAliasAvailabilityResponse]
+
+
 class LinkAliasSuggestionResponse(BaseModel):
     suggested_aliases: list[str]
     time_taken: float
+    source: str | None = None
 
 
 class LinkURLExistenceResponse(BaseModel):
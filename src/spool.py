@@ -0,0 +1,271 @@
+import asyncio
+import fcntl
+import json
+import os
+import secrets
+import struct
+import zlib
+from datetime import datetime
+from typing import Iterator
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from src.clicks import insert_click_rows
+from src.metrics import metrics
+from src.models import Link
+
+# a directory for the click spool; when set, redirects append their click
+# to it instead of writing to the database (see ClickSpool)
+CLICK_SPOOL_DIR = os.getenv("CLICK_SPOOL_DIR")
+# appended clicks reach the disk (fsync) at most this many seconds later
+CLICK_SPOOL_FSYNC_INTERVAL = float(os.getenv("CLICK_SPOOL_FSYNC_INTERVAL", "0.5"))
+CLICK_SPOOL_REPLAY_INTERVAL = float(os.getenv("CLICK_SPOOL_REPLAY_INTERVAL", "5"))
+CLICK_SPOOL_REPLAY_BATCH = int(os.getenv("CLICK_SPOOL_REPLAY_BATCH", "5000"))
+
+# payload length, crc32 of the payload
+_SPOOL_RECORD = struct.Struct("<II")
+
+
+metrics.counter("click_spool_appended_total", "Clicks appended to the click spool.")
+metrics.counter("click_spool_replayed_total", "Spooled clicks written to the database.")
+metrics.counter("click_spool_dropped_total", "Spooled clicks not replayed, by reason.")
+
+
+class ClickSpool:
+    """
+    Append-only click log on local disk, in numbered segment files of
+    length-prefixed, CRC-checked JSON records. `append` writes into the
+    file's buffer and returns; `run` flushes and fsyncs every
+    `fsync_interval` seconds, so a crash loses at most that much, and a
+    torn last record is detected and skipped on reading.
+
+    Several processes can share the directory: each names its segments
+    after a random instance id and holds an exclusive lock on the one it
+    appends to. `rotate` closes the active segment; every other segment
+    whose lock can be taken (closed, or left by a process that is gone) is
+    what the replayer drains, deleting each one once it is in the database.
+    """
+
+    def __init__(self, directory: str, fsync_interval: float = CLICK_SPOOL_FSYNC_INTERVAL):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        os.makedirs(directory, exist_ok=True)
+        self.instance = secrets.token_hex(4)
+        self._seq = 0
+        self._file = None
+        self._records = 0
+        self._unsynced = False
+        # rotate and the fsync in run never touch the file at the same time
+        self._sync_lock = asyncio.Lock()
+        self._open_next()
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{self.instance}-{seq:012d}.spool")
+
+    def _open_next(self):
+        self._seq += 1
+        self._file = open(self._segment_path(self._seq), "ab")
+        # held until the segment is closed; replayers skip locked segments
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._records = 0
+
+    def closed_segments(self) -> list[str]:
+        """
+        Segment files other than the one being appended to, oldest first.
+        Other processes' active segments are listed too; claim_segment
+        tells them apart.
+        """
+        active = self._segment_path(self._seq)
+        return sorted(
+            (
+                os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith(".spool") and os.path.join(self.directory, name) != active
+            ),
+            key=_modified_at,
+        )
+
+    def backlog_bytes(self) -> int:
+        total = self._file.tell()
+        for path in self.closed_segments():
+            try:
+                total += os.path.getsize(path)
+            except FileNotFoundError:
+                pass  # replayed in the meantime
+        return total
+
+    def append(self, link_id: str, ip: str | None, timestamp: datetime, user_agent: str | None):
+        payload = json.dumps(
+            [link_id, ip, timestamp.isoformat(), user_agent], separators=(",", ":")
+        ).encode()
+        self._file.write(_SPOOL_RECORD.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._records += 1
+        self._unsynced = True
+        metrics.inc("click_spool_appended_total")
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = False
+
+    @staticmethod
+    def _sync_and_close(file):
+        file.flush()
+        os.fsync(file.fileno())
+        file.close()  # releases the lock
+
+    async def rotate(self) -> bool:
+        """Close the active segment if it has records; True when it did."""
+        if not self._records:
+            return False
+        async with self._sync_lock:
+            closing = self._file
+            self._open_next()
+            self._unsynced = False
+            # the fsync waits for the disk; keep it off the loop
+            await asyncio.to_thread(self._sync_and_close, closing)
+        return True
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.fsync_interval)
+                if not self._unsynced:
+                    continue
+                async with self._sync_lock:
+                    self._unsynced = False
+                    try:
+                        self._file.flush()
+                        await asyncio.to_thread(os.fsync, self._file.fileno())
+                    except OSError as e:
+                        self._unsynced = True
+                        print(f"Failed to fsync the click spool, retrying: {e}")
+        finally:
+            self.sync()
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+
+def _modified_at(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0.0
+
+
+def claim_segment(path: str):
+    """
+    The segment opened and locked for replaying, or None when its writer
+    still appends to it, another replayer has it, or it is gone already.
+    """
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # replayed and deleted between our open and our lock
+        if os.stat(path).st_ino != os.fstat(file.fileno()).st_ino:
+            raise FileNotFoundError(path)
+    except (BlockingIOError, FileNotFoundError):
+        file.close()
+        return None
+    return file
+
+
+def read_spool_segment(file) -> Iterator[tuple]:
+    """(link_id, ip, timestamp, user_agent) records of a segment, up to a torn or corrupt one."""
+    data = file.read()
+    position = 0
+    while position + _SPOOL_RECORD.size <= len(data):
+        length, crc = _SPOOL_RECORD.unpack_from(data, position)
+        start = position + _SPOOL_RECORD.size
+        payload = data[start : start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            print(f"Skipping the torn end of click spool segment {file.name} at byte {position}")
+            break
+        link_id, ip, timestamp, user_agent = json.loads(payload)
+        yield link_id, ip, datetime.fromisoformat(timestamp), user_agent
+        position = start + length
+
+
+async def _replay_batch(conn: AsyncConnection, rows: list[tuple]) -> int:
+    """Write a batch of clicks, the log rows plus the per-link counters; returns how many."""
+    link_ids = list({row[0] for row in rows})
+    # links reaped by the expiry sweeper since the click was spooled
+    existing = set(
+        (await conn.execute(select(Link.id).where(Link.id.in_(link_ids)))).scalars()
+    )
+    kept = [row for row in rows if row[0] in existing]
+    if len(kept) < len(rows):
+        metrics.inc("click_spool_dropped_total", len(rows) - len(kept), reason="deleted_link")
+    if not kept:
+        return 0
+    await insert_click_rows(conn, kept)
+    counters: dict[str, list] = {}
+    for link_id, ip, _, _ in kept:
+        counter = counters.setdefault(link_id, [0, None])
+        counter[0] += 1
+        counter[1] = ip
+    await conn.execute(
+        update(Link)
+        .where(Link.id == bindparam("b_link_id"))
+        .values(
+            clicks=Link.clicks + bindparam("b_clicks"),
+            last_ip=bindparam("b_last_ip"),
+        ),
+        [
+            {"b_link_id": link_id, "b_clicks": clicks, "b_last_ip": ip}
+            for link_id, (clicks, ip) in counters.items()
+        ],
+    )
+    return len(kept)
+
+
+async def replay_click_spool(
+    spool: ClickSpool, engine: AsyncEngine, batch: int = CLICK_SPOOL_REPLAY_BATCH
+) -> int:
+    """
+    Rotate the spool and write every closed segment to the database, one
+    transaction per segment and `batch` clicks per statement; returns the
+    number of clicks replayed. Stops at the first failure, leaving that
+    segment for the next call, so a failed segment is not counted twice.
+    """
+    await spool.rotate()
+    replayed = 0
+    for path in spool.closed_segments():
+        segment = claim_segment(path)
+        if segment is None:
+            continue
+        try:
+            rows = list(read_spool_segment(segment))
+            written = 0
+            async with engine.connect() as conn:
+                for offset in range(0, len(rows), batch):
+                    written += await _replay_batch(conn, rows[offset : offset + batch])
+                await conn.commit()
+            # still locked, so no other replayer can pick it up in between
+            os.remove(path)
+        finally:
+            segment.close()
+        metrics.inc("click_spool_replayed_total", written)
+        replayed += written
+    return replayed
+
+
+async def keep_replaying(
+    spool: ClickSpool,
+    engine: AsyncEngine,
+    interval: float = CLICK_SPOOL_REPLAY_INTERVAL,
+    batch: int = CLICK_SPOOL_REPLAY_BATCH,
+):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await replay_click_spool(spool, engine, batch)
+        except Exception as e:
+            # the database is down or slow; the clicks wait on disk
+            print(f"Failed to replay the click spool, {spool.backlog_bytes()} bytes waiting: {e}")
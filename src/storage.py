@@ -0,0 +1,1008 @@
+import asyncio
+import os
+import random
+import sqlite3
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import AsyncIterator, Iterable
+
+from sqlalchemy import DateTime, String, bindparam, case, delete, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from src.breaker import (
+    BREAKER_STATES,
+    DB_BREAKER_ENABLED,
+    DB_BREAKER_FAILURES,
+    DB_BREAKER_RESET_TIMEOUT,
+    DB_CALL_TIMEOUT,
+    CircuitBreaker,
+    DatabaseUnavailableError,
+    is_database_error,
+)
+from src.cache import LINK_CACHE_SIZE, LinkCache, TimingWheel
+from src.clicks import CLICK_BUFFER_ENABLED, ClickBuffer
+from src.counters import CLICK_COUNTER_SHARDS, shard_increment, sharded_clicks
+from src.db import async_engine
+from src.metrics import metrics
+from src.models import Link, LinkClickLog, LinkClickShard
+from src.snapshot import LinkSnapshot
+from src.spool import CLICK_SPOOL_DIR, ClickSpool
+from src.tracing import span
+
+# "sqlalchemy" (DATABASE_URL, Postgres in production), "sqlite" (a local
+# WAL-mode file, for a single node or an edge deployment) or "memory"
+# (process memory, for tests and benchmarks)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlalchemy")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "shortener.db")
+# the memory backend keeps only the latest clicks
+MEMORY_CLICK_LOG_SIZE = int(os.getenv("MEMORY_CLICK_LOG_SIZE", "100000"))
+# a file written by export_snapshot.py; redirects for the links in it skip
+# the lookup query. Checked for a newer file every LINK_SNAPSHOT_REFRESH seconds
+LINK_SNAPSHOT_PATH = os.getenv("LINK_SNAPSHOT_PATH")
+LINK_SNAPSHOT_REFRESH = float(os.getenv("LINK_SNAPSHOT_REFRESH", "60"))
+
+
+metrics.counter(
+    "link_snapshot_lookups_total",
+    "Redirect lookups answered by the link snapshot (hit) or passed on (miss).",
+)
+metrics.counter(
+    "degraded_redirects_total",
+    "Redirects while the database was unavailable, served stale (hit) or not (miss).",
+)
+
+
+class LinkExistsError(Exception):
+    """Raised by `create_link` when the id is already taken."""
+
+
+@dataclass
+class StoredLink:
+    id: str
+    long_url: str
+    name: str = ""
+    clicks: int = 0
+    last_ip: str | None = None
+    expires_at: datetime | None = None
+    max_clicks: int | None = None
+
+
+@dataclass
+class Click:
+    link_id: str
+    ip: str | None
+    user_agent: str | None
+    timestamp: datetime
+
+
+def utc_now() -> datetime:
+    """Naive UTC, the way expires_at is stored."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def link_expired(expires_at: datetime | None, max_clicks: int | None, clicks: int) -> bool:
+    return (expires_at is not None and expires_at <= utc_now()) or (
+        max_clicks is not None and clicks >= max_clicks
+    )
+
+
+class LinkStore(ABC):
+    """
+    What the endpoints need from storage. Every method is one unit of work:
+    it either commits or leaves nothing behind.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        """The link with its name and click count, or None (also when it expired)."""
+
+    @abstractmethod
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        """Insert a link; raises LinkExistsError when `link_id` is taken."""
+
+    @abstractmethod
+    async def record_click(self, click: Click) -> bool:
+        """Count a click and log it; False when the link doesn't exist."""
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        """
+        The link `click.link_id` points to (None when it doesn't exist or
+        has expired), with the click recorded. The redirect path: backends
+        override this to do the lookup and the write together, and to enforce
+        max_clicks atomically. Only the id, long_url and expiry fields of the
+        result are reliably filled in.
+        """
+        link = await self.get_link(click.link_id)
+        if link is None:
+            return None
+        await self.record_click(click)
+        return link
+
+    @abstractmethod
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        """The subset of `link_ids` already used."""
+
+    @abstractmethod
+    async def count_links(self) -> int:
+        ...
+
+    @abstractmethod
+    def iter_link_ids(self) -> AsyncIterator[str]:
+        ...
+
+    @abstractmethod
+    def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        """(id, long_url) of every link that never expires, for export_snapshot.py."""
+
+    @abstractmethod
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        """Delete up to `limit` links that expired by `now`, with their clicks."""
+
+    async def close(self):
+        pass
+
+
+def link_statements(dialect: str, counter_shards: int = 1) -> dict:
+    """
+    The SQLAlchemy store's statements, built once with bind parameters
+    instead of per call. A statement object memoizes its cache key, so
+    running it again goes straight to the compiled SQL (and, on asyncpg,
+    the connection's prepared statement) without building and hashing the
+    expression first.
+    """
+    link_columns = [Link.long_url, Link.name, Link.clicks, Link.last_ip]
+    if counter_shards > 1:
+        shard_clicks, shard_last_ip = sharded_clicks(Link.id)
+        link_columns += [shard_clicks.label("shard_clicks"), shard_last_ip.label("shard_last_ip")]
+    now = bindparam("b_now", type_=DateTime)
+    return {
+        "get_link": select(*link_columns, Link.expires_at, Link.max_clicks).where(
+            Link.id == bindparam("b_link_id")
+        ),
+        "lookup": select(Link.long_url, Link.expires_at, Link.max_clicks).where(
+            Link.id == bindparam("b_link_id")
+        ),
+        # counts a click unless the link has expired or is used up. The
+        # limit is checked by the statement that counts, so concurrent
+        # redirects can't go past it, and the last allowed click sets
+        # expires_at: from then on the sweeper owns the link
+        "count_click": update(Link)
+        .where(
+            Link.id == bindparam("b_link_id"),
+            or_(Link.expires_at.is_(None), Link.expires_at > now),
+            or_(Link.max_clicks.is_(None), Link.clicks < Link.max_clicks),
+        )
+        .values(
+            clicks=Link.clicks + 1,
+            last_ip=bindparam("b_ip", type_=String),
+            expires_at=case((Link.clicks + 1 >= Link.max_clicks, now), else_=Link.expires_at),
+        )
+        .returning(Link.long_url, Link.expires_at, Link.max_clicks),
+        "increment_shard": shard_increment(dialect),
+        "insert_link": insert(Link),
+        "insert_click": insert(LinkClickLog),
+        "taken_ids": select(Link.id).where(Link.id.in_(bindparam("b_link_ids", expanding=True))),
+    }
+
+
+class SQLAlchemyLinkStore(LinkStore):
+    """
+    The links and link_click_log tables through `src.db`, with Core
+    statements built once (see link_statements) on pooled connections. A
+    redirect is a single UPDATE of the link's row that checks expiry and
+    max_clicks, counts the click and returns long_url, plus the click log
+    insert. With a ClickBuffer the click log rows are left to it. With a
+    ClickSpool the whole click (count and log row) goes to the spool and a
+    redirect is a single read; links with max_clicks are still counted
+    inline, since the limit has to be checked by the statement that
+    counts. With `counter_shards` > 1 clicks are counted in
+    link_click_shards rows (see src/counters.py) instead of the link's row.
+    """
+
+    name = "sqlalchemy"
+
+    def __init__(
+        self,
+        click_buffer: ClickBuffer | None = None,
+        click_spool: ClickSpool | None = None,
+        counter_shards: int = 1,
+    ):
+        if async_engine is None:
+            raise EnvironmentError("DATABASE_URL not set in environment variables")
+        self.engine = async_engine
+        self.click_buffer = click_buffer
+        self.click_spool = click_spool
+        self.counter_shards = counter_shards
+        self.statements = link_statements(async_engine.dialect.name, counter_shards)
+
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        async with self.engine.connect() as conn:
+            with span("link_lookup"):
+                row = (
+                    await conn.execute(self.statements["get_link"], {"b_link_id": link_id})
+                ).one_or_none()
+        if row is None:
+            return None
+        clicks, last_ip = row.clicks, row.last_ip
+        if self.counter_shards > 1:
+            clicks += row.shard_clicks
+            last_ip = row.shard_last_ip or last_ip
+        if link_expired(row.expires_at, row.max_clicks, clicks):
+            return None
+        return StoredLink(
+            link_id, row.long_url, row.name, clicks, last_ip, row.expires_at, row.max_clicks
+        )
+
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        async with self.engine.connect() as conn:
+            try:
+                with span("insert"):
+                    await conn.execute(
+                        self.statements["insert_link"],
+                        {
+                            "id": link_id,
+                            "long_url": long_url,
+                            "name": name,
+                            "clicks": 0,
+                            "expires_at": expires_at,
+                            "max_clicks": max_clicks,
+                        },
+                    )
+                with span("commit"):
+                    await conn.commit()
+            except IntegrityError:
+                # the primary key is the check for a taken id
+                raise LinkExistsError(link_id)
+        return StoredLink(link_id, long_url, name, expires_at=expires_at, max_clicks=max_clicks)
+
+    async def _count_click(self, conn, click: Click):
+        """The link's (long_url, expires_at, max_clicks) if the click counted, else None."""
+        return (
+            await conn.execute(
+                self.statements["count_click"],
+                {"b_link_id": click.link_id, "b_ip": click.ip, "b_now": utc_now()},
+            )
+        ).one_or_none()
+
+    async def _increment_shard(self, conn, click: Click) -> bool:
+        try:
+            with span("clicks_update"):
+                await conn.execute(
+                    self.statements["increment_shard"],
+                    {
+                        "b_link_id": click.link_id,
+                        "b_shard": random.randrange(self.counter_shards),
+                        "b_ip": click.ip,
+                    },
+                )
+        except IntegrityError:
+            return False  # no such link
+        return True
+
+    async def _log_click(self, conn, click: Click) -> bool:
+        if self.click_buffer is None:
+            with span("click_insert"):
+                await conn.execute(
+                    self.statements["insert_click"],
+                    {
+                        "link_id": click.link_id,
+                        "click_ip": click.ip,
+                        "timestamp": click.timestamp,
+                        "user_agent": click.user_agent,
+                    },
+                )
+        with span("commit"):
+            await conn.commit()
+        if self.click_buffer is not None:
+            self.click_buffer.add(click.link_id, click.ip, click.timestamp, click.user_agent)
+        return True
+
+    def _spool_click(self, click: Click):
+        self.click_spool.append(click.link_id, click.ip, click.timestamp, click.user_agent)
+
+    async def record_click(self, click: Click) -> bool:
+        if self.click_spool is not None:
+            # not checked against the database; the replayer skips unknown links
+            self._spool_click(click)
+            return True
+        async with self.engine.connect() as conn:
+            if self.counter_shards > 1:
+                if not await self._increment_shard(conn, click):
+                    return False
+            else:
+                with span("clicks_update"):
+                    if await self._count_click(conn, click) is None:
+                        return False
+            return await self._log_click(conn, click)
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        # one connection for the lookup and the write
+        async with self.engine.connect() as conn:
+            if self.click_spool is None and self.counter_shards <= 1:
+                # the lookup is the UPDATE that counts the click
+                with span("link_lookup"):
+                    row = await self._count_click(conn, click)
+                if row is None:
+                    return None
+                await self._log_click(conn, click)
+                return StoredLink(
+                    click.link_id,
+                    row.long_url,
+                    expires_at=row.expires_at,
+                    max_clicks=row.max_clicks,
+                )
+            with span("link_lookup"):
+                row = (
+                    await conn.execute(self.statements["lookup"], {"b_link_id": click.link_id})
+                ).one_or_none()
+            if row is None or link_expired(row.expires_at, None, 0):
+                return None
+            if row.max_clicks is not None:
+                with span("clicks_update"):
+                    row = await self._count_click(conn, click)
+                if row is None:
+                    return None  # used up
+                await self._log_click(conn, click)
+            elif self.click_spool is not None:
+                self._spool_click(click)
+            elif not await self._increment_shard(conn, click):
+                return None  # deleted since the lookup
+            else:
+                await self._log_click(conn, click)
+        return StoredLink(
+            click.link_id, row.long_url, expires_at=row.expires_at, max_clicks=row.max_clicks
+        )
+
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        async with self.engine.connect() as conn:
+            return set(
+                (
+                    await conn.execute(self.statements["taken_ids"], {"b_link_ids": list(link_ids)})
+                ).scalars()
+            )
+
+    async def count_links(self) -> int:
+        async with self.engine.connect() as conn:
+            return (await conn.execute(select(func.count()).select_from(Link))).scalar_one()
+
+    async def iter_link_ids(self) -> AsyncIterator[str]:
+        async with self.engine.connect() as conn:
+            result = await conn.stream_scalars(select(Link.id).execution_options(yield_per=10_000))
+            async for link_id in result:
+                yield link_id
+
+    async def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        async with self.engine.connect() as conn:
+            result = await conn.stream(
+                select(Link.id, Link.long_url)
+                .where(Link.expires_at.is_(None), Link.max_clicks.is_(None))
+                .execution_options(yield_per=10_000)
+            )
+            async for link_id, long_url in result:
+                yield link_id, long_url
+
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        async with self.engine.connect() as conn:
+            # walks the partial ix_links_expires_at index; SKIP LOCKED lets
+            # several instances sweep at once (ignored on SQLite)
+            link_ids = list(
+                (
+                    await conn.execute(
+                        select(Link.id)
+                        .where(Link.expires_at <= now)
+                        .order_by(Link.expires_at)
+                        .limit(limit)
+                        .with_for_update(skip_locked=True)
+                    )
+                ).scalars()
+            )
+            if not link_ids:
+                return []
+            await conn.execute(delete(LinkClickLog).where(LinkClickLog.link_id.in_(link_ids)))
+            await conn.execute(
+                delete(LinkClickShard).where(LinkClickShard.link_id.in_(link_ids))
+            )
+            await conn.execute(delete(Link).where(Link.id.in_(link_ids)))
+            await conn.commit()
+        return link_ids
+
+    async def close(self):
+        await self.engine.dispose()
+
+
+# the same tables (and column names) as src/models.py, so a file can be
+# inspected or moved with the usual tools
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (
+    id VARCHAR NOT NULL PRIMARY KEY,
+    long_url VARCHAR NOT NULL,
+    name VARCHAR NOT NULL DEFAULT '',
+    clicks INTEGER NOT NULL DEFAULT 0,
+    last_ip VARCHAR,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at DATETIME,
+    max_clicks INTEGER
+);
+CREATE TABLE IF NOT EXISTS link_click_log (
+    id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+    link_id VARCHAR NOT NULL REFERENCES links (id),
+    click_ip VARCHAR,
+    timestamp DATETIME,
+    user_agent VARCHAR,
+    created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS ix_link_click_log_link_id_timestamp
+    ON link_click_log (link_id, timestamp);
+DROP INDEX IF EXISTS ix_link_click_log_link_id;
+"""
+# columns added after the first release, for files created before them
+SQLITE_ADDED_COLUMNS = {
+    "expires_at": "DATETIME",
+    "max_clicks": "INTEGER",
+    "name": "VARCHAR NOT NULL DEFAULT ''",
+    "clicks": "INTEGER NOT NULL DEFAULT 0",
+    "last_ip": "VARCHAR",
+}
+# files created before link_metadata was folded into links
+SQLITE_FOLD_METADATA = """
+UPDATE links SET
+    name = (SELECT name FROM link_metadata WHERE link_id = links.id),
+    clicks = (SELECT clicks FROM link_metadata WHERE link_id = links.id),
+    last_ip = (SELECT last_ip FROM link_metadata WHERE link_id = links.id)
+WHERE id IN (SELECT link_id FROM link_metadata);
+DROP TABLE link_metadata;
+"""
+
+
+def _sqlite_time(value: datetime | None) -> str | None:
+    # fixed width, so comparing the text compares the times
+    return value.isoformat(" ", timespec="microseconds") if value is not None else None
+
+
+def _from_sqlite_time(value: str | None) -> datetime | None:
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+class SQLiteLinkStore(LinkStore):
+    """
+    A local SQLite file in WAL mode through the stdlib driver, without an
+    ORM or a connection pool. Statements run directly on the event loop: a
+    point lookup or a WAL commit with synchronous=NORMAL (no fsync until
+    checkpoint) takes microseconds, less than handing it to a thread would.
+    Only one process should write to the file.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SQLITE_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(links)")}
+        for column, column_type in SQLITE_ADDED_COLUMNS.items():
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE links ADD COLUMN {column} {column_type}")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_links_expires_at ON links (expires_at)"
+            " WHERE expires_at IS NOT NULL"
+        )
+        if self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'link_metadata'"
+        ).fetchone():
+            self._conn.executescript(f"BEGIN IMMEDIATE; {SQLITE_FOLD_METADATA} COMMIT;")
+
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        with span("link_lookup"):
+            row = self._conn.execute(
+                "SELECT long_url, name, clicks, last_ip, expires_at, max_clicks"
+                " FROM links WHERE id = ?",
+                (link_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        expires_at = _from_sqlite_time(row[4])
+        if link_expired(expires_at, row[5], row[2]):
+            return None
+        return StoredLink(link_id, row[0], row[1], row[2], row[3], expires_at, row[5])
+
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        with span("insert"):
+            try:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT INTO links (id, long_url, name, clicks, expires_at, max_clicks)"
+                        " VALUES (?, ?, ?, 0, ?, ?)",
+                        (link_id, long_url, name, _sqlite_time(expires_at), max_clicks),
+                    )
+            except sqlite3.IntegrityError:
+                raise LinkExistsError(link_id)
+        return StoredLink(link_id, long_url, name, expires_at=expires_at, max_clicks=max_clicks)
+
+    def _write_click(self, click: Click) -> tuple | None:
+        """
+        Count and log `click` unless its link has expired or is used up;
+        returns the link's (long_url, expires_at, max_clicks). The UPDATE
+        checks max_clicks as it counts, and the last allowed click sets
+        expires_at so the sweeper takes the link from there.
+        """
+        now = _sqlite_time(utc_now())
+        with span("click_write"), self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "UPDATE links SET clicks = clicks + 1, last_ip = ?,"
+                " updated_at = CURRENT_TIMESTAMP,"
+                " expires_at = CASE WHEN clicks + 1 >= max_clicks THEN ? ELSE expires_at END"
+                " WHERE id = ? AND (expires_at IS NULL OR expires_at > ?)"
+                " AND (max_clicks IS NULL OR clicks < max_clicks)"
+                " RETURNING long_url, expires_at, max_clicks",
+                (click.ip, now, click.link_id, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "INSERT INTO link_click_log (link_id, click_ip, timestamp, user_agent)"
+                " VALUES (?, ?, ?, ?)",
+                (click.link_id, click.ip, click.timestamp.isoformat(" "), click.user_agent),
+            )
+        return row
+
+    async def record_click(self, click: Click) -> bool:
+        return self._write_click(click) is not None
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        row = self._write_click(click)
+        if row is None:
+            return None
+        return StoredLink(
+            click.link_id, row[0], expires_at=_from_sqlite_time(row[1]), max_clicks=row[2]
+        )
+
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        link_ids = list(link_ids)
+        if not link_ids:
+            return set()
+        placeholders = ",".join("?" * len(link_ids))
+        rows = self._conn.execute(
+            f"SELECT id FROM links WHERE id IN ({placeholders})", link_ids
+        ).fetchall()
+        return {row[0] for row in rows}
+
+    async def count_links(self) -> int:
+        return self._conn.execute("SELECT count(*) FROM links").fetchone()[0]
+
+    async def iter_link_ids(self) -> AsyncIterator[str]:
+        cursor = self._conn.execute("SELECT id FROM links")
+        while rows := cursor.fetchmany(10_000):
+            for row in rows:
+                yield row[0]
+
+    async def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        cursor = self._conn.execute(
+            "SELECT id, long_url FROM links WHERE expires_at IS NULL AND max_clicks IS NULL"
+        )
+        while rows := cursor.fetchmany(10_000):
+            for link_id, long_url in rows:
+                yield link_id, long_url
+
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            link_ids = [
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT id FROM links WHERE expires_at <= ? ORDER BY expires_at LIMIT ?",
+                    (_sqlite_time(now), limit),
+                )
+            ]
+            if link_ids:
+                placeholders = ",".join("?" * len(link_ids))
+                for table, column in (
+                    ("link_click_log", "link_id"),
+                    ("links", "id"),
+                ):
+                    self._conn.execute(
+                        f"DELETE FROM {table} WHERE {column} IN ({placeholders})", link_ids
+                    )
+        return link_ids
+
+    async def close(self):
+        self._conn.close()
+
+
+class MemoryLinkStore(LinkStore):
+    """
+    Dicts in process memory; nothing survives a restart. Expiring links are
+    also filed in a timing wheel, which plays the part of the expires_at
+    index for delete_expired.
+    """
+
+    name = "memory"
+
+    def __init__(self, click_log_size: int = MEMORY_CLICK_LOG_SIZE):
+        self.links: dict[str, StoredLink] = {}
+        self.clicks: deque[Click] = deque(maxlen=click_log_size)
+        self._expiring = TimingWheel(1.0, 3600, utc_now().timestamp())
+
+    def _schedule_expiry(self, link: StoredLink):
+        at = link.expires_at.replace(tzinfo=timezone.utc).timestamp()
+        self._expiring.schedule(link.id, at)
+
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        link = self.links.get(link_id)
+        if link is None or link_expired(link.expires_at, link.max_clicks, link.clicks):
+            return None
+        return link
+
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        if link_id in self.links:
+            raise LinkExistsError(link_id)
+        link = self.links[link_id] = StoredLink(
+            link_id, long_url, name, expires_at=expires_at, max_clicks=max_clicks
+        )
+        if expires_at is not None:
+            self._schedule_expiry(link)
+        return link
+
+    async def record_click(self, click: Click) -> bool:
+        link = self.links.get(click.link_id)
+        if link is None:
+            return False
+        link.clicks += 1
+        link.last_ip = click.ip
+        self.clicks.append(click)
+        if link.max_clicks is not None and link.clicks >= link.max_clicks:
+            link.expires_at = utc_now()
+            self._schedule_expiry(link)
+        return True
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        link = await self.get_link(click.link_id)
+        if link is None:
+            return None
+        await self.record_click(click)
+        return link
+
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        return {link_id for link_id in link_ids if link_id in self.links}
+
+    async def count_links(self) -> int:
+        return len(self.links)
+
+    async def iter_link_ids(self) -> AsyncIterator[str]:
+        for link_id in list(self.links):
+            yield link_id
+
+    async def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        for link in list(self.links.values()):
+            if link.expires_at is None and link.max_clicks is None:
+                yield link.id, link.long_url
+
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        # the wheel hands out everything that is due, limit or not
+        link_ids = self._expiring.advance(now.replace(tzinfo=timezone.utc).timestamp())
+        for link_id in link_ids:
+            self.links.pop(link_id, None)
+        return link_ids
+
+
+class SnapshotLinkStore(LinkStore):
+    """
+    Answers redirect lookups from an immutable LinkSnapshot (see
+    src/snapshot.py) and everything else from `inner`: metadata and clicks,
+    new links, and the lookups for links created after the snapshot. Links
+    never change once created and expiring ones are left out of snapshots
+    (see iter_links), so a snapshot hit is always right.
+
+    A hit only skips the database when its click can go to `click_spool`.
+    Without one, counting the click takes the same statement as looking the
+    link up (see SQLAlchemyLinkStore.follow_link), so hits go to `inner`
+    too; the snapshot then still answers alias checks, and redirects while
+    the database is unavailable (see GuardedLinkStore).
+    """
+
+    def __init__(self, inner: LinkStore, path: str, click_spool: ClickSpool | None = None):
+        self.inner = inner
+        self.click_spool = click_spool
+        self.name = f"snapshot+{inner.name}"
+        self.path = path
+        self.snapshot: LinkSnapshot | None = None
+        self._loaded_mtime: int | None = None
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """Load the file if it changed since the last load; True when it did."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self._loaded_mtime:
+            return False
+        try:
+            snapshot = LinkSnapshot(self.path)
+        except (OSError, ValueError) as e:
+            print(f"Failed to load link snapshot {self.path}: {e}")
+            return False
+        previous, self.snapshot, self._loaded_mtime = self.snapshot, snapshot, mtime
+        if previous is not None:
+            previous.close()
+        print(f"Loaded link snapshot {self.path} with {len(snapshot)} links")
+        return True
+
+    async def keep_fresh(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.refresh()
+
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        return await self.inner.get_link(link_id)
+
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        return await self.inner.create_link(link_id, long_url, name, expires_at, max_clicks)
+
+    async def record_click(self, click: Click) -> bool:
+        return await self.inner.record_click(click)
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        long_url = self.snapshot.lookup(click.link_id) if self.snapshot is not None else None
+        if long_url is None:
+            metrics.inc("link_snapshot_lookups_total", result="miss")
+            return await self.inner.follow_link(click)
+        metrics.inc("link_snapshot_lookups_total", result="hit")
+        if self.click_spool is None:
+            return await self.inner.follow_link(click)
+        self.click_spool.append(click.link_id, click.ip, click.timestamp, click.user_agent)
+        return StoredLink(click.link_id, long_url)
+
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        link_ids = list(link_ids)
+        taken = set()
+        if self.snapshot is not None:
+            taken = {link_id for link_id in link_ids if self.snapshot.lookup(link_id) is not None}
+        rest = [link_id for link_id in link_ids if link_id not in taken]
+        if rest:
+            taken |= await self.inner.taken_ids(rest)
+        return taken
+
+    async def count_links(self) -> int:
+        return await self.inner.count_links()
+
+    def iter_link_ids(self) -> AsyncIterator[str]:
+        return self.inner.iter_link_ids()
+
+    def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        return self.inner.iter_links()
+
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        return await self.inner.delete_expired(now, limit)
+
+    async def close(self):
+        await self.inner.close()
+        if self.snapshot is not None:
+            self.snapshot.close()
+
+
+class GuardedLinkStore(LinkStore):
+    """
+    Puts a CircuitBreaker in front of `inner`. Calls that fail with a
+    database error, or take longer than `timeout`, count against it, and
+    while it is open they raise DatabaseUnavailableError right away instead
+    of waiting on the database.
+
+    Redirects degrade instead: every followed link is kept in a LinkCache,
+    and while the database is unavailable a redirect is answered from it
+    (or from the link snapshot), stale-while-revalidate: the first request
+    let through by the half-open breaker revalidates against the database.
+    Links limited by max_clicks are never served stale. The clicks of stale
+    redirects go to the click spool if there is one, and are lost otherwise.
+    """
+
+    def __init__(
+        self,
+        inner: LinkStore,
+        breaker: CircuitBreaker,
+        link_cache: LinkCache,
+        timeout: float = DB_CALL_TIMEOUT,
+        click_spool: ClickSpool | None = None,
+    ):
+        self.inner = inner
+        self.name = f"guarded+{inner.name}"
+        self.breaker = breaker
+        self.link_cache = link_cache
+        self.timeout = timeout
+        self.click_spool = click_spool
+
+    async def _call(self, operation):
+        if not self.breaker.allow():
+            raise DatabaseUnavailableError("The database is unavailable, try again shortly")
+        try:
+            async with asyncio.timeout(self.timeout):
+                result = await operation()
+        except Exception as e:
+            if not is_database_error(e):
+                self.breaker.record_success()  # the database answered
+                raise
+            self.breaker.record_failure()
+            print(f"Database call failed: {e!r}")
+            raise DatabaseUnavailableError("The database is unavailable, try again shortly") from e
+        except BaseException:
+            self.breaker.abandon()
+            raise
+        self.breaker.record_success()
+        return result
+
+    def _stale_url(self, link_id: str) -> str | None:
+        long_url = self.link_cache.get(link_id)
+        snapshot = getattr(self.inner, "snapshot", None)
+        if long_url is None and snapshot is not None:
+            long_url = snapshot.lookup(link_id)
+        return long_url
+
+    async def get_link(self, link_id: str) -> StoredLink | None:
+        return await self._call(lambda: self.inner.get_link(link_id))
+
+    async def create_link(
+        self,
+        link_id: str,
+        long_url: str,
+        name: str = "",
+        expires_at: datetime | None = None,
+        max_clicks: int | None = None,
+    ) -> StoredLink:
+        return await self._call(
+            lambda: self.inner.create_link(link_id, long_url, name, expires_at, max_clicks)
+        )
+
+    async def record_click(self, click: Click) -> bool:
+        return await self._call(lambda: self.inner.record_click(click))
+
+    async def follow_link(self, click: Click) -> StoredLink | None:
+        try:
+            link = await self._call(lambda: self.inner.follow_link(click))
+        except DatabaseUnavailableError:
+            long_url = self._stale_url(click.link_id)
+            if long_url is None:
+                metrics.inc("degraded_redirects_total", result="miss")
+                raise
+            metrics.inc("degraded_redirects_total", result="hit")
+            if self.click_spool is not None:
+                self.click_spool.append(click.link_id, click.ip, click.timestamp, click.user_agent)
+            return StoredLink(click.link_id, long_url)
+        if link is not None and link.max_clicks is None:
+            expires_at = link.expires_at
+            self.link_cache.put(
+                link.id,
+                link.long_url,
+                expires_at.replace(tzinfo=timezone.utc).timestamp() if expires_at else None,
+            )
+        return link
+
+    async def taken_ids(self, link_ids: Iterable[str]) -> set[str]:
+        return await self._call(lambda: self.inner.taken_ids(link_ids))
+
+    async def count_links(self) -> int:
+        return await self._call(self.inner.count_links)
+
+    def iter_link_ids(self) -> AsyncIterator[str]:
+        return self.inner.iter_link_ids()
+
+    def iter_links(self) -> AsyncIterator[tuple[str, str]]:
+        return self.inner.iter_links()
+
+    async def delete_expired(self, now: datetime, limit: int) -> list[str]:
+        return await self._call(lambda: self.inner.delete_expired(now, limit))
+
+    async def close(self):
+        await self.inner.close()
+
+
+def create_link_store(backend: str) -> LinkStore:
+    if backend == "sqlalchemy":
+        return SQLAlchemyLinkStore(click_buffer, click_spool, CLICK_COUNTER_SHARDS)
+    if backend == "sqlite":
+        return SQLiteLinkStore(SQLITE_PATH)
+    if backend == "memory":
+        return MemoryLinkStore()
+    raise EnvironmentError(f"Unknown STORAGE_BACKEND {backend!r}, use sqlalchemy, sqlite or memory")
+
+
+# flushed by a task the lifespan runs (see src/clicks.py)
+click_buffer = (
+    ClickBuffer(async_engine)
+    if CLICK_BUFFER_ENABLED and STORAGE_BACKEND == "sqlalchemy" and async_engine is not None
+    else None
+)
+if click_buffer is not None:
+    metrics.gauge(
+        "click_buffer_pending",
+        "Clicks waiting to be written to the click log.",
+        lambda: len(click_buffer),
+    )
+# fsynced and replayed by tasks the lifespan runs (see src/spool.py)
+click_spool = (
+    ClickSpool(CLICK_SPOOL_DIR)
+    if CLICK_SPOOL_DIR and STORAGE_BACKEND == "sqlalchemy" and async_engine is not None
+    else None
+)
+if click_spool is not None:
+    metrics.gauge(
+        "click_spool_backlog_bytes",
+        "Bytes of spooled clicks not yet replayed to the database.",
+        click_spool.backlog_bytes,
+    )
+link_store = create_link_store(STORAGE_BACKEND)
+link_snapshot_store = None
+if LINK_SNAPSHOT_PATH:
+    link_store = link_snapshot_store = SnapshotLinkStore(
+        link_store, LINK_SNAPSHOT_PATH, click_spool=click_spool
+    )
+    metrics.gauge(
+        "link_snapshot_entries",
+        "Links in the loaded snapshot.",
+        lambda: len(link_snapshot_store.snapshot) if link_snapshot_store.snapshot is not None else 0,
+    )
+# the database backend only; SQLite and memory are in-process
+db_breaker = None
+if DB_BREAKER_ENABLED and STORAGE_BACKEND == "sqlalchemy":
+    db_breaker = CircuitBreaker(DB_BREAKER_FAILURES, DB_BREAKER_RESET_TIMEOUT)
+    link_store = GuardedLinkStore(
+        link_store, db_breaker, LinkCache(LINK_CACHE_SIZE), click_spool=click_spool
+    )
+    metrics.gauge(
+        "db_breaker_state",
+        "Database circuit breaker: 0 closed, 1 half open, 2 open.",
+        lambda: BREAKER_STATES[db_breaker.state],
+    )
+    metrics.gauge(
+        "link_cache_entries",
+        "Links kept for redirects while the database is unavailable.",
+        lambda: len(link_store.link_cache),
+    )
+
+
+def get_link_store() -> LinkStore:
+    """FastAPI dependency, so tests can swap the store with dependency_overrides."""
+    return link_store
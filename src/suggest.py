@@ -0,0 +1,360 @@
+import json
+import os
+import re
+from collections import Counter
+from typing import AsyncIterator
+from urllib.parse import unquote, urlsplit
+
+import httpx
+from bs4 import BeautifulSoup
+from src.filters import link_id_filter
+from src.metrics import metrics
+from src.schemas import LinkShortUrlSuggestionsResponse
+from src.storage import LinkStore
+from src.tracing import span
+from src.utils import PROMPT, get_genai_client, llm_limiter
+
+
+class LLMEmptyError(Exception):
+    """Raised when the LLM answers without any alias suggestions."""
+
+
+# "local" answers from the URL alone, "llm" asks Gemini, "hybrid" asks Gemini
+# but falls back to local suggestions if it is not done within the budget.
+ALIAS_SUGGEST_MODE = os.getenv("ALIAS_SUGGEST_MODE", "local")
+ALIAS_SUGGEST_LLM_BUDGET = float(os.getenv("ALIAS_SUGGEST_LLM_BUDGET", "2.0"))
+
+# Same rules the LLM prompt asks for: lowercase alphanumerics and hyphens,
+# under 15 characters. 5 is the lower bound /alias/check accepts.
+ALIAS_MIN_LENGTH = 5
+ALIAS_MAX_LENGTH = 14
+
+FETCH_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/143.0.0.0 Safari/537.36 Edg/143.0.0.0"
+}
+
+STOPWORDS = {
+    "a", "about", "an", "and", "are", "as", "at", "be", "by", "can", "com",
+    "de", "do", "does", "en", "for", "from", "has", "have", "how", "htm",
+    "html", "http", "https", "i", "in", "index", "into", "is", "it", "its",
+    "js", "me", "my", "net", "of", "on", "or", "org", "our", "page", "php",
+    "s", "the", "their", "this", "to", "was", "we", "what", "when", "where",
+    "which", "who", "why", "will", "with", "www", "you", "your",
+}
+
+ABBREVIATIONS = {
+    "administration": "admin",
+    "application": "app",
+    "applications": "apps",
+    "architecture": "arch",
+    "article": "art",
+    "configuration": "config",
+    "database": "db",
+    "development": "dev",
+    "developer": "dev",
+    "developers": "devs",
+    "documentation": "docs",
+    "download": "dl",
+    "example": "ex",
+    "examples": "ex",
+    "government": "gov",
+    "information": "info",
+    "international": "intl",
+    "introduction": "intro",
+    "javascript": "js",
+    "kubernetes": "k8s",
+    "library": "lib",
+    "management": "mgmt",
+    "performance": "perf",
+    "presentation": "pres",
+    "production": "prod",
+    "programming": "prog",
+    "python": "py",
+    "reference": "ref",
+    "repository": "repo",
+    "specification": "spec",
+    "statistics": "stats",
+    "tutorial": "tut",
+    "typescript": "ts",
+}
+
+_SPLIT_RE = re.compile(r"[^A-Za-z0-9]+")
+_CAMEL_RE = re.compile(r"(?<=[a-z])(?=[A-Z])")
+_UNSAFE_RE = re.compile(r"[^a-z0-9-]")
+
+
+def _tokens(text: str) -> list[str]:
+    words = []
+    for chunk in _SPLIT_RE.split(text):
+        for word in _CAMEL_RE.split(chunk):
+            word = word.lower()
+            if len(word) < 2 or word in STOPWORDS:
+                continue
+            if word.isdigit() and len(word) > 4:  # ids, timestamps
+                continue
+            words.append(word)
+    return words
+
+
+def _abbreviate(word: str) -> str:
+    if word in ABBREVIATIONS:
+        return ABBREVIATIONS[word]
+    if len(word) <= 6:
+        return word
+    # keep the first letter and the consonants: "shortener" -> "shrtnr"
+    return (word[0] + re.sub(r"[aeiou]", "", word[1:]))[:6]
+
+
+def _clean_alias(alias: str) -> str:
+    alias = _UNSAFE_RE.sub("", alias.lower().replace("_", "-"))
+    return re.sub(r"-{2,}", "-", alias).strip("-")
+
+
+def _keywords(long_url: str, title: str | None, text: str | None) -> list[str]:
+    """Rank candidate words: title first, then URL path, then frequent page words."""
+    parts = urlsplit(long_url)
+    host_labels = [
+        label for label in (parts.hostname or "").split(".")[:-1] if label != "www"
+    ]
+    # the last path segment is usually the most specific one
+    segments = [s for s in unquote(parts.path).split("/") if s][::-1]
+    path_words = [word for segment in segments for word in _tokens(segment)]
+
+    ranked: list[str] = []
+    for word in _tokens(title or "") + path_words:
+        if word not in ranked:
+            ranked.append(word)
+
+    if text:
+        for word, _ in Counter(w for w in _tokens(text) if len(w) > 3).most_common(8):
+            if word not in ranked:
+                ranked.append(word)
+
+    for label in host_labels[::-1]:
+        for word in _tokens(label):
+            if word not in ranked:
+                ranked.append(word)
+    return ranked
+
+
+def _join(words: list[str], sep: str = "-") -> str | None:
+    """Join words into an alias, abbreviating them if the full form is too long."""
+    for form in (words, [_abbreviate(w) for w in words]):
+        alias = _clean_alias(sep.join(form))
+        if ALIAS_MIN_LENGTH <= len(alias) <= ALIAS_MAX_LENGTH:
+            return alias
+    return None
+
+
+def local_alias_candidates(
+    long_url: str, title: str | None = None, text: str | None = None, limit: int = 30
+) -> list[str]:
+    """
+    Deterministic alias suggestions built from the URL, page title and page
+    keywords. Pure string work, no network or database access.
+    """
+    words = _keywords(long_url, title, text)
+    top = words[:5]
+
+    combos: list[list[str]] = []
+    for i, first in enumerate(top):
+        for second in top[i + 1 :]:
+            combos.append([first, second])
+    for i in range(len(top) - 2):
+        combos.append(top[i : i + 3])
+    combos.extend([word] for word in words[:8])
+
+    candidates: list[str] = []
+    for combo in combos:
+        for sep in ("-", ""):
+            alias = _join(combo, sep)
+            if alias and alias not in candidates:
+                candidates.append(alias)
+                break
+
+    # numbered variants keep the list useful when the good names are taken
+    base = candidates[:3] or [_join(words[:1]) or "link"]
+    n = 2
+    while len(candidates) < limit:
+        for alias in base:
+            numbered = f"{alias[: ALIAS_MAX_LENGTH - len(str(n)) - 1]}-{n}"
+            if numbered not in candidates:
+                candidates.append(numbered)
+        n += 1
+    return candidates[:limit]
+
+
+async def available_aliases(store: LinkStore, names: list[str]) -> list[str]:
+    """
+    Drop the names already used as link ids, keeping order. Names the link id
+    filter has never seen are available without asking the store; the rest
+    are confirmed in a single lookup.
+    """
+    maybe_taken = [name for name in names if link_id_filter.might_exist(name)]
+    if not maybe_taken:
+        return list(names)
+    with span("availability", names=len(maybe_taken)):
+        taken = await store.taken_ids(maybe_taken)
+    return [name for name in names if name not in taken]
+
+
+async def suggest_local_aliases(
+    store: LinkStore,
+    long_url: str,
+    count: int,
+    title: str | None = None,
+    text: str | None = None,
+) -> list[str]:
+    candidates = local_alias_candidates(long_url, title, text, limit=max(30, count * 3))
+    return (await available_aliases(store, candidates))[:count]
+
+
+async def fetch_page(long_url: str) -> "httpx.Response":
+    with span("fetch"), metrics.time_block("outbound_request_duration_seconds", target="fetch"):
+        async with httpx.AsyncClient(
+            timeout=5.0, follow_redirects=True, headers=FETCH_HEADERS
+        ) as client:
+            return await client.get(long_url)
+
+
+def parse_page(html: str) -> tuple[str | None, str]:
+    """Return the page title and its visible text."""
+    with span("parse", bytes=len(html)):
+        soup = BeautifulSoup(html, "html.parser")
+        title = soup.title.get_text(strip=True) if soup.title else None
+        keywords = soup.find("meta", attrs={"name": "keywords"})
+        text = soup.get_text(" ", strip=True)
+    if keywords and keywords.get("content"):
+        text = f"{keywords['content']} {text}"
+    return title, text
+
+
+async def llm_alias_batch(long_url: str, text: str, needed: int) -> list[str]:
+    client = await get_genai_client()
+
+    async def call():
+        with span("llm"), metrics.time_block("outbound_request_duration_seconds", target="llm"):
+            return await client.aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=[
+                    PROMPT.format(
+                        url=long_url, text=text[:5000], needed=int(needed * 2)
+                    )  # take first 5000 chars only from the page, double the needed count to avoid duplicates
+                ],
+                config={
+                    "response_mime_type": "application/json",
+                    "response_schema": LinkShortUrlSuggestionsResponse,
+                },
+            )
+
+    ai_resp = await llm_limiter.run(call)
+    parsed = LinkShortUrlSuggestionsResponse.model_validate(ai_resp.parsed)
+    return list(dict.fromkeys(parsed.suggested_names))
+
+
+async def collect_llm_aliases(
+    store: LinkStore, long_url: str, text: str, count: int
+) -> list[str]:
+    """Ask the LLM for more names until `count` of them are available."""
+    aliases: list[str] = []
+    while len(aliases) < count:
+        batch = await llm_alias_batch(long_url, text, count - len(aliases))
+        if not batch:
+            raise LLMEmptyError()
+        batch = [name for name in batch if name not in aliases]
+        aliases.extend(await available_aliases(store, batch))
+    return aliases[:count]  # return only the requested count
+
+
+class _NameStreamParser:
+    """
+    Pulls the complete names out of a partially received
+    `{"suggested_names": [...]}` document, so each one can be used as soon
+    as its closing quote arrives.
+    """
+
+    def __init__(self):
+        self._in_array = False
+        self._in_string = False
+        self._escaped = False
+        self._buffer: list[str] = []
+
+    def feed(self, text: str) -> list[str]:
+        names = []
+        for ch in text:
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                    names.append(json.loads('"' + "".join(self._buffer) + '"'))
+                    self._buffer = []
+                    continue
+                self._buffer.append(ch)
+            elif not self._in_array:
+                self._in_array = ch == "["
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "]":
+                self._in_array = False
+        return names
+
+
+async def stream_llm_aliases(
+    store: LinkStore,
+    long_url: str,
+    text: str,
+    count: int,
+    exclude: set[str] | None = None,
+) -> AsyncIterator[str]:
+    """
+    Like `collect_llm_aliases`, but streams the model output and yields the
+    available aliases of each generated batch. The LLM slot is only held while
+    a batch is generated, not while the caller sends the aliases on.
+    """
+    client = await get_genai_client()
+    seen = set(exclude or ())
+    emitted = 0
+    while emitted < count:
+        need = count - emitted
+        async with llm_limiter.slot():
+            attempt = 0
+            while True:
+                parser = _NameStreamParser()
+                batch: list[str] = []
+                try:
+                    # only until the model starts answering
+                    with span("llm_stream"), metrics.time_block(
+                        "outbound_request_duration_seconds", target="llm_stream"
+                    ):
+                        stream = await client.aio.models.generate_content_stream(
+                            model="gemini-2.5-flash",
+                            contents=[
+                                PROMPT.format(url=long_url, text=text[:5000], needed=int(need * 2))
+                            ],
+                            config={
+                                "response_mime_type": "application/json",
+                                "response_schema": LinkShortUrlSuggestionsResponse,
+                            },
+                        )
+                    async for chunk in stream:
+                        for name in parser.feed(chunk.text or ""):
+                            if name not in seen and name not in batch:
+                                batch.append(name)
+                    break
+                except Exception as e:
+                    # nothing went out yet, so the whole batch can be retried
+                    if not llm_limiter.should_retry(e, attempt):
+                        raise
+                    await llm_limiter.backoff(attempt)
+                    attempt += 1
+        if not batch:
+            raise LLMEmptyError()
+        seen.update(batch)
+        for name in await available_aliases(store, batch):
+            yield name
+            emitted += 1
+            if emitted >= count:
+                return
@@ -0,0 +1,254 @@
+import asyncio
+import json
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+
+from src.metrics import route_template
+
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "1") == "1"
+# OTLP/JSON export of finished traces: a file (one ExportTraceServiceRequest
+# per line, like the collector's file exporter) and/or an OTLP/HTTP endpoint
+# such as http://localhost:4318/v1/traces
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE")
+TRACE_EXPORT_URL = os.getenv("TRACE_EXPORT_URL")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "url-shortener")
+
+TRACING_ENABLED = SERVER_TIMING_ENABLED or bool(TRACE_EXPORT_FILE or TRACE_EXPORT_URL)
+
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start_ns", "duration_ns", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: str | None, attributes: dict):
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.duration_ns = 0
+        self.attributes = attributes
+        self.error: str | None = None
+
+
+class Trace:
+    """The spans of one request. The root span is the request itself."""
+
+    def __init__(self, trace_id: str | None = None, parent_id: str | None = None):
+        self.trace_id = trace_id or f"{random.getrandbits(128):032x}"
+        self.root = Span("request", parent_id, {})
+        self.spans: list[Span] = []
+
+    def server_timing(self, total_ms: float) -> str:
+        """`Server-Timing` value; repeated spans (e.g. retried LLM calls) are summed."""
+        totals: dict[str, float] = {}
+        for span in self.spans:
+            totals[span.name] = totals.get(span.name, 0) + span.duration_ns / 1e6
+        parts = [f"{name};dur={ms:.2f}" for name, ms in totals.items()]
+        parts.append(f"total;dur={total_ms:.2f}")
+        return ", ".join(parts)
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+_current_span_id: ContextVar[str | None] = ContextVar("current_span_id", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time a phase of the current request. Nests, and does nothing outside a
+    traced request. Names end up in the Server-Timing header, so keep them
+    to letters, digits and underscores.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    current = Span(name, _current_span_id.get(), attributes)
+    token = _current_span_id.set(current.span_id)
+    started = time.perf_counter_ns()
+    try:
+        yield
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.duration_ns = time.perf_counter_ns() - started
+        _current_span_id.reset(token)
+        trace.spans.append(current)
+
+
+def _attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _otlp_span(trace: Trace, span: Span) -> dict:
+    data = {
+        "traceId": trace.trace_id,
+        "spanId": span.span_id,
+        "name": span.name,
+        "kind": 2 if span is trace.root else 1,  # SERVER / INTERNAL
+        "startTimeUnixNano": str(span.start_ns),
+        "endTimeUnixNano": str(span.start_ns + span.duration_ns),
+        "attributes": [_attribute(k, v) for k, v in span.attributes.items()],
+        "status": {"code": 2, "message": span.error} if span.error else {},
+    }
+    if span.parent_id:
+        data["parentSpanId"] = span.parent_id
+    return data
+
+
+async def _post_traces(url: str, body: dict):
+    # a plain function, so build.py can defer importing httpx into it
+    async with httpx.AsyncClient(timeout=5.0) as client:
+        resp = await client.post(url, json=body)
+        resp.raise_for_status()
+
+
+class TraceExporter:
+    """
+    Buffers finished traces and writes them out in batches, off the request
+    path, as OTLP/JSON. Flushed every `interval` seconds by `run()` (started
+    from the lifespan), when the buffer fills up, and on shutdown.
+    """
+
+    def __init__(self, file: str | None, url: str | None, interval: float, batch_size: int = 512):
+        self.file = file
+        self.url = url
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending: list[Trace] = []
+        self._flushing: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.file or self.url)
+
+    def add(self, trace: Trace):
+        self._pending.append(trace)
+        if len(self._pending) >= self.batch_size and (
+            self._flushing is None or self._flushing.done()
+        ):
+            self._flushing = asyncio.create_task(self.flush())
+
+    def _request_body(self, traces: list[Trace]) -> dict:
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [_attribute("service.name", TRACE_SERVICE_NAME)]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "src.tracing"},
+                            "spans": [
+                                _otlp_span(trace, span)
+                                for trace in traces
+                                for span in (trace.root, *trace.spans)
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def _append_to_file(self, line: str):
+        with open(self.file, "a") as f:
+            f.write(line + "\n")
+
+    async def flush(self):
+        traces, self._pending = self._pending, []
+        if not traces:
+            return
+        body = self._request_body(traces)
+        try:
+            if self.file:
+                await asyncio.to_thread(self._append_to_file, json.dumps(body))
+            if self.url:
+                await _post_traces(self.url, body)
+        except Exception as e:
+            print(f"Failed to export {len(traces)} traces: {e}")
+
+    async def run(self):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+
+trace_exporter = TraceExporter(TRACE_EXPORT_FILE, TRACE_EXPORT_URL, TRACE_EXPORT_INTERVAL)
+
+
+class TracingMiddleware:
+    """
+    Starts a trace per HTTP request, adds a `Server-Timing` header with the
+    spans finished before the response started, and hands sampled traces to
+    the exporter. Joins the caller's trace when a W3C `traceparent` header
+    is sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace_id = parent_id = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                match = _TRACEPARENT_RE.match(value.decode("latin-1"))
+                if match:
+                    trace_id, parent_id = match.groups()
+                break
+        trace = Trace(trace_id, parent_id)
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span_id.set(trace.root.span_id)
+        started = time.perf_counter_ns()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if SERVER_TIMING_ENABLED:
+                    total_ms = (time.perf_counter_ns() - started) / 1e6
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"server-timing", trace.server_timing(total_ms).encode("latin-1")),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_span_id.reset(span_token)
+            _current_trace.reset(trace_token)
+            trace.root.duration_ns = time.perf_counter_ns() - started
+            if trace_exporter.enabled and random.random() < TRACE_SAMPLE_RATE:
+                trace.root.name = f"{scope['method']} {route_template(scope)}"
+                trace.root.attributes = {
+                    "http.request.method": scope["method"],
+                    "http.route": route_template(scope),
+                    "http.response.status_code": status,
+                }
+                if status >= 500:
+                    trace.root.error = str(status)
+                trace_exporter.add(trace)
@@ -1,12 +1,143 @@
+import asyncio
 import os
+import random
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, TypeVar
+
+import httpx
 from google.genai import Client as GenAIClient
+from google.genai import errors as genai_errors
+
+from src.metrics import metrics
+
+T = TypeVar("T")
+
+# One client per process; building it on every request costs a fresh HTTP
+# client and TLS handshake to the model provider. The annotations are strings
+# so the bundle built by build.py can defer importing google.genai.
+_genai_client: "GenAIClient | None" = None
+
+
+async def get_genai_client() -> "GenAIClient":
+    global _genai_client
+    if _genai_client is None:
+        api_key = os.getenv("GOOGLE_API_KEY")
+        if not api_key:
+            raise EnvironmentError("GOOGLE_API_KEY not found in environment variables")
+        # GOOGLE_GENAI_BASE_URL lets us point the client at a local fake model
+        # server (see scripts/fake_genai_server.py) instead of Gemini.
+        base_url = os.getenv("GOOGLE_GENAI_BASE_URL")
+        _genai_client = GenAIClient(
+            api_key=api_key,
+            http_options={"base_url": base_url} if base_url else None,
+        )
+    return _genai_client
+
+
+async def close_genai_client():
+    global _genai_client
+    if _genai_client is not None:
+        await _genai_client.aio.aclose()
+        _genai_client = None
+
+
+class LLMBusyError(Exception):
+    """Raised when an LLM call cannot get a slot within the queue limits."""
+
+
+def _is_retryable(exc: Exception) -> bool:
+    if isinstance(exc, genai_errors.ServerError):
+        return True
+    if isinstance(exc, genai_errors.ClientError):
+        return exc.code == 429  # rate limited by the provider
+    return isinstance(exc, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class LLMLimiter:
+    """
+    Bounds the number of in-flight LLM calls.
+
+    At most `max_concurrency` calls run at once, at most `max_waiting` callers
+    wait for a slot, and a waiter gives up after `wait_timeout` seconds.
+    Retryable failures (5xx, 429, transport errors) are retried with
+    full-jitter exponential backoff while still holding the slot.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_waiting: int,
+        wait_timeout: float,
+        max_retries: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._waiting = 0
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one concurrency slot, e.g. for the lifetime of a streamed call."""
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()  # free slot, does not suspend
+        elif self._waiting >= self.max_waiting:
+            raise LLMBusyError("Too many pending AI requests, try again later")
+        else:
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                raise LLMBusyError("Timed out waiting for an AI request slot")
+            finally:
+                self._waiting -= 1
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+    def should_retry(self, exc: Exception, attempt: int) -> bool:
+        return attempt < self.max_retries and _is_retryable(exc)
+
+    async def backoff(self, attempt: int):
+        delay = min(self.max_delay, self.base_delay * 2**attempt)
+        await asyncio.sleep(random.uniform(0, delay))
+
+    async def run(self, call: Callable[[], Awaitable[T]]) -> T:
+        async with self.slot():
+            attempt = 0
+            while True:
+                try:
+                    return await call()
+                except Exception as e:
+                    if not self.should_retry(e, attempt):
+                        raise
+                    await self.backoff(attempt)
+                    attempt += 1
 
 
-async def get_genai_client() -> GenAIClient:
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        raise EnvironmentError("GOOGLE_API_KEY not found in environment variables")
-    return GenAIClient(api_key=api_key)
+llm_limiter = LLMLimiter(
+    max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "4")),
+    max_waiting=int(os.getenv("LLM_MAX_WAITING", "16")),
+    wait_timeout=float(os.getenv("LLM_WAIT_TIMEOUT", "10")),
+    max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+    base_delay=float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5")),
+)
+metrics.gauge(
+    "llm_waiting_requests",
+    "Callers waiting for an LLM concurrency slot.",
+    lambda: llm_limiter.waiting,
+)
 
 
 PROMPT = """